@@ -17,6 +17,17 @@ a number of functions:
     - Provide a convenient web interface to view the message log
     - Allow users to respond to messages from the web interface
     - Imports from the original logger app
+    - Optionally buffer LoggedMessages and write them in bulk, possibly
+      from a background thread
+    - Optionally spool LoggedMessages to a local file while the database
+      is down or slow
+    - Optionally publish LoggedMessages to a live tail of the log
+    - Keep hourly and daily traffic counts (see rollup.py), and response
+      latency histograms (see latency.py)
+    - Keep a summary of the activity of each phone (see summary.py)
+    - Group the messages exchanged with a phone in conversations (see
+      conversation.py)
+    - Time the stages of logging a message (see instrument.py)
 
 logger_ng does not play well with logger. To switch from using the original
 logger app, to logger_ng, simply edit your local.ini and change logger
@@ -33,11 +44,84 @@ Conflicts:
 
 Dependencies:
     direct_sms
+
+Configuration (all optional, in the [logger_ng] section of local.ini):
+    batch_size - when set, LoggedMessages are buffered and written in bulk
+                 once this many are waiting (see batch.py). Defaults to 0,
+                 meaning each message is saved as soon as it is logged.
+    batch_interval - maximum number of seconds a buffered message waits
+                     before being written. Defaults to 1.
+    reporter_cache_size - number of (backend, identity) to reporter lookups
+                          kept in memory. Defaults to 1000, 0 disables it.
+    reporter_cache_ttl - seconds after which a cached reporter lookup is
+                         done again. Defaults to 300.
+    response_window - number of recent incoming message ids remembered, so
+                      that responses can be linked to them without a query.
+                      Defaults to 1000.
+    writer_queue_size - when set, LoggedMessages are written by a background
+                        thread, from a queue of at most this many messages
+                        (see writer.py). batch_size is then the maximum
+                        number of messages written at once. Defaults to 0.
+    writer_policy - what to do when the writer queue is full: block,
+                    drop_oldest or spill (which needs a spool_path).
+                    Defaults to block.
+    spool_path - when set, LoggedMessages are appended to this file when
+                 the database is failing or slow, and written to the
+                 database once it has recovered (see spool.py).
+    spool_slow_ms - a database write taking longer than this many
+                    milliseconds counts as a failure. Defaults to 1000.
+    spool_error_rate - proportion of the last 20 database writes that must
+                       have failed for messages to be spooled. Defaults to
+                       0.5.
+    spool_retry - seconds to wait before trying the database again.
+                  Defaults to 30.
+    live_port - when set, logged messages are published on this port of
+                localhost for the live tail of the log (see live.py). Set
+                LOGGER_NG_LIVE_PORT to the same port in the Django
+                settings. Defaults to 0, meaning disabled.
+    live_secret - a password, without spaces, that the web server must give
+                  to get the live tail. Required with live_port. Set
+                  LOGGER_NG_LIVE_SECRET to the same in the Django settings.
+    rollup_interval - seconds between updates of the traffic rollups, the
+                      response latencies and the identity summaries (see
+                      rollup.py, latency.py and summary.py). Defaults to
+                      10, 0 disables all three.
+    conversation_window - a message sent or received more than this many
+                          seconds after the previous one with the same
+                          phone starts a new conversation (see
+                          conversation.py). Defaults to 1800, 0 disables
+                          conversations. A phone whose last message isn't
+                          in memory costs one query. Messages get their id
+                          before they are saved, from blocks reserved as
+                          for batch_size (see batch.IdAllocator).
+    instrument - time the stages of logging a message and count events in
+                 memory (see instrument.py). Defaults to 1, 0 disables it.
+    stats_path - when set, the timers and counters, with the reporter
+                 cache, writer and spool statistics, are written to this
+                 file as JSON every rollup_interval seconds, for
+                 ./rapidsms logger_stats. Set LOGGER_NG_STATS_PATH to the
+                 same file in the Django settings to serve it at
+                 /logger_ng/instrumentation.json.
 '''
 
+import time
+import threading
+from datetime import datetime
+
 import rapidsms
+from django.db import transaction, DatabaseError
 
-from models import LoggedMessage
+import live
+import batch
+import spool
+import rollup
+import latency
+import summary
+import conversation
+import instrument
+import writer
+from models import LoggedMessage, reporter_cache
+from libs.lru import LRUCache, MISSING
 
 
 class App(rapidsms.app.App):
@@ -47,28 +131,297 @@ class App(rapidsms.app.App):
     Overrides the handle and outgoing methods
     '''
 
+    def configure(self, batch_size=0, batch_interval=1,
+                  reporter_cache_size=1000, reporter_cache_ttl=300,
+                  response_window=1000, writer_queue_size=0,
+                  writer_policy=writer.POLICY_BLOCK, spool_path='',
+                  spool_slow_ms=1000, spool_error_rate=0.5, spool_retry=30,
+                  live_port=0, live_secret='', rollup_interval=10,
+                  conversation_window=1800, instrument=1, stats_path='',
+                  **kwargs):
+        '''
+        Called by the router with the options from local.ini
+        '''
+        self.batch_size = int(batch_size)
+        self.batch_interval = float(batch_interval)
+        self.writer_queue_size = int(writer_queue_size)
+        self.writer_policy = writer_policy
+        self.spool_path = spool_path
+        self.live_port = int(live_port)
+        self.live_secret = live_secret
+        self.rollup_interval = float(rollup_interval)
+        self.conversation_window = float(conversation_window)
+        self.instrument = int(instrument)
+        self.stats_path = stats_path
+        self.spool_breaker = spool.CircuitBreaker(
+                                    error_rate=float(spool_error_rate),
+                                    slow_ms=float(spool_slow_ms),
+                                    retry_after=float(spool_retry))
+        reporter_cache.max_size = int(reporter_cache_size)
+        reporter_cache.ttl = float(reporter_cache_ttl)
+
+        # Ids of the incoming messages we logged most recently, with their
+        # date. Responses are almost always sent to one of these.
+        self.recent_incoming = LRUCache(max_size=int(response_window))
+
+
+    def start(self):
+        '''
+        Sets up the spool, the background writer or the write-behind
+        buffer, the live tail, the rollups, the conversations and the
+        instrumentation, if they are enabled.
+        '''
+        if getattr(self, 'instrument', 0):
+            instrument.current = instrument.Instruments()
+
+        if getattr(self, 'conversation_window', 0) > 0:
+            # As many phones as the reporter cache
+            conversation.current = conversation.Conversations(
+                                        self.conversation_window,
+                                        reporter_cache.max_size or 1000)
+
+        if getattr(self, 'rollup_interval', 0) > 0:
+            rollup.current = rollup.Rollup(error=self.error)
+            latency.current = latency.LatencyRecorder(error=self.error)
+            summary.current = summary.Summaries(error=self.error)
+            self._stats_stopping = threading.Event()
+            self._stats_thread = threading.Thread(target=self._flush_stats,
+                                                  name='logger_ng stats')
+            self._stats_thread.setDaemon(True)
+            self._stats_thread.start()
+
+        if getattr(self, 'live_port', 0):
+            live.current = live.Channel(self.live_port, self.live_secret)
+            live.current.start()
+
+        if getattr(self, 'spool_path', ''):
+            spool.current = spool.Spool(self.spool_path, self.spool_breaker,
+                                        error=self.error)
+
+        # The ids waiting in the journal must not be handed out again
+        floor = spool.current is not None and spool.current.highest_id() or 0
+        if getattr(self, 'writer_queue_size', 0) > 0:
+            allocator = batch.IdAllocator(self.batch_size or 100, floor)
+            batch.current = writer.BackgroundWriter(self.writer_queue_size,
+                                                    self.writer_policy,
+                                                    self.batch_size or 100,
+                                                    allocator,
+                                                    error=self.error)
+            batch.current.start()
+        elif getattr(self, 'batch_size', 0) > 0:
+            allocator = batch.IdAllocator(self.batch_size, floor)
+            batch.current = batch.MessageBuffer(self.batch_size,
+                                                self.batch_interval,
+                                                allocator, error=self.error)
+            batch.current.start()
+        elif spool.current is not None:
+            # Messages must be given their id before being spooled, which
+            # a buffer flushing every message does.
+            batch.current = batch.MessageBuffer(1, allocator=
+                                                batch.IdAllocator(1, floor),
+                                                error=self.error)
+
+        # Messages saved one at a time are also given their id before being
+        # saved when they are put in conversations, so that a message
+        # starting a conversation is saved with it.
+        self.allocator = None
+        if batch.current is None and conversation.current is not None:
+            self.allocator = batch.IdAllocator()
+
+
+    def stop(self):
+        '''
+        Writes any buffered messages and deferred tags before the router
+        shuts down.
+        '''
+        LoggedMessage.apply_deferred_tags()
+        if batch.current is not None:
+            batch.current.stop()
+        if getattr(self, '_stats_thread', None) is not None:
+            self._stats_stopping.set()
+            self._stats_thread.join()
+            self._stats_thread = None
+        self.flush_stats()
+        if batch.current is not None:
+            if isinstance(batch.current, writer.BackgroundWriter):
+                self.info("Writer queue: %(written)d written, "
+                          "%(dropped)d dropped, %(spilled)d spilled, "
+                          "max depth %(max_depth)d/%(max_size)d" %
+                          batch.current.stats())
+            batch.current = None
+        if spool.current is not None:
+            self.info("Spool: %(spooled)d spooled, %(replayed)d replayed, "
+                      "%(in_journal)d waiting in the journal" %
+                      spool.current.stats())
+            spool.current = None
+        instrument.current = None
+        rollup.current = latency.current = summary.current = None
+        conversation.current = None
+        if live.current is not None:
+            live.current.stop()
+            self.info("Live tail: %(published)d published, %(skipped)d "
+                      "skipped, %(dropped)d slow subscribers dropped, "
+                      "%(refused)d refused" % live.current.stats())
+            live.current = None
+        self.info("Reporter cache: %(hits)d hits, %(misses)d misses, "
+                  "%(evictions)d evictions, %(size)d/%(max_size)d entries" %
+                  reporter_cache.stats())
+
+
+    def store(self, msg):
+        '''
+        Saves the LoggedMessage, or hands it to the background writer or
+        write-behind buffer if one is enabled. Either way, msg.pk is set
+        when this returns, as well as its conversation. Then publishes it
+        to the live tail and counts it in the rollups and the summary of
+        its phone.
+        '''
+        instruments = instrument.current
+        if instruments is not None:
+            started = time.time()
+
+        conversations = conversation.current
+        if conversations is not None:
+            # So that a new conversation can have its id straight away
+            if batch.current is not None:
+                msg.id = batch.current.allocator.next_id()
+            else:
+                msg.id = self.allocator.next_id()
+            conversations.assign(msg)
+        if batch.current is not None:
+            batch.current.add(msg)
+        elif msg.pk is not None:
+            # The id is new, so Django needn't look for a row to update
+            msg.save(force_insert=True)
+        else:
+            msg.save()
+        if instruments is not None:
+            instruments.time('store', started)
+        if live.current is not None:
+            live.current.publish(msg)
+        if rollup.current is not None:
+            rollup.current.count(msg)
+        if summary.current is not None:
+            summary.current.count(msg)
+
+
+    def _flush_stats(self):
+        '''
+        Calls flush_stats every rollup_interval seconds, in a thread of its
+        own so that the router never waits for these writes.
+        '''
+        while not self._stats_stopping.isSet():
+            self._stats_stopping.wait(self.rollup_interval)
+            if not self._stats_stopping.isSet():
+                self.flush_stats()
+
+
+    def flush_stats(self):
+        '''
+        Writes the traffic rollups, response latencies and identity
+        summaries collected so far, and the instrumentation snapshot.
+        '''
+        if rollup.current is not None:
+            rollup.current.flush()
+        if latency.current is not None:
+            latency.current.flush()
+        if summary.current is not None:
+            summary.current.flush()
+        if instrument.current is not None and \
+           getattr(self, 'stats_path', ''):
+            writer_stats = spool_stats = live_stats = None
+            if isinstance(batch.current, writer.BackgroundWriter):
+                writer_stats = batch.current.stats()
+            if spool.current is not None:
+                spool_stats = spool.current.stats()
+            if live.current is not None:
+                live_stats = live.current.stats()
+            data = instrument.current.snapshot(
+                                    reporter_cache=reporter_cache.stats(),
+                                    writer=writer_stats, spool=spool_stats,
+                                    live=live_stats)
+            try:
+                instrument.write_snapshot(self.stats_path, data)
+            except (IOError, OSError), e:
+                self.error("Could not write the stats to %s: %s",
+                           self.stats_path, e)
+
+
+    def incoming_date(self, pk):
+        '''
+        Returns the date of the logged incoming message with this pk, None
+        if its date isn't known, or MISSING if pk isn't the id of a logged
+        incoming message. This doesn't hit the database if the message was
+        logged recently. The date is remembered in recent_incoming when
+        known.
+        '''
+        received = self.recent_incoming.get(pk)
+        if received is not MISSING:
+            return received
+        if batch.current is not None:
+            msg = batch.current.get(pk)
+            if msg is not None:
+                return msg.is_incoming() and msg.date or MISSING
+        if spool.current is not None and spool.current.direction(pk):
+            if spool.current.direction(pk) == \
+               LoggedMessage.DIRECTION_INCOMING:
+                return None
+            return MISSING
+        try:
+            dates = LoggedMessage.incoming.filter(pk=pk) \
+                                          .values_list('date', flat=True)
+            if not dates:
+                return MISSING
+            self.recent_incoming.set(pk, dates[0])
+            return dates[0]
+        except DatabaseError:
+            # Still log the response, just not linked, if the database is
+            # down.
+            transaction.rollback_unless_managed()
+            return MISSING
+
+
     def handle(self, message):
         '''
         This will be called when messages come in. We don't return return
         anything, so as far as rapidsms is concerned, we haven't handled it
         so it just keeps passing it along to the latter apps.
         '''
+        instruments = instrument.current
+        if instruments is not None:
+            started = time.time()
+
         msg = LoggedMessage.create_from_message(message)
         msg.direction = LoggedMessage.DIRECTION_INCOMING
-        msg.save()
+        self.store(msg)
+        self.recent_incoming.set(msg.pk, msg.date or datetime.now())
 
         # Watermark the message object with the LoggedMessage pk.
         message.logger_id = msg.pk
 
+        if instruments is not None:
+            instruments.time('handle', started)
+
         # Print message if debug
         self.debug(msg)
 
 
+    def cleanup(self, message):
+        '''
+        Called once every app has handled the incoming message. Writes the
+        tags that apps deferred with LoggedMessage.defer_tag.
+        '''
+        LoggedMessage.apply_deferred_tags()
+
+
     def outgoing(self, message):
         '''
         This will be called when messages go out.
         '''
-        
+        instruments = instrument.current
+        if instruments is not None:
+            started = time.time()
+
         msg = LoggedMessage.create_from_message(message)
         msg.direction = LoggedMessage.DIRECTION_OUTGOING
 
@@ -78,22 +431,33 @@ class App(rapidsms.app.App):
         # it allows us to match an outgoing message to the incoming message
         # that solicited it (assuming Message.respond) was used.
         if hasattr(message, 'logger_id'):
-            try:
-                orig_msg = LoggedMessage.incoming.get(pk=message.logger_id)
-            except LoggedMessage.DoesNotExist:
-                # Really no reason for this to ever happen, but if it does
-                # we'll just silently continue, but we won't be able
-                # to set the response_to field of this LoggedMessage
-                pass
-            else:
-                # Set the response_to foreign key of this logged outgoing
-                # message to the incoming message that it was copied from.
-                msg.response_to = orig_msg
+            if instruments is not None:
+                matching = time.time()
+            # Set the response_to foreign key of this logged outgoing
+            # message to the incoming message that it was copied from.
+            # We only need the id for that, not the incoming message itself.
+            #
+            # There is really no reason for the incoming message not to
+            # exist, but if it doesn't we'll just silently continue, and
+            # won't set the response_to field of this LoggedMessage.
+            received = self.incoming_date(message.logger_id)
+            if received is not MISSING:
+                msg.response_to_id = message.logger_id
+                if latency.current is not None and \
+                   isinstance(received, datetime):
+                    latency.current.record(msg.backend, received)
+            if instruments is not None:
+                instruments.time('response_matching', matching)
+                instruments.count(msg.response_to_id and 'responses_matched'
+                                  or 'responses_unmatched')
 
-        msg.save()
+        self.store(msg)
 
         # Watermark the message object with the LoggedMessage pk.
         message.logger_id = msg.pk
 
+        if instruments is not None:
+            instruments.time('outgoing', started)
+
         # Print message if debug
         self.debug(msg)
@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Write-behind buffering of LoggedMessage objects.
+
+By default, App.handle and App.outgoing save each LoggedMessage as soon as
+it is created, which costs one INSERT (and one commit) per message. When
+batching is turned on in local.ini, they hand the LoggedMessage to a
+MessageBuffer instead. The buffer gives it a primary key straight away, from
+a block of ids reserved in advance, so the logger_id watermark can still be
+set on the rapidsms Message. The rows are then written all at once with a
+bulk insert, when batch_size messages are waiting or every batch_interval
+seconds, whichever comes first. Messages get their date when they are
+added, so it is the time they were logged, not the time they were written.
+
+While a message is waiting in the buffer, tag_message and response_to
+linking use the object in memory instead of the database.
+
+If writing a batch fails MAX_RETRIES times in a row, its messages are
+written one at a time instead, and those that still fail are dropped and
+logged, so that one bad row doesn't hold up every message after it, and
+the buffer doesn't grow while the database is down (spool the messages to
+keep them, see spool.py).
+'''
+
+import time
+import threading
+from collections import deque
+from datetime import datetime
+
+from django.db import connection, transaction, DatabaseError
+
+from logger_ng.db import backend_vendor, bulk_insert
+from logger_ng.models import LoggedMessage
+
+
+# The MessageBuffer in use by the logger_ng app, if batching is enabled, or
+# the writer.BackgroundWriter, which works the same way.
+current = None
+
+# Number of times in a row writing a batch may fail before its messages are
+# written one by one, and dropped if they still can't be.
+MAX_RETRIES = 3
+
+
+class IdAllocator(object):
+    '''
+    Hands out LoggedMessage primary keys from blocks reserved in advance.
+
+    On PostgreSQL, blocks are taken from the table's own sequence, so they
+    never clash with rows that are saved the usual way. Other backends have
+    no sequence we can reserve from, so a block simply starts after the
+    highest id in the table (or after the previous block). This is safe as
+    long as the router is the only process writing to the log while
+    batching is enabled, which is the case in a normal deployment since
+    responses from the web interface go through the router too.
+
+    Ids are always above `floor`, the highest id waiting in the spool
+    journal (see spool.py), which the table doesn't know of yet. If the
+    database can't be reached to reserve a block, ids simply follow the
+    last one given, or the floor, or if there is neither, start from the
+    current Unix time, far above the ids of any real log. That way messages
+    can still be spooled, and the sequence is moved past them by catch_up()
+    once the database is back.
+    '''
+
+    def __init__(self, block_size=100, floor=0):
+        self.block_size = block_size
+        self._ids = deque()
+        self._highest = floor
+        # True when ids were handed out that the sequence may be behind of
+        self.behind = False
+        self._lock = threading.Lock()
+
+
+    def next_id(self):
+        '''
+        Returns the next free id, reserving a new block if needed.
+        '''
+        self._lock.acquire()
+        try:
+            if not self._ids:
+                try:
+                    ids = self._reserve(self.block_size)
+                except Exception:
+                    transaction.rollback_unless_managed()
+                    start = self._highest or int(time.time())
+                    ids = range(start + 1, start + 1 + self.block_size)
+                    self.behind = True
+                self._ids.extend(ids)
+                self._highest = max(self._highest, ids[-1])
+            return self._ids.popleft()
+        finally:
+            self._lock.release()
+
+
+    def catch_up(self):
+        '''
+        On PostgreSQL, moves the sequence past every id handed out, so that
+        rows saved the usual way (or by import_from_logger) can't take the
+        ids still waiting to be written. Called once the database is back,
+        if ids were handed out while it was down.
+        '''
+        self._lock.acquire()
+        try:
+            if backend_vendor() == 'postgresql':
+                try:
+                    self._advance_sequence(connection.cursor())
+                    transaction.commit_unless_managed()
+                except DatabaseError:
+                    transaction.rollback_unless_managed()
+                    return
+            self.behind = False
+        finally:
+            self._lock.release()
+
+
+    def _reserve(self, count):
+        opts = LoggedMessage._meta
+        cursor = connection.cursor()
+
+        if backend_vendor() == 'postgresql':
+            sql = "SELECT nextval(pg_get_serial_sequence(%s, %s)) " \
+                  "FROM generate_series(1, %s)"
+            params = [opts.db_table, opts.pk.column, count]
+            cursor.execute(sql, params)
+            ids = [row[0] for row in cursor.fetchall()]
+            if ids[0] <= self._highest:
+                # The sequence is behind the ids of the journal, or those
+                # handed out while the database was down.
+                self._advance_sequence(cursor)
+                cursor.execute(sql, params)
+                ids = [row[0] for row in cursor.fetchall()]
+            self.behind = False
+            return ids
+
+        qn = connection.ops.quote_name
+        cursor.execute("SELECT MAX(%s) FROM %s" % (qn(opts.pk.column),
+                                                   qn(opts.db_table)))
+        start = max(cursor.fetchone()[0] or 0, self._highest) + 1
+        return range(start, start + count)
+
+
+    def _advance_sequence(self, cursor):
+        '''
+        Moves the PostgreSQL sequence to the highest id handed out, unless
+        it is already past it.
+        '''
+        opts = LoggedMessage._meta
+        cursor.execute("SELECT setval(seq, GREATEST(%s, nextval(seq))) "
+                       "FROM (SELECT pg_get_serial_sequence(%s, %s) AS seq) "
+                       "AS sequence",
+                       [self._highest, opts.db_table, opts.pk.column])
+
+
+class MessageBuffer(object):
+    '''
+    Collects LoggedMessage objects in memory and writes them in bulk.
+
+    All the public methods are thread safe: messages are added from the
+    router thread, while the time based flushes happen in a thread started
+    by start().
+    '''
+
+    def __init__(self, batch_size=100, batch_interval=1.0, allocator=None,
+                 error=None):
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.allocator = allocator or IdAllocator(max(batch_size, 1))
+        self.error = error
+        self.last_flush = time.time()
+        # Failed flushes in a row, and messages dropped after MAX_RETRIES
+        self.failures = 0
+        self.dropped = 0
+
+        self._pending = []
+        self._by_id = {}
+        # Re-entrant, because add() may trigger a flush itself.
+        self._lock = threading.RLock()
+        self._thread = None
+        self._stopping = threading.Event()
+
+
+    def add(self, msg):
+        '''
+        Gives the LoggedMessage its primary key and date, and queues it for
+        writing. Flushes the buffer if it is full or hasn't been flushed in
+        a while.
+        '''
+        if msg.pk is None:
+            msg.id = self.allocator.next_id()
+        if msg.date is None:
+            msg.date = datetime.now()
+
+        self._lock.acquire()
+        try:
+            self._pending.append(msg)
+            self._by_id[msg.pk] = msg
+            if len(self._pending) >= self.batch_size or \
+               time.time() - self.last_flush >= self.batch_interval:
+                self.flush()
+        finally:
+            self._lock.release()
+
+
+    def get(self, pk):
+        '''
+        Returns the LoggedMessage with this primary key if it is still
+        waiting to be written, else None.
+        '''
+        return self._by_id.get(pk)
+
+
+    def tag(self, pk, status):
+        '''
+        Sets the status of a LoggedMessage that is still waiting to be
+        written. Returns False if it isn't in the buffer (anymore).
+
+        This waits for a flush in progress, so that a message being written
+        is either tagged here or found in the database afterwards.
+        '''
+        self._lock.acquire()
+        try:
+            msg = self._by_id.get(pk)
+            if msg is None:
+                return False
+            msg.status = status
+            return True
+        finally:
+            self._lock.release()
+
+
+    def flush(self):
+        '''
+        Writes everything in the buffer with one bulk insert and returns the
+        number of rows written. If the insert fails the messages are kept
+        for the next flush, unless it is the MAX_RETRIES-th failure in a
+        row: then they are written one by one, dropping those that fail.
+        '''
+        self._lock.acquire()
+        try:
+            self.last_flush = time.time()
+            msgs = self._pending
+            if not msgs:
+                return 0
+            try:
+                write_messages(msgs)
+            except Exception, e:
+                self.failures += 1
+                if self.error:
+                    self.error("Could not write %d buffered messages: %s",
+                               len(msgs), e)
+                if self.failures < MAX_RETRIES:
+                    return 0
+                dropped = len(write_each(msgs, self.error))
+                self.dropped += dropped
+            else:
+                dropped = 0
+                if self.allocator.behind:
+                    self.allocator.catch_up()
+            self.failures = 0
+            self._pending = []
+            self._by_id = {}
+            return len(msgs) - dropped
+        finally:
+            self._lock.release()
+
+
+    def start(self):
+        '''
+        Starts a daemon thread that flushes the buffer every batch_interval
+        seconds, so that messages don't wait indefinitely during quiet
+        periods.
+        '''
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run,
+                                        name='logger_ng flusher')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+
+    def stop(self):
+        '''
+        Stops the flushing thread and writes whatever is left.
+        '''
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+    def _run(self):
+        while not self._stopping.isSet():
+            self._stopping.wait(self.batch_interval)
+            if time.time() - self.last_flush >= self.batch_interval:
+                self.flush()
+
+
+def write_messages(msgs):
+    '''
+    Writes LoggedMessages with one bulk insert, through the spool if there
+    is one.
+    '''
+    from logger_ng import spool
+    if spool.current is not None:
+        spool.current.write(msgs)
+    else:
+        bulk_insert(msgs)
+
+
+def write_each(msgs, error=None):
+    '''
+    Writes the messages of a batch that kept failing one at a time, so that
+    a bad row only loses itself. Those that still can't be written are
+    dropped and reported with error. Returns the dropped messages.
+    '''
+    dropped = []
+    for msg in msgs:
+        try:
+            write_messages([msg])
+        except Exception, e:
+            dropped.append(msg)
+            if error:
+                error("Dropped message %s from %s %s (%r): %s", msg.pk,
+                      msg.backend, msg.identity, msg.text, e)
+    return dropped
+
+
+def tag_pending(pk, status):
+    '''
+    Tags a message that hasn't reached the database yet, because it is
+    waiting in the current buffer (or writer queue) or in the spool journal.
+    Returns False if the tag should be written to the database as usual.
+    '''
+    from logger_ng import spool
+    if current is not None and current.tag(pk, status):
+        return True
+    if spool.current is not None and spool.current.tag(pk, status):
+        return True
+    return False
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Helpers for the logger_ng benchmarks (./rapidsms benchmark_logger_ingest
+and benchmark_logger_views): timing stages, and reporting the results as a
+table or as JSON, so that they can be compared between releases. Also the
+progress report of the commands that write many messages (seed_logger and
+import_from_logger).
+'''
+
+import sys
+import time
+import platform
+from datetime import datetime, timedelta
+
+import django
+from django.utils import simplejson
+from django.utils.translation import ugettext as _
+
+from logger_ng.db import backend_vendor
+
+
+def percentile(values, fraction):
+    '''
+    Returns the value below which `fraction` of the sorted values are.
+    '''
+    if not values:
+        return 0.0
+    return values[min(int(round(fraction * (len(values) - 1))),
+                      len(values) - 1)]
+
+
+class Stage(object):
+    '''
+    Collects the durations of the calls of one stage of a benchmark:
+        stage = Stage('save')
+        for msg in msgs:
+            stage.start()
+            msg.save()
+            stage.stop()
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.durations = []
+        # Number of queries of each call, for the stages that count them
+        self.queries = []
+        self._started = None
+
+
+    def start(self):
+        self._started = time.time()
+
+
+    def stop(self):
+        self.durations.append(time.time() - self._started)
+
+
+    def time(self, function, *args, **kwargs):
+        '''
+        Calls function, timing it, and returns what it returns.
+        '''
+        self.start()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.stop()
+
+
+    def result(self):
+        '''
+        Returns the count, total seconds, calls per second, the p50, p99
+        and max durations in milliseconds, and the most queries made by a
+        call if they were counted.
+        '''
+        durations = sorted(self.durations)
+        count, total = len(durations), sum(durations)
+        result = {'count': count,
+                  'seconds': round(total, 6),
+                  'per_second': total and round(count / total, 1) or 0,
+                  'p50_ms': round(percentile(durations, 0.5) * 1000, 3),
+                  'p99_ms': round(percentile(durations, 0.99) * 1000, 3),
+                  'max_ms': round((durations and durations[-1] or 0) * 1000,
+                                  3)}
+        if self.queries:
+            result['queries'] = max(self.queries)
+        return result
+
+
+def results(name, stages, options=None, **extra):
+    '''
+    Returns the results of a benchmark as a dict, ready for JSON.
+    '''
+    data = {'benchmark': name,
+            'date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'database': backend_vendor(),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'options': options or {},
+            'stages': [dict(stage.result(), name=stage.name)
+                       for stage in stages]}
+    data.update(extra)
+    return data
+
+
+def print_table(data, output=sys.stdout):
+    '''
+    Prints the stages of benchmark results as a table.
+    '''
+    output.write("%(benchmark)s on %(database)s, %(date)s\n" % data)
+    output.write("%-28s %8s %10s %10s %10s %10s %8s\n" %
+                 ('stage', 'count', 'per sec', 'p50 ms', 'p99 ms', 'max ms',
+                  'queries'))
+    for stage in data['stages']:
+        output.write("%(name)-28s %(count)8d %(per_second)10.1f "
+                     "%(p50_ms)10.3f %(p99_ms)10.3f %(max_ms)10.3f " % stage +
+                     "%8s\n" % stage.get('queries', '-'))
+
+
+def write_json(data, path):
+    '''
+    Writes benchmark results as JSON to a file, or to stdout if path is '-'.
+    '''
+    if path == '-':
+        output = sys.stdout
+    else:
+        output = open(path, 'w')
+    try:
+        simplejson.dump(data, output, indent=2, sort_keys=True)
+        output.write('\n')
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+
+class Progress(object):
+    '''
+    Prints how many of the `total` rows have been written, how fast, and
+    the time left, at most once a second. Used by import_from_logger and
+    seed_logger.
+    '''
+
+    def __init__(self, label, total):
+        self.label = label
+        self.total = total
+        self.done = 0
+        self.started = time.time()
+        self._printed = 0
+
+
+    def add(self, count):
+        self.done += count
+        now = time.time()
+        if now - self._printed < 1 and self.done < self.total:
+            return
+        self._printed = now
+        rate = self.done / max(now - self.started, 0.001)
+        if rate:
+            eta = unicode(timedelta(seconds=int((self.total - self.done) /
+                                                rate)))
+        else:
+            eta = u"?"
+        sys.stdout.write(_(u"\r%(label)s: %(done)d/%(total)d, " \
+                           u"%(rate)d rows/s, %(eta)s left  ") %
+                         {'label': self.label, 'done': self.done,
+                          'total': self.total, 'rate': rate, 'eta': eta})
+        sys.stdout.flush()
+
+
+    def finish(self):
+        if self.done:
+            sys.stdout.write('\n')
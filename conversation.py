@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Conversations: the messages exchanged with a phone (a backend and an
+identity) without a pause longer than conversation_window seconds, in
+either direction.
+
+Every message the router logs gets the id of the first message of its
+conversation in LoggedMessage.conversation, so that a whole conversation
+loads with one query on the (conversation, date, id) index. Messages are
+given their id before they are saved (see batch.IdAllocator), even when
+they aren't batched, so the conversation is part of the INSERT. The date and
+conversation of the last message of each phone are kept in an LRU cache,
+so this normally costs nothing; a phone that isn't in the cache costs one
+query on the (backend, identity, date) index.
+
+Conversations of messages logged before, or imported, are assigned with:
+    ./rapidsms backfill_logger_conversations
+'''
+
+from datetime import datetime, timedelta
+
+from django.db import transaction, DatabaseError
+
+from logger_ng.models import LoggedMessage
+from logger_ng.libs.lru import LRUCache, MISSING
+
+
+# The Conversations of the logger_ng app, if enabled.
+current = None
+
+
+class Conversations(object):
+    '''
+    Assigns logged messages to conversations.
+    '''
+
+    def __init__(self, window=1800, cache_size=1000):
+        self.window = timedelta(seconds=window)
+        # (backend, identity) => (date, conversation) of the last message
+        self._last = LRUCache(max_size=cache_size)
+
+
+    def assign(self, msg):
+        '''
+        Sets the conversation of a LoggedMessage about to be stored, which
+        must already have its primary key (see batch.IdAllocator), so that
+        a message starting a conversation is saved with it.
+        '''
+        date = msg.date or datetime.now()
+        key = (msg.backend, msg.identity)
+        last = self._last.get(key)
+        if last is MISSING:
+            last = self._load(key)
+
+        if last is not None and last[1] is not None and \
+           date - last[0] <= self.window:
+            msg.conversation = last[1]
+        else:
+            msg.conversation = msg.pk
+        self._last.set(key, (date, msg.conversation))
+
+
+    def _load(self, key):
+        backend, identity = key
+        try:
+            last = list(LoggedMessage.objects
+                            .filter(backend=backend, identity=identity)
+                            .order_by('-date', '-id')
+                            .values_list('date', 'conversation')[:1])
+        except DatabaseError:
+            transaction.rollback_unless_managed()
+            return None
+        return last and last[0] or None
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Low level database helpers for logger_ng.
+
+The Django ORM writes one row per query. These helpers are used in the few
+places where logger_ng needs to write many LoggedMessage rows at once.
+'''
+
+from datetime import datetime
+
+from django.db import connection, transaction
+
+
+def backend_vendor():
+    '''
+    Returns 'postgresql', 'mysql', 'sqlite' or 'other' depending on the
+    database backend Django is connected to.
+    '''
+    module = connection.__class__.__module__
+    for vendor in ('postgresql', 'mysql', 'sqlite'):
+        if vendor in module:
+            return vendor
+    return 'other'
+
+
+def bulk_insert(objs):
+    '''
+    Inserts a list of model instances (all of the same model) with a single
+    executemany, and commits unless a transaction is being managed by the
+    caller.
+
+    Either all the instances have their primary key set, or none of them
+    has, in which case the database gives them their ids. We can't read
+    those back, so the instances are left without a primary key.
+    auto_now_add fields are only filled in when they are empty, so unlike
+    save(), an existing date is written as is. auto_now fields are set to
+    the current time.
+    '''
+    if not objs:
+        return 0
+
+    opts = objs[0]._meta
+    fields = opts.local_fields
+    if objs[0].pk is None:
+        fields = [field for field in fields if field is not opts.pk]
+    qn = connection.ops.quote_name
+
+    now = datetime.now()
+    rows = []
+    for obj in objs:
+        row = []
+        for field in fields:
+            value = getattr(obj, field.attname)
+            if getattr(field, 'auto_now', False) or \
+               (value is None and getattr(field, 'auto_now_add', False)):
+                value = now
+                setattr(obj, field.attname, value)
+            row.append(value)
+        rows.append(row)
+
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % \
+          (qn(opts.db_table),
+           ', '.join([qn(field.column) for field in fields]),
+           ', '.join(['%s'] * len(fields)))
+
+    cursor = connection.cursor()
+    try:
+        cursor.executemany(sql, rows)
+    except:
+        transaction.rollback_unless_managed()
+        raise
+    transaction.commit_unless_managed()
+    return len(rows)
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Exporting the message log as CSV or JSON Lines.
+
+Used by views.export and ./rapidsms export_logger. The messages are read
+CHUNK_SIZE at a time, oldest first, each chunk starting after the (date, id)
+of the last message of the previous one (like pagination.KeysetPaginator),
+and the output is produced as it is read. Exporting the whole log therefore
+takes the same, small amount of memory whatever its size, and the first
+bytes go out straight away.
+
+Unlike the log view, responses are exported as rows of their own, with the
+id of the message they respond to.
+'''
+
+import csv
+from datetime import datetime
+
+from django.db.models import Q
+from django.utils import simplejson
+
+from logger_ng.models import LoggedMessage
+from logger_ng.search import filter_messages
+
+
+FORMATS = ('csv', 'jsonl')
+
+# Number of messages read per query
+CHUNK_SIZE = 2000
+
+# Output is produced in pieces of about that many bytes
+BUFFER_SIZE = 64 * 1024
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+FIELDS = ['id', 'date', 'direction', 'backend', 'identity',
+          'reporter__first_name', 'reporter__last_name', 'status',
+          'response_to', 'text']
+
+COLUMNS = ['id', 'date', 'direction', 'backend', 'identity', 'reporter',
+           'status', 'response_to', 'text']
+
+
+def parse_date(value):
+    '''
+    Returns the datetime for a YYYY-MM-DD string, or None if it is empty.
+    Raises ValueError if it isn't a date.
+    '''
+    if not value:
+        return None
+    return datetime.strptime(value, '%Y-%m-%d')
+
+
+def export_queryset(search='', since=None, until=None):
+    '''
+    Returns the messages matching the search string, as in the log view,
+    logged from the datetime `since` and before `until`.
+    '''
+    msgs = filter_messages(LoggedMessage.objects.all(), search)
+    if since is not None:
+        msgs = msgs.filter(date__gte=since)
+    if until is not None:
+        msgs = msgs.filter(date__lt=until)
+    return msgs
+
+
+def iter_rows(msgs, chunk_size=CHUNK_SIZE):
+    '''
+    Yields a tuple of the FIELDS of each message of the queryset, oldest
+    first, reading them chunk_size at a time.
+    '''
+    msgs = msgs.order_by('date', 'id').values_list(*FIELDS)
+    last = None
+    while True:
+        chunk = msgs
+        if last is not None:
+            pk, date = last
+            # The date__gte is redundant, but lets the database use the
+            # index on date to find where to start.
+            chunk = chunk.filter(date__gte=date) \
+                         .filter(Q(date__gt=date) | Q(date=date, pk__gt=pk))
+        rows = list(chunk[:chunk_size])
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last = rows[-1][:2]
+
+
+def to_record(row):
+    '''
+    Returns the values of the COLUMNS for a row from iter_rows.
+    '''
+    pk, date, direction, backend, identity, first_name, last_name, status, \
+        response_to, text = row
+    reporter = u' '.join([name for name in (first_name, last_name) if name])
+    return [pk, date.strftime(DATE_FORMAT), direction, backend, identity,
+            reporter, status or u'', response_to, text]
+
+
+class _Output(object):
+    '''
+    A file-like object for csv.writer, keeping what is written until it is
+    taken.
+    '''
+
+    def __init__(self):
+        self.pieces = []
+        self.size = 0
+
+
+    def write(self, data):
+        self.pieces.append(data)
+        self.size += len(data)
+
+
+    def take(self):
+        data = ''.join(self.pieces)
+        self.pieces = []
+        self.size = 0
+        return data
+
+
+def export_messages(msgs, format='csv'):
+    '''
+    Yields the export of a LoggedMessage queryset as UTF-8 encoded
+    strings, in one of the FORMATS.
+    '''
+    if format not in FORMATS:
+        raise ValueError("Unknown export format %r, must be one of: %s" %
+                         (format, ', '.join(FORMATS)))
+
+    output = _Output()
+    if format == 'csv':
+        writer = csv.writer(output)
+        writer.writerow(COLUMNS)
+
+    for row in iter_rows(msgs):
+        record = to_record(row)
+        if format == 'csv':
+            writer.writerow([isinstance(value, unicode) and \
+                             value.encode('utf-8') or value
+                             for value in record])
+        else:
+            output.write(simplejson.dumps(dict(zip(COLUMNS, record))) + '\n')
+        if output.size >= BUFFER_SIZE:
+            yield output.take()
+
+    if output.size:
+        yield output.take()
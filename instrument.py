@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Instrumentation of the router's message path, to tell whether logger_ng is
+what slows the router down.
+
+The time spent in each stage of logging a message (looking up its reporter,
+building the row, storing it, matching a response to the message it
+answers, tagging) is counted in the buckets of a histogram per stage, and
+events are counted, in memory. Timing a stage costs two time.time() calls,
+a bisect and an increment, well under a microsecond, so a message costs
+about two or three microseconds. Only the bucket counts are kept, the mean
+and max are estimated from them when a snapshot is taken. Nothing is
+locked, so an increment may be lost now and then when two threads time the
+same stage, which is fine for monitoring.
+
+Every rollup_interval seconds and when it stops, the router writes a
+snapshot of these, and of the reporter cache, writer and spool statistics,
+as JSON to the stats_path file of local.ini. Read it with:
+    ./rapidsms logger_stats
+or at /logger_ng/instrumentation.json when LOGGER_NG_STATS_PATH is set to
+the same file in the Django settings.
+
+Instrumentation is on by default, and turned off with instrument = 0 in
+local.ini, in which case current stays None and nothing is timed.
+'''
+
+import os
+import time
+from bisect import bisect_left
+
+from django.utils import simplejson
+
+from logger_ng.libs.histogram import Histogram, geometric_bounds
+
+
+# The Instruments of the logger_ng app, if instrumentation is enabled.
+current = None
+
+# Microseconds, from 1us to 10s, with a relative error of less than 20%
+BOUNDS = geometric_bounds(1, 10000000, 1.2)
+
+STAGES = ('handle', 'outgoing', 'reporter_lookup', 'build', 'store',
+          'response_matching', 'tag')
+
+
+class Instruments(object):
+    '''
+    Stage timers and counters, kept in memory.
+
+        started = time.time()
+        ...
+        instruments.time('store', started)
+        instruments.count('responses_matched')
+    '''
+
+    def __init__(self):
+        self.started = time.time()
+        # stage => counts of the buckets of a Histogram(BOUNDS)
+        self.timers = dict([(stage, [0] * (len(BOUNDS) + 1))
+                            for stage in STAGES])
+        self.counters = {}
+
+
+    def time(self, stage, started):
+        '''
+        Records the time since `started`, a time.time(), for a stage.
+        '''
+        self.timers[stage][bisect_left(BOUNDS,
+                                       (time.time() - started) * 1000000)] += 1
+
+
+    def histogram(self, stage):
+        '''
+        Returns the Histogram of a stage, each time counted as the upper
+        bound of its bucket.
+        '''
+        histogram = Histogram(BOUNDS)
+        histogram.counts = list(self.timers[stage])
+        for i, count in enumerate(histogram.counts):
+            if count:
+                bound = BOUNDS[min(i, len(BOUNDS) - 1)]
+                histogram.count += count
+                histogram.total += count * bound
+                histogram.max = bound
+        return histogram
+
+
+    def count(self, counter, count=1):
+        self.counters[counter] = self.counters.get(counter, 0) + count
+
+
+    def snapshot(self, **extra):
+        '''
+        Returns the timers and counters as a dict, with the extra
+        statistics given.
+        '''
+        timers = {}
+        for stage in STAGES:
+            histogram = self.histogram(stage)
+            if histogram.count:
+                timers[stage] = histogram.stats()
+        data = {'written': time.time(), 'started': self.started,
+                'timers_us': timers, 'counters': dict(self.counters)}
+        data.update(extra)
+        return data
+
+
+def write_snapshot(path, data):
+    '''
+    Replaces the snapshot file with data, atomically, so that readers never
+    see half of it.
+    '''
+    f = open(path + '.tmp', 'w')
+    try:
+        simplejson.dump(data, f)
+    finally:
+        f.close()
+    os.rename(path + '.tmp', path)
+
+
+def read_snapshot(path):
+    '''
+    Returns the snapshot written by the router, or None if there is none.
+    '''
+    if not os.path.exists(path):
+        return None
+    f = open(path)
+    try:
+        return simplejson.load(f)
+    finally:
+        f.close()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Response latency: how long reporters wait for a response.
+
+When App.outgoing links a response to the incoming message it answers, it
+adds the time between the two to a Histogram for the backend and the hour,
+kept in memory. Every rollup_interval seconds the histograms are merged
+into the ResponseLatency table, one row per backend and hour. Percentiles
+over any period are then computed by merging a few of these rows, without
+looking at the messages at all.
+
+See them at /logger_ng/latency or with ./rapidsms logger_latency
+'''
+
+import threading
+from datetime import datetime
+
+from django.db import transaction, DatabaseError
+from django.utils import simplejson
+
+from logger_ng.models import ResponseLatency
+from logger_ng.libs.histogram import Histogram, geometric_bounds
+
+
+# The LatencyRecorder of the logger_ng app, if enabled.
+current = None
+
+# Seconds, from 0.1s to a week, with a relative error of less than 20%
+BOUNDS = geometric_bounds(0.1, 7 * 24 * 3600, 1.2)
+
+
+def to_json(histogram):
+    data = histogram.to_dict()
+    del data['bounds']
+    return simplejson.dumps(data)
+
+
+def from_json(text):
+    data = simplejson.loads(text)
+    data['bounds'] = BOUNDS
+    return Histogram.from_dict(data)
+
+
+class LatencyRecorder(object):
+    '''
+    Collects response latencies in memory, per backend and hour, and merges
+    them into the ResponseLatency table when flushed.
+    '''
+
+    def __init__(self, error=None):
+        self.error = error
+        # (backend, hour) => Histogram
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+
+    def record(self, backend, received, responded=None):
+        '''
+        Records the latency of a response sent at `responded` (now by
+        default) to a message received at `received`.
+        '''
+        responded = responded or datetime.now()
+        delta = responded - received
+        seconds = delta.days * 86400 + delta.seconds + \
+                  delta.microseconds / 1000000.0
+        hour = responded.replace(minute=0, second=0, microsecond=0)
+        self._lock.acquire()
+        try:
+            histogram = self._histograms.get((backend, hour))
+            if histogram is None:
+                histogram = self._histograms[(backend, hour)] = \
+                                                        Histogram(BOUNDS)
+            histogram.add(max(seconds, 0))
+        finally:
+            self._lock.release()
+
+
+    def flush(self):
+        '''
+        Merges the histograms into the table. If that fails, they are kept
+        for the next flush.
+        '''
+        self._lock.acquire()
+        try:
+            histograms, self._histograms = self._histograms, {}
+        finally:
+            self._lock.release()
+        if not histograms:
+            return
+
+        try:
+            merge_histograms(histograms)
+        except DatabaseError, e:
+            self._lock.acquire()
+            try:
+                for key, histogram in histograms.iteritems():
+                    if key in self._histograms:
+                        histogram.merge(self._histograms[key])
+                    self._histograms[key] = histogram
+            finally:
+                self._lock.release()
+            if self.error:
+                self.error("Could not update the response latencies: %s", e)
+
+
+@transaction.commit_on_success
+def merge_histograms(histograms):
+    '''
+    Merges a dict of (backend, hour) => Histogram into the ResponseLatency
+    rows.
+    '''
+    for (backend, hour), histogram in histograms.iteritems():
+        try:
+            row = ResponseLatency.objects.get(backend=backend, hour=hour)
+        except ResponseLatency.DoesNotExist:
+            row = ResponseLatency(backend=backend, hour=hour)
+        else:
+            histogram.merge(from_json(row.histogram))
+        row.histogram = to_json(histogram)
+        row.save()
+
+
+def load(since=None, until=None, backend=None):
+    '''
+    Returns the ResponseLatency rows from the datetime `since` and before
+    `until`, as a list of (backend, hour, Histogram) tuples ordered by hour.
+    '''
+    rows = ResponseLatency.objects.order_by('hour', 'backend')
+    if since is not None:
+        rows = rows.filter(hour__gte=since)
+    if until is not None:
+        rows = rows.filter(hour__lt=until)
+    if backend:
+        rows = rows.filter(backend=backend)
+    return [(row.backend, row.hour, from_json(row.histogram))
+            for row in rows]
+
+
+def summarize(rows, by='total'):
+    '''
+    Merges the rows returned by load() per backend and 'hour', 'day' or
+    'total'. Returns a list of (backend, start or None, Histogram) tuples,
+    ordered by start then backend.
+    '''
+    merged = {}
+    for backend, hour, histogram in rows:
+        if by == 'hour':
+            start = hour
+        elif by == 'day':
+            start = hour.replace(hour=0)
+        else:
+            start = None
+        key = (start, backend)
+        if key not in merged:
+            merged[key] = Histogram(BOUNDS)
+        merged[key].merge(histogram)
+    return [(backend, start, merged[(start, backend)])
+            for start, backend in sorted(merged.keys())]
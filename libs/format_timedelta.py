@@ -6,10 +6,11 @@ import datetime
 def humanize_timedelta(previous_date,
                        max_days=3,
                        datetime_format='%m/%d/%Y',
-                       suffix=' ago'):
+                       suffix=' ago',
+                       now=None):
     """
     Returns a humanized string representing a fuzzy time difference
-    between the current date and the passed date.
+    between the current date (or now, if given) and the passed date.
 
     >>> yesterday = datetime.datetime.now() - datetime.timedelta(1)
     >>> humanize_timedelta(yesterday)
@@ -39,8 +40,11 @@ def humanize_timedelta(previous_date,
     u'3 seconds ago'
     >>> humanize_timedelta(three_secs, suffix=" before the end of the word")
     u'3 seconds before the end of the word'
+    >>> humanize_timedelta(three_secs,
+    ... now=three_secs + datetime.timedelta(minutes=2))
+    u'2 minutes ago'
     """
-    today = datetime.datetime.now()
+    today = now or datetime.datetime.now()
     delta = today - previous_date
     time_values = (
         (u"day", delta.days),
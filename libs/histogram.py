@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+from bisect import bisect_left
+
+
+def geometric_bounds(low=0.1, high=1000000, ratio=1.2):
+    """
+    Returns bucket upper bounds growing by ratio from low to high, so that
+    every bucket is about the same relative width.
+    """
+    bounds = []
+    bound = low
+    while bound < high:
+        bounds.append(round(bound, 3))
+        bound *= ratio
+    bounds.append(high)
+    return bounds
+
+# Good for latencies in milliseconds, from 0.1ms to about 16 minutes, with
+# a relative error of less than 20%
+DEFAULT_BOUNDS = geometric_bounds()
+
+
+class Histogram(object):
+    """
+    Fixed bucket histogram. Adding a value is a bisect and an increment, and
+    the memory used doesn't depend on the number of values, so it is cheap
+    enough to keep on the message path. Percentiles are the upper bound of
+    the bucket they fall in.
+
+    >>> h = Histogram([1, 2, 5, 10])
+    >>> for value in (0.5, 1.5, 1.5, 3, 7, 20):
+    ...     h.add(value)
+    >>> h.count, h.max
+    (6, 20)
+    >>> h.percentile(50), h.percentile(80), h.percentile(100)
+    (2, 10, 20)
+    >>> h2 = Histogram.from_dict(h.to_dict())
+    >>> h2.merge(h)
+    >>> h2.count, h2.percentile(50)
+    (12, 2)
+    """
+
+    def __init__(self, bounds=None):
+        self.bounds = bounds or DEFAULT_BOUNDS
+        # The last bucket is for values above the highest bound.
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+
+    def add(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+
+    def merge(self, other):
+        """
+        Adds the values of another histogram with the same bounds.
+        """
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+
+    def percentile(self, percent):
+        """
+        Returns the value below which percent % of the values fall.
+        """
+        if not self.count:
+            return 0
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= rank:
+                if i < len(self.bounds):
+                    return min(self.bounds[i], self.max)
+                break
+        return self.max
+
+
+    def mean(self):
+        if not self.count:
+            return 0
+        return float(self.total) / self.count
+
+
+    def stats(self):
+        """
+        Returns a summary of the histogram as a dict.
+        """
+        return {'count': self.count, 'mean': self.mean(), 'max': self.max,
+                'p50': self.percentile(50), 'p90': self.percentile(90),
+                'p99': self.percentile(99)}
+
+
+    def to_dict(self):
+        """
+        Returns a compact representation of the histogram, only keeping the
+        buckets that aren't empty, suitable for storage as JSON.
+        """
+        return {'bounds': self.bounds,
+                'buckets': [(i, count) for i, count in enumerate(self.counts)
+                                       if count],
+                'count': self.count, 'total': self.total, 'max': self.max}
+
+
+    @classmethod
+    def from_dict(cls, data):
+        histogram = cls(list(data['bounds']))
+        for i, count in data['buckets']:
+            histogram.counts[i] = count
+        histogram.count = data['count']
+        histogram.total = data['total']
+        histogram.max = data['max']
+        return histogram
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+import time
+import threading
+
+
+# Returned by LRUCache.get on a miss, since None is a perfectly good value
+# to cache.
+MISSING = object()
+
+# Positions in the linked list entries
+PREV, NEXT, KEY, VALUE, EXPIRES = range(5)
+
+
+class LRUCache(object):
+    """
+    A thread safe, size bounded mapping that evicts the least recently used
+    entry when it is full. Entries can optionally expire after ttl seconds.
+    It counts hits, misses and evictions so it can be sized.
+
+    >>> cache = LRUCache(max_size=2)
+    >>> cache.set('a', 1)
+    >>> cache.set('b', None)
+    >>> cache.get('b') is None
+    True
+    >>> cache.get('a')
+    1
+    >>> cache.set('c', 3)
+    >>> cache.get('b') is MISSING
+    True
+    >>> cache.discard_values(lambda value: value == 1)
+    >>> cache.get('a') is MISSING
+    True
+    >>> sorted(cache.stats().items())
+    [('evictions', 1), ('hits', 2), ('max_size', 2), ('misses', 2), ('size', 1)]
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # Doubly linked list of entries, most recently used first. The
+        # root entry is a sentinel that never holds a value.
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+        self._map = {}
+        self._lock = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._map)
+
+
+    def get(self, key, default=MISSING):
+        """
+        Returns the value cached for key, or default if there is none.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._map.get(key)
+            if entry is not None and entry[EXPIRES] is not None and \
+               entry[EXPIRES] < time.time():
+                self._unlink(entry)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self._unlink(entry)
+            self._link(entry)
+            return entry[VALUE]
+        finally:
+            self._lock.release()
+
+
+    def set(self, key, value):
+        """
+        Caches value for key, evicting the least recently used entry if the
+        cache is full.
+        """
+        if self.max_size <= 0:
+            return
+        expires = None
+        if self.ttl:
+            expires = time.time() + self.ttl
+
+        self._lock.acquire()
+        try:
+            entry = self._map.get(key)
+            if entry is not None:
+                self._unlink(entry)
+            while len(self._map) >= self.max_size:
+                self._unlink(self._root[PREV])
+                self.evictions += 1
+            self._link([None, None, key, value, expires])
+        finally:
+            self._lock.release()
+
+
+    def discard(self, key):
+        """
+        Removes key from the cache, if it is there.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._map.get(key)
+            if entry is not None:
+                self._unlink(entry)
+        finally:
+            self._lock.release()
+
+
+    def discard_values(self, predicate):
+        """
+        Removes every entry whose value matches predicate(value).
+        """
+        self._lock.acquire()
+        try:
+            for entry in self._map.values():
+                if predicate(entry[VALUE]):
+                    self._unlink(entry)
+        finally:
+            self._lock.release()
+
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._map.clear()
+            self._root[:] = [self._root, self._root, None, None, None]
+        finally:
+            self._lock.release()
+
+
+    def stats(self):
+        """
+        Returns a dict of the cache counters, for monitoring.
+        """
+        return {'size': len(self._map), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
+
+    def _link(self, entry):
+        root = self._root
+        first = root[NEXT]
+        entry[PREV], entry[NEXT] = root, first
+        first[PREV] = root[NEXT] = entry
+        self._map[entry[KEY]] = entry
+
+
+    def _unlink(self, entry):
+        entry[PREV][NEXT] = entry[NEXT]
+        entry[NEXT][PREV] = entry[PREV]
+        del self._map[entry[KEY]]
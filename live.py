@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Live tail of the message log.
+
+When live_port and live_secret are set in local.ini, the router listens
+on that port of localhost, and App.handle and App.outgoing publish every
+LoggedMessage they log to the Channel. A single thread sends each message,
+as a line of JSON, to every subscriber: the web server processes streaming
+the log to browsers (see views.live_stream). However many people watch the
+log, each message is serialized once and the database isn't queried at
+all.
+
+The Channel remembers the last HISTORY messages. Subscribers send the id of
+the last message they have seen when they connect and get the messages
+logged since first, so a browser reconnecting doesn't miss any (as long as
+it was away for less than HISTORY messages).
+
+The protocol is line based: the subscriber sends the secret and its last
+id, separated by a space and followed by a newline, then receives one JSON
+object per line. Any local user can connect to the port, so subscribers
+that don't know the secret are disconnected straight away.
+
+Sending never blocks: what a subscriber can't take yet waits in a buffer of
+its own, and a subscriber more than MAX_PENDING bytes behind is dropped.
+'''
+
+import errno
+import Queue
+import socket
+import threading
+from collections import deque
+
+from django.utils import simplejson
+
+
+# The Channel of the logger_ng app, if live tail is enabled.
+current = None
+
+# Number of messages kept for subscribers that reconnect
+HISTORY = 1000
+
+# Messages waiting to be sent. When subscribers are so slow that this many
+# pile up, new messages are not published rather than slowing the router.
+QUEUE_SIZE = 10000
+
+# Seconds a subscriber has to send the secret and its last id
+HANDSHAKE_TIMEOUT = 5
+
+# Bytes that may wait for a subscriber before it is disconnected
+MAX_PENDING = 1024 * 1024
+
+# Seconds between attempts to send to subscribers that are behind
+RETRY_INTERVAL = 0.1
+
+
+def same_secret(a, b):
+    '''
+    Compares two secrets in a time that doesn't depend on how much of them
+    is the same.
+    '''
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+def to_event(msg):
+    '''
+    Returns the line published for a LoggedMessage.
+    '''
+    data = msg.to_dict()
+    data['reporter_id'] = msg.reporter_id
+    return simplejson.dumps(data) + '\n'
+
+
+class Channel(object):
+    '''
+    Publishes LoggedMessages to the processes subscribed on localhost:port
+    with the secret.
+    '''
+
+    def __init__(self, port, secret, history=HISTORY):
+        if not secret:
+            raise ValueError("The live tail needs a live_secret")
+        self.port = port
+        self.secret = secret
+        self.published = 0
+        self.skipped = 0
+        self.dropped = 0
+        self.refused = 0
+        # (id, line) of the last messages
+        self._history = deque(maxlen=history)
+        # socket => data it hasn't taken yet
+        self._subscribers = {}
+        self._queue = Queue.Queue(QUEUE_SIZE)
+        self._server = None
+        self._threads = []
+
+
+    def publish(self, msg):
+        '''
+        Queues a LoggedMessage for the subscribers. Never blocks.
+        '''
+        try:
+            self._queue.put_nowait(('message', msg.pk, to_event(msg)))
+            self.published += 1
+        except Queue.Full:
+            self.skipped += 1
+
+
+    def start(self):
+        self._server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._server.bind(('127.0.0.1', self.port))
+        self._server.listen(16)
+        for target, name in ((self._accept, 'logger_ng live accept'),
+                             (self._fan_out, 'logger_ng live fan-out')):
+            thread = threading.Thread(target=target, name=name)
+            thread.setDaemon(True)
+            thread.start()
+            self._threads.append(thread)
+
+
+    def stop(self):
+        self._queue.put(('stop', None, None))
+        try:
+            self._server.close()
+        except socket.error:
+            pass
+        for thread in self._threads:
+            thread.join(HANDSHAKE_TIMEOUT)
+        self._threads = []
+        for sock in self._subscribers.keys():
+            sock.close()
+        self._subscribers = {}
+
+
+    def stats(self):
+        return {'subscribers': len(self._subscribers),
+                'published': self.published, 'skipped': self.skipped,
+                'dropped': self.dropped, 'refused': self.refused}
+
+
+    def _accept(self):
+        while True:
+            try:
+                sock, address = self._server.accept()
+            except socket.error:
+                # The server socket was closed by stop()
+                return
+            # Reading the handshake happens here, so that a subscriber slow
+            # to send it doesn't hold up the others.
+            sock.settimeout(HANDSHAKE_TIMEOUT)
+            try:
+                secret, last_id = sock.makefile('rb').readline().split()
+                last_id = int(last_id)
+            except (socket.error, ValueError):
+                secret = None
+            if secret is None or not same_secret(secret, self.secret):
+                self.refused += 1
+                sock.close()
+                continue
+            sock.setblocking(0)
+            self._queue.put(('subscribe', last_id, sock))
+
+
+    def _fan_out(self):
+        while True:
+            try:
+                if [pending for pending in self._subscribers.itervalues()
+                    if pending]:
+                    kind, pk, data = self._queue.get(True, RETRY_INTERVAL)
+                else:
+                    kind, pk, data = self._queue.get()
+            except Queue.Empty:
+                kind, pk, data = None, None, ''
+            if kind == 'stop':
+                return
+            if kind == 'subscribe':
+                sock = data
+                self._subscribers[sock] = ''
+                data = ''.join([line for msg_id, line in self._history
+                                if msg_id > pk])
+                self._send(sock, data)
+                continue
+
+            if kind == 'message':
+                self._history.append((pk, data))
+            for sock in self._subscribers.keys():
+                self._send(sock, data)
+
+
+    def _send(self, sock, data):
+        '''
+        Sends as much of the data waiting for a subscriber, followed by
+        data, as it takes without blocking. Drops the subscriber if it is
+        too far behind or gone.
+        '''
+        pending = self._subscribers[sock] + data
+        try:
+            if pending:
+                pending = pending[sock.send(pending):]
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self._drop(sock)
+                return
+        if len(pending) > MAX_PENDING:
+            self.dropped += 1
+            self._drop(sock)
+            return
+        self._subscribers[sock] = pending
+
+
+    def _drop(self, sock):
+        del self._subscribers[sock]
+        sock.close()
+
+
+def subscribe(port, secret, last_id=0, timeout=15):
+    '''
+    Connects to the Channel of the router on localhost:port and returns an
+    iterator over the dicts of the messages logged after last_id. It yields
+    None when nothing was logged for `timeout` seconds. Raises socket.error
+    if the router isn't listening.
+    '''
+    sock = socket.create_connection(('127.0.0.1', port), timeout)
+    try:
+        sock.sendall('%s %d\n' % (secret, last_id))
+    except socket.error:
+        sock.close()
+        raise
+    return _receive(sock)
+
+
+def _receive(sock):
+    try:
+        received = ''
+        while True:
+            try:
+                data = sock.recv(65536)
+            except socket.timeout:
+                yield None
+                continue
+            if not data:
+                # The router stopped
+                return
+            lines = (received + data).split('\n')
+            # The last one is incomplete, or empty
+            received = lines.pop()
+            for line in lines:
+                yield simplejson.loads(line)
+    finally:
+        sock.close()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Assigns the conversation of every message of the log (see conversation.py),
+for the messages logged before conversations existed, or imported:
+    ./rapidsms backfill_logger_conversations [--window=seconds]
+
+The log is read in date order, CHUNK_SIZE messages at a time, remembering
+the last message of each phone, and only the messages whose conversation
+changes are updated, one transaction per chunk. Run it with the router
+stopped, or it may split a conversation going on meanwhile.
+'''
+
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.db import connection, transaction
+from django.db.models import Q
+from django.utils.translation import ugettext as _
+from django.core.management.base import BaseCommand
+
+from logger_ng.models import LoggedMessage
+
+
+CHUNK_SIZE = 5000
+
+
+def iter_messages(chunk_size=CHUNK_SIZE):
+    '''
+    Yields the (id, date, backend, identity, conversation) of every message,
+    oldest first, reading them chunk_size at a time (see export.iter_rows).
+    '''
+    msgs = LoggedMessage.objects.order_by('date', 'id') \
+                        .values_list('id', 'date', 'backend', 'identity',
+                                     'conversation')
+    last = None
+    while True:
+        chunk = msgs
+        if last is not None:
+            pk, date = last
+            chunk = chunk.filter(date__gte=date) \
+                         .filter(Q(date__gt=date) | Q(date=date, pk__gt=pk))
+        rows = list(chunk[:chunk_size])
+        if not rows:
+            return
+        for row in rows:
+            yield row
+        last = rows[-1][:2]
+
+
+@transaction.commit_on_success
+def update_conversations(changes):
+    '''
+    Sets the conversation of messages, from a list of (conversation, id).
+    '''
+    now = datetime.now()
+    cursor = connection.cursor()
+    cursor.executemany("UPDATE %s SET conversation = %%s, modified = %%s "
+                       "WHERE id = %%s" %
+                       connection.ops.quote_name(LoggedMessage._meta.db_table),
+                       [(conversation, now, pk) for conversation, pk
+                        in changes])
+
+
+class Command(BaseCommand):
+    '''
+    This class _must_ be named command subclass BaseCommand to work.
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--window', type='int', dest='window', default=1800,
+                    help='Seconds without a message after which a new '
+                         'conversation starts, as conversation_window in '
+                         'local.ini. Defaults to 1800.'),
+    )
+    help = 'Assigns the conversation of the messages already logged.'
+
+    def handle(self, *args, **options):
+        window = timedelta(seconds=options['window'])
+        # (backend, identity) => (date, conversation) of the last message
+        last = {}
+        changes = []
+        updated = 0
+        for pk, date, backend, identity, current in iter_messages():
+            key = (backend, identity)
+            previous = last.get(key)
+            if previous is not None and date - previous[0] <= window:
+                conversation = previous[1]
+            else:
+                conversation = pk
+            last[key] = (date, conversation)
+
+            if current != conversation:
+                changes.append((conversation, pk))
+            if len(changes) >= CHUNK_SIZE:
+                update_conversations(changes)
+                updated += len(changes)
+                changes = []
+
+        if changes:
+            update_conversations(changes)
+            updated += len(changes)
+        print _(u"%(updated)d messages updated, in %(count)d phones.") % \
+              {'updated': updated, 'count': len(last)}
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Rebuilds the identity summaries (see summary.py) from the message log:
+    ./rapidsms backfill_logger_identities
+
+Use it once after creating the summary table, and after importing messages
+with import_from_logger. All the summaries are replaced, in one
+transaction, by one GROUP BY query over the log, then the last status and
+reporter of each phone are read from its last message with the
+(backend, identity, date) index. Messages logged or tagged while it runs
+may be counted twice or not at all, so run it with the router stopped.
+'''
+
+from django.db import connection, transaction
+from django.utils.translation import ugettext as _
+from django.core.management.base import BaseCommand
+
+from logger_ng.models import LoggedMessage, IdentitySummary
+
+
+@transaction.commit_on_success
+def backfill():
+    '''
+    Replaces the identity summaries by a recount, and returns the number of
+    phones summarized.
+    '''
+    qn = connection.ops.quote_name
+    names = {'summary': qn(IdentitySummary._meta.db_table),
+             'log': qn(LoggedMessage._meta.db_table)}
+
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM %(summary)s" % names)
+    cursor.execute("INSERT INTO %(summary)s (backend, identity, first_seen, "
+                   "last_seen, incoming, outgoing, last_status) "
+                   "SELECT backend, identity, MIN(date), MAX(date), "
+                   "SUM(CASE WHEN direction = %%s THEN 1 ELSE 0 END), "
+                   "SUM(CASE WHEN direction = %%s THEN 0 ELSE 1 END), '' "
+                   "FROM %(log)s GROUP BY backend, identity" % names,
+                   [LoggedMessage.DIRECTION_INCOMING,
+                    LoggedMessage.DIRECTION_INCOMING])
+    last = "(SELECT %%s FROM %(log)s m " \
+           "WHERE m.backend = %(summary)s.backend " \
+           "AND m.identity = %(summary)s.identity " \
+           "ORDER BY m.date DESC, m.id DESC LIMIT 1)" % names
+    cursor.execute("UPDATE %s SET last_status = COALESCE(%s, ''), "
+                   "reporter_id = %s" %
+                   (names['summary'], last % 'm.status',
+                    last % 'm.reporter_id'))
+    return IdentitySummary.objects.count()
+
+
+class Command(BaseCommand):
+    '''
+    This class _must_ be named command subclass BaseCommand to work.
+    '''
+
+    help = 'Rebuilds the logger_ng identity summaries from the message log.'
+
+    def handle(self, *args, **options):
+        print _(u"%d phones summarized.") % backfill()
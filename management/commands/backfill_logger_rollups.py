@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Recounts the traffic rollups (see rollup.py) from the message log:
+    ./rapidsms backfill_logger_rollups [--since=YYYY-MM-DD]
+
+Use it once after creating the rollup table, and after importing messages
+with import_from_logger. The rollups from the since date (or all of them)
+are replaced by counts made with one GROUP BY query. Messages logged or
+tagged while it runs may be counted twice or not at all, so run it with
+the router stopped, or for days that are over.
+'''
+
+from datetime import datetime
+from optparse import make_option
+
+from django.db import connection, transaction
+from django.utils.translation import ugettext as _
+from django.core.management.base import BaseCommand, CommandError
+
+from logger_ng.db import backend_vendor
+from logger_ng.models import LoggedMessage, TrafficRollup
+from logger_ng.rollup import period_starts
+
+
+# SQL expression of the start of the hour of the date column
+HOUR_SQL = {
+    'postgresql': "date_trunc('hour', date)",
+    'mysql': "DATE_FORMAT(date, '%%Y-%%m-%%d %%H:00:00')",
+    'sqlite': "strftime('%%Y-%%m-%%d %%H:00:00', date)",
+}
+
+
+def hourly_counts(since=None):
+    '''
+    Yields (hour start, backend, direction, status, count) rows, counted by
+    the database.
+    '''
+    hour = HOUR_SQL.get(backend_vendor())
+    if hour is None:
+        raise CommandError(_(u"Rollups can only be backfilled on " \
+                             u"PostgreSQL, MySQL and SQLite."))
+    sql = "SELECT %(hour)s, backend, direction, status, COUNT(*) " \
+          "FROM %(table)s %(where)s GROUP BY 1, 2, 3, 4" % \
+          {'hour': hour, 'table': LoggedMessage._meta.db_table,
+           'where': since and "WHERE date >= %s" or ""}
+    cursor = connection.cursor()
+    cursor.execute(sql, since and [since] or [])
+    for start, backend, direction, status, count in cursor.fetchall():
+        if not isinstance(start, datetime):
+            start = datetime.strptime(start, '%Y-%m-%d %H:%M:%S')
+        yield start, backend, direction, status, count
+
+
+@transaction.commit_on_success
+def backfill(since=None):
+    '''
+    Replaces the rollups from the since date by a recount, and returns the
+    number of rollup rows written.
+    '''
+    counts = {}
+    for start, backend, direction, status, count in hourly_counts(since):
+        for period, period_start in period_starts(start):
+            key = (period, period_start, backend, direction, status or '')
+            counts[key] = counts.get(key, 0) + count
+
+    rollups = TrafficRollup.objects.all()
+    if since is not None:
+        rollups = rollups.filter(start__gte=since)
+    rollups.delete()
+
+    qn = connection.ops.quote_name
+    columns = ('period', 'start', 'backend', 'direction', 'status', 'count')
+    cursor = connection.cursor()
+    cursor.executemany("INSERT INTO %s (%s) VALUES (%s)" %
+                       (qn(TrafficRollup._meta.db_table),
+                        ', '.join([qn(column) for column in columns]),
+                        ', '.join(['%s'] * len(columns))),
+                       [key + (count,) for key, count in counts.iteritems()])
+    return len(counts)
+
+
+class Command(BaseCommand):
+    '''
+    This class _must_ be named command subclass BaseCommand to work.
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest='since',
+                    help='Only recount the messages from this date '
+                         '(YYYY-MM-DD).'),
+    )
+    help = 'Recounts the logger_ng traffic rollups from the message log.'
+
+    def handle(self, *args, **options):
+        since = None
+        if options['since']:
+            try:
+                since = datetime.strptime(options['since'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError(_(u"Dates must be given as YYYY-MM-DD"))
+
+        print _(u"%d rollups written.") % backfill(since)
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Measures how fast the logger_ng app logs messages:
+    ./rapidsms benchmark_logger_ingest [--messages=2000] [--phones=500]
+                                       [--known=0.5] [--replies=0.8]
+                                       [--tags=0.5] [--option=key=value]
+                                       [--json=file|-]
+
+Synthetic messages, from stub backend and connection classes, go through
+LoggedMessage.create_from_message and save() on their own, then through the
+whole of App.handle, App.outgoing (for the replies) and
+LoggedMessage.tag_message, as they would in the router. The throughput and
+the p50/p99 durations of each stage are printed, and written as JSON with
+--json, to compare releases. --option passes local.ini options to the app,
+i.e. --option=batch_size=100 to measure the write-behind buffer.
+
+It runs against the database in the settings, so point local.ini to a
+scratch SQLite or PostgreSQL database. The messages, phones and reporters it
+creates use the BACKEND backend, and are deleted at the end unless --keep
+is given.
+'''
+
+import sys
+import copy
+import random
+from optparse import make_option
+
+from django.db import connection, transaction
+from django.utils.translation import ugettext as _
+from django.core.management.base import BaseCommand, CommandError
+
+from reporters.models import Reporter, PersistantBackend, \
+                             PersistantConnection
+
+from logger_ng.app import App
+from logger_ng.benchmark import Stage, results, print_table, write_json
+from logger_ng.models import LoggedMessage, TrafficRollup, ResponseLatency, \
+                             IdentitySummary, reporter_cache
+
+
+BACKEND = 'logger_ng_bench'
+
+TEXTS = [u"report 12 4 0", u"join John Doe", u"stock 3 bags",
+         u"help", u"cases 2 1 0 5", u"pin 1234"]
+
+
+class _Backend(object):
+
+    def __init__(self, slug):
+        self.slug = slug
+
+
+class _Connection(object):
+
+    def __init__(self, backend, identity):
+        self.backend = backend
+        self.identity = identity
+
+
+class _Message(object):
+    '''
+    The parts of rapidsms.message.Message that logger_ng uses.
+    '''
+
+    def __init__(self, connection, text, status=None):
+        self.connection = connection
+        self.text = text
+        self.status = status
+
+
+    def respond(self, text, status=None):
+        # Like Message.respond, the response is a copy, logger_id included
+        response = copy.copy(self)
+        response.text = text
+        response.status = status
+        return response
+
+
+class _Router(object):
+    '''
+    Stands for the router the app logs through.
+    '''
+
+    def log(self, level, msg, *args):
+        pass
+
+
+def create_phones(count, known):
+    '''
+    Creates the phones messages come from, a `known` fraction of them with
+    a reporter. Returns their connections.
+    '''
+    backend, created = PersistantBackend.objects.get_or_create(slug=BACKEND)
+    connections = []
+    for i in xrange(count):
+        identity = '+1555%07d' % i
+        if random.random() < known:
+            reporter = Reporter.objects.create(username='%s_%d' %
+                                                        (BACKEND, i),
+                                               first_name=u"Bench",
+                                               last_name=unicode(i))
+            PersistantConnection.objects.create(backend=backend,
+                                                identity=identity,
+                                                reporter=reporter)
+        connections.append(_Connection(_Backend(BACKEND), identity))
+    return connections
+
+
+@transaction.commit_on_success
+def clean_up():
+    '''
+    Deletes everything the benchmark created.
+    '''
+    cursor = connection.cursor()
+    for model in (LoggedMessage, TrafficRollup, ResponseLatency,
+                  IdentitySummary):
+        cursor.execute("DELETE FROM %s WHERE backend = %%s" %
+                       connection.ops.quote_name(model._meta.db_table),
+                       [BACKEND])
+    PersistantConnection.objects.filter(backend__slug=BACKEND).delete()
+    Reporter.objects.filter(username__startswith=BACKEND + '_').delete()
+    PersistantBackend.objects.filter(slug=BACKEND).delete()
+
+
+class Command(BaseCommand):
+    '''
+    This class _must_ be named command subclass BaseCommand to work.
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--messages', type='int', dest='messages', default=2000,
+                    help='Number of incoming messages per pass. Defaults '
+                         'to 2000.'),
+        make_option('--phones', type='int', dest='phones', default=500,
+                    help='Number of phones sending them. Defaults to 500.'),
+        make_option('--known', type='float', dest='known', default=0.5,
+                    help='Fraction of the phones with a reporter. Defaults '
+                         'to 0.5.'),
+        make_option('--replies', type='float', dest='replies', default=0.8,
+                    help='Fraction of the messages replied to. Defaults '
+                         'to 0.8.'),
+        make_option('--tags', type='float', dest='tags', default=0.5,
+                    help='Fraction of the messages tagged. Defaults to '
+                         '0.5.'),
+        make_option('--option', action='append', dest='app_options',
+                    default=[],
+                    help='key=value option for the app, as in local.ini. '
+                         'Can be given several times.'),
+        make_option('--json', dest='json',
+                    help='Write the results as JSON to this file, or to '
+                         'stdout with -.'),
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help='Random seed, so that runs can be compared. '
+                         'Defaults to 0.'),
+        make_option('--keep', action='store_true', dest='keep',
+                    default=False,
+                    help="Don't delete the messages, phones and reporters "
+                         "created."),
+    )
+    help = 'Measures the throughput of the logger_ng app.'
+
+    def handle(self, *args, **options):
+        app_options = {}
+        for option in options['app_options']:
+            if '=' not in option:
+                raise CommandError(_(u"App options must be given as " \
+                                     u"key=value"))
+            key, value = option.split('=', 1)
+            app_options[key] = value
+
+        random.seed(options['seed'])
+        count = options['messages']
+        statuses = [code for code, name in LoggedMessage.STATUS_CHOICES]
+
+        try:
+            connections = create_phones(options['phones'], options['known'])
+
+            def messages():
+                return [_Message(random.choice(connections),
+                                 random.choice(TEXTS))
+                        for i in xrange(count)]
+
+            # The parts of logging a message, on their own
+            create = Stage('create_from_message')
+            save = Stage('save')
+            reporter_cache.clear()
+            for message in messages():
+                msg = create.time(LoggedMessage.create_from_message, message)
+                msg.direction = LoggedMessage.DIRECTION_INCOMING
+                save.time(msg.save)
+
+            # The whole app, as the router uses it
+            app = App(_Router())
+            app.configure(**app_options)
+            reporter_cache.clear()
+            app.start()
+            handle = Stage('App.handle')
+            outgoing = Stage('App.outgoing')
+            tag = Stage('tag_message')
+            for message in messages():
+                handle.time(app.handle, message)
+                if random.random() < options['replies']:
+                    outgoing.time(app.outgoing,
+                                  message.respond(u"Thank you"))
+                if random.random() < options['tags']:
+                    tag.time(LoggedMessage.tag_message, message,
+                             random.choice(statuses))
+            stop = Stage('App.stop')
+            stop.time(app.stop)
+            cache_stats = reporter_cache.stats()
+
+        finally:
+            if not options['keep']:
+                clean_up()
+            reporter_cache.clear()
+
+        data = results('logger_ng.ingest',
+                       [create, save, handle, outgoing, tag, stop],
+                       dict(options, app_options=app_options),
+                       reporter_cache=cache_stats)
+        # Keep stdout for the JSON if it goes there
+        print_table(data, options['json'] == '-' and sys.stderr or sys.stdout)
+        if options['json']:
+            write_json(data, options['json'])
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Measures how fast the log view answers, and with how many queries:
+    ./rapidsms benchmark_logger_views [--repeat=10] [--depth=100]
+                                      [--common=report] [--rare=cholera]
+                                      [--json=file|-]
+
+Meant to be run on a large log, i.e. one filled by seed_logger. Each
+request goes through the whole Django stack with the test client, logged
+in as a temporary superuser, and is made --repeat times:
+    first page          - /logger_ng
+    deep page           - the page --depth pages down the log
+    common search       - the first page of a search matching most messages
+    common search, deep - the page --depth pages down that search
+    rare search         - the first page of a search matching a few
+The throughput, p50/p99 durations and queries per request are printed, and
+written as JSON with --json, to compare schema and view changes. The
+cursors of the deep pages are found before timing, and not timed.
+'''
+
+import re
+import sys
+from optparse import make_option
+
+from django.conf import settings
+from django.db import connection
+from django.test.client import Client
+from django.contrib.auth.models import User
+from django.utils.translation import ugettext as _
+from django.core.management.base import BaseCommand, CommandError
+
+from logger_ng.benchmark import Stage, results, print_table, write_json
+from logger_ng.pagination import KeysetPaginator, RankedPaginator
+from logger_ng.search import search_messages, search_words, index_exists
+from logger_ng.views import threaded_messages
+
+
+URL = '/logger_ng'
+
+# Messages per page of views.index
+PER_PAGE = 30
+
+USERNAME = 'logger_ng_bench_user'
+
+
+def deep_params(search, depth):
+    '''
+    Returns the GET parameters of the page `depth` pages into the log, or
+    into the results of a search, or None if there are fewer pages.
+    '''
+    params = {}
+    if search:
+        params['logger_ng_search_box'] = search
+    msgs = search_messages(threaded_messages(), search)
+    if search_words(search) and index_exists():
+        paginator = RankedPaginator(msgs, PER_PAGE, search)
+    else:
+        paginator = KeysetPaginator(msgs, PER_PAGE)
+    try:
+        last = paginator.ordered(msgs)[depth * PER_PAGE - 1]
+    except IndexError:
+        return None
+    params['after'] = paginator.make_cursor(last)
+    return params
+
+
+class Command(BaseCommand):
+    '''
+    This class _must_ be named command subclass BaseCommand to work.
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--repeat', type='int', dest='repeat', default=10,
+                    help='Number of times each request is made. Defaults '
+                         'to 10.'),
+        make_option('--depth', type='int', dest='depth', default=100,
+                    help='How many pages down the deep pages are. Defaults '
+                         'to 100.'),
+        make_option('--common', dest='common', default='report',
+                    help='Search matching most messages. Defaults to '
+                         '"report".'),
+        make_option('--rare', dest='rare', default='cholera',
+                    help='Search matching a few messages. Defaults to '
+                         '"cholera".'),
+        make_option('--json', dest='json',
+                    help='Write the results as JSON to this file, or to '
+                         'stdout with -.'),
+    )
+    help = 'Measures the response time of the logger_ng log view.'
+
+    def handle(self, *args, **options):
+        if options['depth'] < 1:
+            raise CommandError(_(u"--depth must be at least 1."))
+        common = options['common'].decode('utf-8')
+        rare = options['rare'].decode('utf-8')
+        scenarios = [
+            ('first page', {}),
+            ('deep page', deep_params(u'', options['depth'])),
+            ('common search', {'logger_ng_search_box': common}),
+            ('common search, deep', deep_params(common, options['depth'])),
+            ('rare search', {'logger_ng_search_box': rare}),
+        ]
+        for name, params in scenarios:
+            if params is None:
+                raise CommandError(_(u"The log doesn't have %(depth)d " \
+                                     u"pages for the %(name)s, seed it " \
+                                     u"with seed_logger or lower --depth.") %
+                                   {'depth': options['depth'], 'name': name})
+
+        # Queries are only recorded in debug mode
+        debug, settings.DEBUG = settings.DEBUG, True
+        password = User.objects.make_random_password()
+        User.objects.filter(username=USERNAME).delete()
+        user = User.objects.create_superuser(USERNAME, '', password)
+        try:
+            client = Client()
+            if not client.login(username=USERNAME, password=password):
+                raise CommandError(_(u"Could not log in the test client."))
+
+            stages = []
+            shown = {}
+            for name, params in scenarios:
+                stage = Stage(name)
+                for i in xrange(options['repeat']):
+                    connection.queries = []
+                    response = stage.time(client.get, URL, params)
+                    stage.queries.append(len(connection.queries))
+                    if response.status_code != 200:
+                        raise CommandError(_(u"%(url)s answered %(status)d " \
+                                             u"for the %(name)s.") %
+                                           {'url': URL, 'name': name,
+                                            'status': response.status_code})
+                stages.append(stage)
+                # Messages shown, to make sure the right pages are timed
+                shown[name] = len(re.findall(r'class="details"',
+                                             response.content))
+            client.logout()
+        finally:
+            user.delete()
+            settings.DEBUG = debug
+            connection.queries = []
+
+        data = results('logger_ng.views', stages, dict(options),
+                       messages_shown=shown)
+        # Keep stdout for the JSON if it goes there
+        print_table(data, options['json'] == '-' and sys.stderr or sys.stdout)
+        if options['json']:
+            write_json(data, options['json'])
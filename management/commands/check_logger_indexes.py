@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Checks that the hot logger_ng queries use the indexes made for them.
+
+Runs EXPLAIN on the queries behind the log view, the threaded responses
+and the per identity lookups, and reports the index each one uses. It
+exits with an error if one of them doesn't use the index expected for
+it, so it can be run after a schema or view change, on SQLite or
+PostgreSQL:
+    ./rapidsms check_logger_indexes [--analyze]
+
+The log view must use the partial index logger_ng_lm_page. Falling back to
+logger_ng_lm_date_id would mean reading past every threaded response.
+
+Planners don't bother with indexes on tiny tables, so this is only
+meaningful on a log with a realistic number of rows.
+'''
+
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.db import connection
+from django.utils.translation import ugettext as _
+from django.core.management.base import BaseCommand, CommandError
+
+from logger_ng.db import backend_vendor
+from logger_ng.models import LoggedMessage
+from logger_ng.views import threaded_messages
+
+
+def query_sql(queryset):
+    '''
+    Returns the SQL and parameters of a queryset.
+    '''
+    query = queryset.query
+    if hasattr(query, 'get_compiler'):
+        return query.get_compiler(queryset.db).as_sql()
+    return query.as_sql()
+
+
+def query_plan(queryset):
+    '''
+    Returns the plan of a queryset, from EXPLAIN on PostgreSQL or EXPLAIN
+    QUERY PLAN on SQLite, as text.
+    '''
+    if backend_vendor() == 'postgresql':
+        explain = 'EXPLAIN '
+    else:
+        explain = 'EXPLAIN QUERY PLAN '
+    sql, params = query_sql(queryset)
+    cursor = connection.cursor()
+    cursor.execute(explain + sql, params)
+    return '\n'.join([' '.join([unicode(column) for column in row])
+                      for row in cursor.fetchall()])
+
+
+def hot_queries():
+    '''
+    Returns (description, queryset, acceptable index names) tuples.
+    '''
+    now = datetime.now()
+    page = threaded_messages()
+    return [
+        (_(u"Log view, first page"),
+         page.order_by('-date', '-id')[:31],
+         ['logger_ng_lm_page']),
+        (_(u"Log view, deep page"),
+         page.filter(date__lte=now - timedelta(days=365))
+             .order_by('-date', '-id')[:31],
+         ['logger_ng_lm_page']),
+        (_(u"Responses to a page of messages"),
+         LoggedMessage.objects.filter(response_to__in=range(1, 31))
+                              .order_by('date', 'id'),
+         ['logger_ng_lm_responses']),
+        (_(u"Messages of an identity around a date"),
+         LoggedMessage.incoming.filter(backend='backend',
+                                       identity='identity',
+                                       date__gte=now - timedelta(seconds=5),
+                                       date__lte=now),
+         ['logger_ng_lm_identity']),
+    ]
+
+
+class Command(BaseCommand):
+    '''
+    This class _must_ be named command subclass BaseCommand to work.
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--analyze', action='store_true', dest='analyze',
+                    default=False,
+                    help='Update the planner statistics first.'),
+    )
+    help = 'Checks that the hot logger_ng queries use their indexes.'
+
+    def handle(self, *args, **options):
+        vendor = backend_vendor()
+        if vendor not in ('postgresql', 'sqlite'):
+            raise CommandError(_(u"Query plans can only be checked on " \
+                                 u"PostgreSQL and SQLite."))
+
+        if options['analyze']:
+            connection.cursor().execute('ANALYZE %s' %
+                                        LoggedMessage._meta.db_table)
+
+        failures = 0
+        for description, queryset, indexes in hot_queries():
+            plan = query_plan(queryset)
+            used = [index for index in indexes if index in plan]
+            if used:
+                print _(u"OK    %(query)s: uses %(index)s") % \
+                      {'query': description, 'index': used[0]}
+            else:
+                failures += 1
+                print _(u"FAIL  %(query)s, expected %(indexes)s:") % \
+                      {'query': description, 'indexes': ' or '.join(indexes)}
+                print plan
+
+        if failures:
+            raise CommandError(_(u"%d queries don't use their index.") %
+                               failures)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Exports the logger_ng message log as CSV or JSON Lines, oldest first:
+    ./rapidsms export_logger [--format=csv|jsonl] [--search=...]
+                             [--since=YYYY-MM-DD] [--until=YYYY-MM-DD]
+                             [--output=file]
+
+The search works like the search box of the log view. The output goes to
+stdout unless --output is given, and is written as the messages are read,
+so any size of log can be exported (see export.py).
+'''
+
+import sys
+from optparse import make_option
+
+from django.utils.translation import ugettext as _
+from django.core.management.base import BaseCommand, CommandError
+
+from logger_ng.export import FORMATS, export_queryset, export_messages, \
+                             parse_date
+
+
+class Command(BaseCommand):
+    '''
+    This class _must_ be named command subclass BaseCommand to work.
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='csv',
+                    choices=FORMATS,
+                    help='csv (the default) or jsonl.'),
+        make_option('--search', dest='search', default='',
+                    help='Only export the messages matching this search.'),
+        make_option('--since', dest='since',
+                    help='Only export the messages logged from this date '
+                         '(YYYY-MM-DD).'),
+        make_option('--until', dest='until',
+                    help='Only export the messages logged before this date '
+                         '(YYYY-MM-DD).'),
+        make_option('--output', dest='output',
+                    help='File to write to, instead of stdout.'),
+    )
+    help = 'Exports the logger_ng message log as CSV or JSON Lines.'
+
+    def handle(self, *args, **options):
+        try:
+            since = parse_date(options['since'])
+            until = parse_date(options['until'])
+        except ValueError:
+            raise CommandError(_(u"Dates must be given as YYYY-MM-DD"))
+
+        msgs = export_queryset(options['search'].decode('utf-8'), since,
+                               until)
+        if options['output']:
+            output = open(options['output'], 'wb')
+        else:
+            output = sys.stdout
+        try:
+            for data in export_messages(msgs, options['format']):
+                output.write(data)
+        finally:
+            if output is not sys.stdout:
+                output.close()
@@ -12,46 +12,363 @@ It will even (somewhat) intelligently associate outgoing messages with their
 corresponding incoming message, based on the message identity, backend, and
 timestamp.
 
-Before importing, it will first check a random sampling of old messages
-and if it finds they've already been imported, it will exit-
-In other words, it won't let you accidentally import your old logs twice.
+The old messages are read CHUNK_SIZE at a time and inserted in bulk, one
+transaction per chunk, so that even large logs import in minutes. The
+imported messages get their ids from the database.
+
+Progress is saved as ImportCheckpoints, in the same transaction as each
+chunk: if an import is interrupted, running the command again resumes it
+where it stopped. Once an import is complete, running it again imports only
+the messages logged by the old logger since, so it can be used to keep
+logger_ng in sync while both apps run. Don't run two imports at once.
+
+Keeping in sync while the router runs needs PostgreSQL, though. With
+batching or spooling on (see batch.py), the router takes the ids of the
+messages it hasn't written yet from the table's sequence, which only
+PostgreSQL shares with other processes: on other databases, the imported
+messages could take them. The command refuses to run there if the router
+logged messages in the last ROUTER_ACTIVE minutes, unless --force is
+given for a router that doesn't batch.
+
+On PostgreSQL, --processes=N splits the old tables in N id ranges imported
+in parallel. Outgoing messages are only imported (and paired) once all the
+incoming ones are in.
+
+Every imported message gets a fingerprint (see models.message_fingerprint)
+and the messages whose fingerprint is already in logger_ng are skipped, so
+it won't import a message twice, even without checkpoints (i.e. messages
+imported by an older version of this command).
 '''
 
-import random
-from datetime import timedelta
+import sys
+import multiprocessing
+from Queue import Empty
+from datetime import datetime, timedelta
+from bisect import bisect_left, bisect_right
+from optparse import make_option
 
+from django.db import connection, transaction
+from django.db.models import Max
 from django.utils.translation import ugettext as _
 from django.core.management.base import BaseCommand, CommandError
 
 from logger.models import IncomingMessage, OutgoingMessage
-from logger_ng.models import LoggedMessage
+from logger_ng.benchmark import Progress
+from logger_ng.db import backend_vendor, bulk_insert
+from logger_ng.models import LoggedMessage, ImportCheckpoint, \
+                             message_fingerprint
 from reporters.models import PersistantConnection
 
 
-def create_from_logger_msg(msg):
+# Number of old messages read, and new ones inserted, at once.
+CHUNK_SIZE = 5000
+
+# Number of fingerprints looked up per query. SQLite doesn't allow more than
+# 999 parameters in a query.
+LOOKUP_SIZE = 500
+
+# Minutes since the router last logged a message for it to count as running
+ROUTER_ACTIVE = 10
+
+# checkpoint source => (old logger model, LoggedMessage direction)
+SOURCES = {
+    ImportCheckpoint.SOURCE_INCOMING: (IncomingMessage,
+                                       LoggedMessage.DIRECTION_INCOMING),
+    ImportCheckpoint.SOURCE_OUTGOING: (OutgoingMessage,
+                                       LoggedMessage.DIRECTION_OUTGOING),
+}
+
+
+def reporter_map():
     '''
-    Helper function that takes either an IncomingMessage or Outgoing
-    message (from the old logger app) and creates a LoggedMessage
-    object from it. It saves the new LoggedMessage then returns it.
+    Returns a dict mapping (backend slug, identity) to reporter id, for all
+    the connections, so we don't have to look them up one message at a
+    time.
     '''
-    if isinstance(msg, IncomingMessage):
-        direction = LoggedMessage.DIRECTION_INCOMING
-    else:
-        direction = LoggedMessage.DIRECTION_OUTGOING
+    return dict([((backend, identity), reporter)
+                 for backend, identity, reporter
+                 in PersistantConnection.objects.values_list('backend__slug',
+                                                             'identity',
+                                                             'reporter')])
+
+
+def iter_chunks(model, chunk_size=CHUNK_SIZE, after=0, upto=None):
+    '''
+    Yields the messages of an old logger model as lists of
+    (id, identity, backend, text, date) tuples, in id order, chunk_size at
+    a time, from the id after `after` up to the id `upto`. Each chunk is one
+    query starting after the last id of the previous one, so the whole
+    table is never in memory.
+    '''
+    last_id = after
+    while True:
+        rows = model.objects.filter(pk__gt=last_id)
+        if upto is not None:
+            rows = rows.filter(pk__lte=upto)
+        rows = list(rows.order_by('pk')
+                        .values_list('id', 'identity', 'backend',
+                                     'text', 'date')[:chunk_size])
+        if not rows:
+            return
+        yield rows
+        last_id = rows[-1][0]
+
+
+def create_from_logger_row(row, direction, reporters):
+    '''
+    Helper function that takes an (id, identity, backend, text, date) row
+    of the old logger app and returns an unsaved LoggedMessage for it,
+    with its fingerprint and the original date already set.
+    '''
+    old_id, identity, backend, text, date = row
+    return LoggedMessage(identity=identity, backend=backend, text=text,
+                         date=date, direction=direction,
+                         reporter_id=reporters.get((backend, identity)),
+                         fingerprint=message_fingerprint(direction, backend,
+                                                         identity, date,
+                                                         text))
+
+
+def skip_imported(msgs):
+    '''
+    Returns the LoggedMessages whose fingerprint isn't in the table yet.
+    '''
+    fingerprints = [msg.fingerprint for msg in msgs]
+    imported = set()
+    for i in range(0, len(fingerprints), LOOKUP_SIZE):
+        imported.update(LoggedMessage.objects
+                            .filter(fingerprint__in=fingerprints[i:i +
+                                                                 LOOKUP_SIZE])
+                            .values_list('fingerprint', flat=True))
+    return [msg for msg in msgs if msg.fingerprint not in imported]
+
+
+class ResponsePairer(object):
+    '''
+    Pairs outgoing messages with the incoming message they most likely
+    respond to: one sent by the same identity, on the same backend, at most
+    `window` seconds before.
+
+    Outgoing messages are paired a chunk at a time, once all the incoming
+    messages have been imported. Before each chunk, prepare() loads the
+    incoming messages sent between `window` seconds before its first
+    message and its last one, grouped by (backend, identity) and sorted by
+    date, and forgets those sent before. As the chunks go forward in time,
+    only the incoming messages newer than those already loaded are read,
+    so each one is read once and only a chunk's worth is in memory. Each
+    outgoing message is then paired with a binary search in its group.
+
+    When several incoming messages are within the window, the policy
+    decides: 'skip' leaves the outgoing message unpaired, 'latest' pairs it
+    with the closest incoming message, 'earliest' with the oldest one.
+    '''
+
+    POLICIES = ('skip', 'latest', 'earliest')
+
+    def __init__(self, window=5, policy='skip'):
+        if policy not in self.POLICIES:
+            raise ValueError(policy)
+        self.window = timedelta(seconds=window)
+        self.policy = policy
+        self.paired = 0
+        self.ambiguous = 0
+        # (backend, identity) => [(date, id), ...]
+        self._incoming = {}
+        # The incoming messages sent from _start to _end are loaded
+        self._start = self._end = None
+
+
+    def prepare(self, msgs):
+        '''
+        Loads the incoming LoggedMessages the outgoing msgs may respond to,
+        and forgets the older ones.
+        '''
+        if not self.window or not msgs:
+            return
+        dates = [msg.date for msg in msgs]
+        start, end = min(dates) - self.window, max(dates)
+
+        if self._start is None or start < self._start:
+            # Going back in time, start over
+            self._incoming = {}
+            self._start = self._end = start
+            self._load(LoggedMessage.incoming.filter(date__gte=start,
+                                                     date__lte=end))
+        else:
+            for key, incoming in self._incoming.items():
+                del incoming[:bisect_left(incoming, (start,))]
+                if not incoming:
+                    del self._incoming[key]
+            if end > self._end:
+                self._load(LoggedMessage.incoming.filter(date__gt=self._end,
+                                                         date__lte=end))
+        self._start, self._end = start, max(end, self._end)
+
 
+    def _load(self, msgs):
+        loaded = set()
+        for backend, identity, date, pk in \
+                msgs.values_list('backend', 'identity', 'date', 'id') \
+                    .iterator():
+            self._incoming.setdefault((backend, identity), []) \
+                          .append((date, pk))
+            loaded.add((backend, identity))
+        for key in loaded:
+            self._incoming[key].sort()
+
+
+    def pair(self, msg):
+        '''
+        Sets the response_to of an outgoing LoggedMessage, if there is an
+        incoming message it can be paired with.
+        '''
+        if not self.window:
+            return
+        incoming = self._incoming.get((msg.backend, msg.identity))
+        if not incoming:
+            return
+        # Incoming messages in [date - window, date]. Ids are above any
+        # real one, so that messages at exactly msg.date are included.
+        first = bisect_left(incoming, (msg.date - self.window,))
+        last = bisect_right(incoming, (msg.date, sys.maxint))
+        candidates = incoming[first:last]
+        if not candidates:
+            return
+        if len(candidates) > 1:
+            self.ambiguous += 1
+            if self.policy == 'skip':
+                return
+            if self.policy == 'earliest':
+                candidates = candidates[:1]
+        msg.response_to_id = candidates[-1][1]
+        self.paired += 1
+
+
+@transaction.commit_on_success
+def insert_chunk(msgs, checkpoint, done_id):
+    '''
+    Inserts a chunk of LoggedMessages and moves the checkpoint past them,
+    in a single transaction.
+    '''
+    count = bulk_insert(msgs)
+    ImportCheckpoint.objects.filter(pk=checkpoint.pk).update(done_id=done_id)
+    checkpoint.done_id = done_id
+    return count
+
+
+def plan_checkpoints(source, shards=1):
+    '''
+    Returns the ImportCheckpoints of a source left to import: the
+    unfinished ones of an interrupted run, and new ones for the messages
+    the old logger logged since the last run, split in up to `shards` id
+    ranges.
+    '''
+    model = SOURCES[source][0]
+    checkpoints = ImportCheckpoint.objects.filter(source=source)
+    pending = [checkpoint for checkpoint in checkpoints.order_by('first_id')
+               if not checkpoint.is_done()]
+
+    top = checkpoints.aggregate(top=Max('last_id'))['top'] or 0
+    newest = model.objects.aggregate(newest=Max('id'))['newest'] or 0
+    bounds = []
+    for i in range(shards + 1):
+        bound = top + (newest - top) * i // shards
+        if not bounds or bound > bounds[-1]:
+            bounds.append(bound)
+    for first, last in zip(bounds, bounds[1:]):
+        pending.append(ImportCheckpoint.objects.create(source=source,
+                                                       first_id=first + 1,
+                                                       last_id=last,
+                                                       done_id=first))
+    return pending
+
+
+def import_range(checkpoint, reporters, pairer=None, progress=None):
+    '''
+    Imports the messages of a checkpoint that haven't been imported yet,
+    pairing them with the pairer if there is one. Returns the number of
+    messages skipped because they were already in logger_ng.
+    '''
+    model, direction = SOURCES[checkpoint.source]
+    skipped = 0
+    for rows in iter_chunks(model, after=checkpoint.done_id,
+                            upto=checkpoint.last_id):
+        msgs = skip_imported([create_from_logger_row(row, direction,
+                                                     reporters)
+                              for row in rows])
+        skipped += len(rows) - len(msgs)
+        if pairer is not None:
+            pairer.prepare(msgs)
+            for msg_lng in msgs:
+                pairer.pair(msg_lng)
+        insert_chunk(msgs, checkpoint, rows[-1][0])
+        if progress is not None:
+            progress(len(rows))
+    return skipped
+
+
+# What the worker processes need. It is set before they are forked, so
+# they inherit it.
+_worker = {}
+
+
+def _import_shard(checkpoint_id):
+    pairer = _worker['pairer']
+    checkpoint = ImportCheckpoint.objects.get(pk=checkpoint_id)
+    if pairer is None:
+        skipped = import_range(checkpoint, _worker['reporters'], None,
+                               _worker['queue'].put)
+        return skipped, 0, 0
+    # A process may import several shards with the same pairer
+    paired, ambiguous = pairer.paired, pairer.ambiguous
+    skipped = import_range(checkpoint, _worker['reporters'], pairer,
+                           _worker['queue'].put)
+    return skipped, pairer.paired - paired, pairer.ambiguous - ambiguous
+
+
+def import_checkpoints(checkpoints, processes, reporters, pairer, progress):
+    '''
+    Imports the checkpoints, in this process or in a pool of worker
+    processes. Returns the number of messages skipped because they were
+    already in logger_ng.
+    '''
+    if processes == 1 or len(checkpoints) < 2:
+        skipped = 0
+        for checkpoint in checkpoints:
+            skipped += import_range(checkpoint, reporters, pairer,
+                                    progress.add)
+        return skipped
+
+    queue = multiprocessing.Queue()
+    _worker.update(reporters=reporters, pairer=pairer, queue=queue)
+    # Each process must open its own connection
+    connection.close()
+    pool = multiprocessing.Pool(processes)
     try:
-        reporter = PersistantConnection \
-                            .objects.get(backend__slug=msg.backend,
-                                         identity=msg.identity).reporter
-    except PersistantConnection.DoesNotExist:
-        reporter = None
-    msg_lng = LoggedMessage(identity=msg.identity, backend=msg.backend,
-                            text=msg.text, reporter=reporter,
-                            direction=direction)
-    msg_lng.save()
-    msg_lng.date = msg.date
-    msg_lng.save()
-    return msg_lng
+        results = pool.map_async(_import_shard,
+                                 [checkpoint.pk for checkpoint in checkpoints])
+        while not results.ready():
+            try:
+                progress.add(queue.get(timeout=1))
+            except Empty:
+                pass
+        counts = results.get()
+    except:
+        pool.terminate()
+        raise
+    pool.close()
+    pool.join()
+    while True:
+        try:
+            progress.add(queue.get_nowait())
+        except Empty:
+            break
+
+    if pairer is not None:
+        # The workers paired with their own copy of the pairer
+        pairer.paired += sum([count[1] for count in counts])
+        pairer.ambiguous += sum([count[2] for count in counts])
+    return sum([count[0] for count in counts])
 
 
 class Command(BaseCommand):
@@ -59,6 +376,26 @@ class Command(BaseCommand):
     This class _must_ be named command subclass BaseCommand to work.
     '''
 
+    option_list = BaseCommand.option_list + (
+        make_option('--window', type='int', dest='window', default=5,
+                    help='Pair an outgoing message with an incoming message '
+                         'sent at most that many seconds before. 0 disables '
+                         'pairing. Defaults to 5.'),
+        make_option('--ambiguous', dest='ambiguous', default='skip',
+                    choices=ResponsePairer.POLICIES,
+                    help='What to do when several incoming messages are in '
+                         'the window: skip (the default), latest or '
+                         'earliest.'),
+        make_option('--processes', type='int', dest='processes', default=1,
+                    help='Number of processes importing in parallel '
+                         '(PostgreSQL only). Defaults to 1.'),
+        make_option('--force', action='store_true', dest='force',
+                    default=False,
+                    help='Import even though the router seems to be running '
+                         'and the database isn\'t PostgreSQL. Only do this '
+                         'if the router doesn\'t batch or spool messages.'),
+    )
+
     def handle(self, *args, **options):
         '''
         Do the import, will be called when the management call of
@@ -72,67 +409,69 @@ class Command(BaseCommand):
         # identity on the same backend, we assume that the outgoing message
         # is a response to the incoming message and we set the response_to
         # of the outgoing message to the incoming message.
-        # If you don't want this behaviour, set this to 0.
-        SECONDS_BEFORE_MATCH = 5
+        # If you don't want this behaviour, use --window=0.
+        SECONDS_BEFORE_MATCH = options['window']
 
-        OUTGOING = LoggedMessage.DIRECTION_OUTGOING
-        INCOMING = LoggedMessage.DIRECTION_INCOMING
+        processes = max(options['processes'], 1)
+        if processes > 1 and backend_vendor() != 'postgresql':
+            raise CommandError(_(u"Importing with several processes needs " \
+                                 u"PostgreSQL."))
+
+        if backend_vendor() != 'postgresql' and not options['force'] and \
+           LoggedMessage.objects.filter(fingerprint__isnull=True,
+                                        date__gte=datetime.now() -
+                                        timedelta(minutes=ROUTER_ACTIVE)) \
+                                .count():
+            raise CommandError(_(u"The router logged messages in the last " \
+                                 u"%d minutes. Stop it before importing, " \
+                                 u"or use --force if it doesn't batch or " \
+                                 u"spool messages.") % ROUTER_ACTIVE)
 
         if not IncomingMessage.objects.count() and \
            not OutgoingMessage.objects.count():
             raise CommandError(_(u"There are no messages in the logger app " \
                                  u"to import."))
 
-        # First let's do a sanity check to see if we've already imported
-        # We choose 5 random incoming and outgoing messages. If any of them
-        # already exist in logger_ng, we exit without importing.
-        checks = []
-        for i in range(0, 5):
-            if IncomingMessage.objects.count():
-                checks.append(random.choice(IncomingMessage.objects.all()))
-            if OutgoingMessage.objects.count():
-                checks.append(random.choice(OutgoingMessage.objects.all()))
-
-        for msg in checks:
-            messages = LoggedMessage.objects.filter(identity=msg.identity,
-                                                    backend=msg.backend,
-                                                    text=msg.text,
-                                                    date=msg.date)
-            if (isinstance(msg, IncomingMessage) and \
-               messages.filter(direction=INCOMING).count()) or \
-               (isinstance(msg, OutgoingMessage) and \
-               messages.filter(direction=OUTGOING).count()):
-                raise CommandError(_(u"It appears that you have already " \
-                                     u"imported your messages."))
-
-        print _(u"Importing %d incoming messages...") % \
-              IncomingMessage.objects.count()
-        for msg in IncomingMessage.objects.all():
-            msg_lng = create_from_logger_msg(msg)
-            msg_lng.save()
-
-        print _(u"Importing %d outgoing messages...") % \
-              OutgoingMessage.objects.count()
-        count = 0
-        for msg in OutgoingMessage.objects.all():
-            msg_lng = create_from_logger_msg(msg)
-            if SECONDS_BEFORE_MATCH > 0:
-                just_before = msg.date - \
-                              timedelta(seconds=SECONDS_BEFORE_MATCH)
-                try:
-                    orig = LoggedMessage.incoming.get(identity=msg.identity,
-                                                      backend=msg.backend,
-                                                      date__gte=just_before,
-                                                      date__lte=msg.date)
-                except (LoggedMessage.DoesNotExist,
-                        LoggedMessage.MultipleObjectsReturned):
-                    pass
-                else:
-                    count += 1
-                    msg_lng.response_to = orig
-            msg_lng.save()
+        reporters = reporter_map()
+        pairer = None
 
-        print _(u"%d outgoing messages paired with " \
-                u"their incoming messages.") % count
+        for source in (ImportCheckpoint.SOURCE_INCOMING,
+                       ImportCheckpoint.SOURCE_OUTGOING):
+            model = SOURCES[source][0]
+            checkpoints = plan_checkpoints(source, processes)
+            total = sum([model.objects.filter(pk__gt=checkpoint.done_id,
+                                              pk__lte=checkpoint.last_id)
+                                      .count()
+                         for checkpoint in checkpoints])
+            print _(u"Importing %(count)d %(source)s messages...") % \
+                  {'count': total, 'source': source}
+            if not total:
+                continue
 
+            if source == ImportCheckpoint.SOURCE_OUTGOING and \
+               SECONDS_BEFORE_MATCH:
+                # All the incoming messages are in, the outgoing ones can
+                # be paired with them.
+                pairer = ResponsePairer(SECONDS_BEFORE_MATCH,
+                                        options['ambiguous'])
+
+            progress = Progress(source, total)
+            skipped = import_checkpoints(checkpoints, processes, reporters,
+                                         pairer, progress)
+            progress.finish()
+            if skipped:
+                print _(u"%d messages were already imported, " \
+                        u"skipped them.") % skipped
+
+        if pairer is None:
+            print _(u"Importing complete.")
+            return
+
+        print _(u"%d outgoing messages paired with " \
+                u"their incoming messages.") % pairer.paired
+        print _(u"%(count)d outgoing messages had several incoming " \
+                u"messages in the %(window)d seconds before them " \
+                u"(%(policy)s).") % \
+              {'count': pairer.ambiguous, 'window': SECONDS_BEFORE_MATCH,
+               'policy': options['ambiguous']}
         print _(u"Importing complete.")
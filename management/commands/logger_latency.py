@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Prints the percentiles of the time between incoming messages and their
+responses, from the ResponseLatency histograms (see latency.py):
+    ./rapidsms logger_latency [--since=YYYY-MM-DD] [--until=YYYY-MM-DD]
+                              [--backend=slug] [--by=total|day|hour]
+'''
+
+from datetime import datetime
+from optparse import make_option
+
+from django.utils.translation import ugettext as _
+from django.core.management.base import BaseCommand, CommandError
+
+from logger_ng import latency
+
+
+class Command(BaseCommand):
+    '''
+    This class _must_ be named command subclass BaseCommand to work.
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--since', dest='since',
+                    help='First day (YYYY-MM-DD).'),
+        make_option('--until', dest='until',
+                    help='Day after the last one (YYYY-MM-DD).'),
+        make_option('--backend', dest='backend',
+                    help='Only this backend.'),
+        make_option('--by', dest='by', default='total',
+                    choices=('total', 'day', 'hour'),
+                    help='total (the default), day or hour.'),
+    )
+    help = 'Prints the response time percentiles of logger_ng.'
+
+    def handle(self, *args, **options):
+        try:
+            since, until = [value and datetime.strptime(value, '%Y-%m-%d')
+                            for value in (options['since'],
+                                          options['until'])]
+        except ValueError:
+            raise CommandError(_(u"Dates must be given as YYYY-MM-DD"))
+
+        rows = latency.load(since, until, options['backend'])
+        if not rows:
+            print _(u"No response recorded.")
+            return
+
+        print "%-16s %-15s %9s %9s %9s %9s %9s" % \
+              ('start', 'backend', 'responses', 'p50 (s)', 'p90 (s)',
+               'p99 (s)', 'max (s)')
+        for backend, start, histogram in latency.summarize(rows,
+                                                           options['by']):
+            stats = histogram.stats()
+            print "%-16s %-15s %9d %9.1f %9.1f %9.1f %9.1f" % \
+                  (start and start.strftime('%Y-%m-%d %H:%M') or 'all',
+                   backend, stats['count'], stats['p50'], stats['p90'],
+                   stats['p99'], stats['max'])
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Shows the instrumentation of the router's message path (see
+instrument.py), from the snapshot the router writes to its stats_path:
+    ./rapidsms logger_stats [--path=file] [--json]
+
+The path defaults to the LOGGER_NG_STATS_PATH setting.
+'''
+
+import sys
+import time
+from optparse import make_option
+
+from django.conf import settings
+from django.utils import simplejson
+from django.utils.translation import ugettext as _
+from django.core.management.base import BaseCommand, CommandError
+
+from logger_ng.instrument import STAGES, read_snapshot
+
+
+class Command(BaseCommand):
+    '''
+    This class _must_ be named command subclass BaseCommand to work.
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--path', dest='path',
+                    default=getattr(settings, 'LOGGER_NG_STATS_PATH', None),
+                    help='The stats_path of the router. Defaults to the '
+                         'LOGGER_NG_STATS_PATH setting.'),
+        make_option('--json', action='store_true', dest='json',
+                    default=False,
+                    help='Print the snapshot as JSON.'),
+    )
+    help = "Shows the timers and counters of the logger_ng app."
+
+    def handle(self, *args, **options):
+        if not options['path']:
+            raise CommandError(_(u"Give the stats_path of the router with " \
+                                 u"--path, or set LOGGER_NG_STATS_PATH."))
+        data = read_snapshot(options['path'])
+        if data is None:
+            raise CommandError(_(u"%s doesn't exist yet. Is instrument " \
+                                 u"enabled and stats_path set in " \
+                                 u"local.ini?") % options['path'])
+        if options['json']:
+            simplejson.dump(data, sys.stdout, indent=2, sort_keys=True)
+            sys.stdout.write('\n')
+            return
+
+        print _(u"Written %(age)ds ago, %(uptime)ds after the router " \
+                u"started.") % \
+              {'age': time.time() - data['written'],
+               'uptime': data['written'] - data['started']}
+        print
+        print "%-18s %10s %10s %10s %10s %10s %10s" % \
+              (_(u"stage (us)"), _(u"count"), _(u"mean"), _(u"p50"),
+               _(u"p90"), _(u"p99"), _(u"max"))
+        for stage in STAGES:
+            stats = data['timers_us'].get(stage)
+            if stats is None:
+                continue
+            print "%-18s %10d %10.1f %10.1f %10.1f %10.1f %10.1f" % \
+                  (stage, stats['count'], stats['mean'], stats['p50'],
+                   stats['p90'], stats['p99'], stats['max'])
+
+        for title, key in ((_(u"Counters"), 'counters'),
+                           (_(u"Reporter cache"), 'reporter_cache'),
+                           (_(u"Writer"), 'writer'),
+                           (_(u"Spool"), 'spool'),
+                           (_(u"Live tail"), 'live')):
+            if not data.get(key):
+                continue
+            print
+            print title
+            for name, value in sorted(data[key].items()):
+                print "    %-16s %s" % (name, value)
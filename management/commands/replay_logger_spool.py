@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Replays the logger_ng spool journal into the LoggedMessage table.
+
+The router replays the journal by itself once the database is back, so
+this is only needed if the router was stopped before that happened, or to
+import a journal copied from another machine. Run it with:
+    ./rapidsms replay_logger_spool <path to the spool_path journal>
+
+Messages that are already in the table are skipped, so it is safe to run
+while the router is running, or to run it twice.
+'''
+
+import os
+
+from django.utils.translation import ugettext as _
+from django.core.management.base import BaseCommand, CommandError
+
+from logger_ng.spool import replay_journal
+
+
+class Command(BaseCommand):
+    '''
+    This class _must_ be named command subclass BaseCommand to work.
+    '''
+
+    args = '<journal path>'
+    help = 'Replays the logger_ng spool journal into the database.'
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError(_(u"Usage: ./rapidsms replay_logger_spool " \
+                                 u"<journal path>"))
+        path = args[0]
+        if not os.path.exists(path) and \
+           not os.path.exists(path + '.replaying'):
+            raise CommandError(_(u"There is no journal at %s") % path)
+
+        print _(u"%d messages replayed.") % replay_journal(path)
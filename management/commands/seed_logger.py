@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Fills the message log with realistic fake messages, to reproduce how the
+log view behaves at scale (see benchmark_logger_views):
+    ./rapidsms seed_logger [--messages=1000000] [--phones=50000]
+                           [--known=0.6] [--replies=0.7] [--days=365]
+                           [--skew=1.1] [--seed=0]
+    ./rapidsms seed_logger --delete
+
+Incoming messages come from --phones phones, a --known fraction of which
+have a reporter, with a Zipf distribution (exponent --skew): a few phones
+send most of the messages, as in real deployments. They are spread over
+the last --days days, and a --replies fraction of them get a threaded
+response. Most texts are reports starting with a handful of keywords;
+RARE_WORD appears in about one message in RARE_RATE, for rare searches.
+
+Messages are written CHUNK_SIZE at a time with one executemany, so
+millions of them take minutes. Everything is created on the SEED_BACKENDS
+backends, and deleted by --delete. The rollups, identity summaries and
+conversations of the seeded messages are made with the backfill_logger_*
+commands.
+'''
+
+import random
+import bisect
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.db import connection, transaction
+from django.utils.translation import ugettext as _
+from django.core.management.base import BaseCommand, CommandError
+
+from reporters.models import Reporter, PersistantBackend, \
+                             PersistantConnection
+
+from logger_ng.batch import IdAllocator
+from logger_ng.benchmark import Progress
+from logger_ng.db import bulk_insert
+from logger_ng.models import LoggedMessage
+
+
+SEED_BACKENDS = ['seed_gsm', 'seed_http']
+
+# Usernames of the seeded reporters start with this
+REPORTER_PREFIX = 'logger_ng_seed_'
+
+CHUNK_SIZE = 5000
+
+RARE_WORD = u"cholera"
+RARE_RATE = 100000
+
+# (weight, keyword, template) of incoming messages
+KEYWORDS = [(40, u"report", u"report %(a)d %(b)d %(c)d"),
+            (15, u"stock", u"stock %(a)d bags %(b)d boxes"),
+            (10, u"cases", u"cases %(a)d %(b)d %(c)d %(d)d"),
+            (8, u"join", u"join %(name)s"),
+            (5, u"help", u"help"),
+            (22, None, u"%(name)s %(a)d")]
+
+NAMES = [u"John Doe", u"Mary", u"Kofi", u"Amina", u"Peter", u"Grace",
+         u"clinic", u"village", u"ok", u"thanks"]
+
+# (weight, status) of incoming messages, and of responses
+INCOMING_STATUSES = [(70, LoggedMessage.STATUS_SUCCESS),
+                     (12, LoggedMessage.STATUS_PARSE_ERRROR),
+                     (5, LoggedMessage.STATUS_BAD_VALUE),
+                     (13, None)]
+RESPONSE_STATUSES = [(75, LoggedMessage.STATUS_SUCCESS),
+                     (15, LoggedMessage.STATUS_ERROR),
+                     (10, LoggedMessage.STATUS_INFO)]
+
+RESPONSES = [u"Thank you, your report was received.",
+             u"Sorry, we didn't understand your message.",
+             u"Welcome %(name)s!"]
+
+
+def weighted(choices):
+    '''
+    Returns a function picking a value from a list of (weight, value...)
+    tuples, at random, in proportion to the weights.
+    '''
+    totals = []
+    total = 0
+    for choice in choices:
+        total += choice[0]
+        totals.append(total)
+
+    def pick():
+        return choices[bisect.bisect(totals, random.random() * total)]
+    return pick
+
+
+def zipf(count, exponent):
+    '''
+    Returns a function picking an index from 0 to count - 1 at random, the
+    first ones much more often than the last ones.
+    '''
+    return weighted([(1.0 / (rank + 1) ** exponent, rank)
+                     for rank in xrange(count)])
+
+
+pick_keyword = weighted(KEYWORDS)
+pick_incoming_status = weighted(INCOMING_STATUSES)
+pick_response_status = weighted(RESPONSE_STATUSES)
+
+
+def random_text():
+    values = {'a': random.randint(0, 50), 'b': random.randint(0, 20),
+              'c': random.randint(0, 9), 'd': random.randint(0, 9),
+              'name': random.choice(NAMES)}
+    text = pick_keyword()[2] % values
+    if random.randint(1, RARE_RATE) == 1:
+        text = u"%s %s" % (text, RARE_WORD)
+    return text
+
+
+@transaction.commit_on_success
+def create_phones(first, count, known):
+    '''
+    Creates `count` phones from number `first`, a `known` fraction of them
+    with a reporter. Returns a list of (backend, identity, reporter id).
+    '''
+    backends = dict([(slug, PersistantBackend.objects.get_or_create(
+                                                            slug=slug)[0])
+                     for slug in SEED_BACKENDS])
+    phones = []
+    for i in xrange(first, first + count):
+        slug = random.choice(SEED_BACKENDS)
+        identity = '+2547%08d' % i
+        reporter_id = None
+        if random.random() < known:
+            reporter = Reporter.objects.create(
+                                    username='%s%d' % (REPORTER_PREFIX, i),
+                                    first_name=random.choice(NAMES[:6]),
+                                    last_name=u"Seed %d" % i)
+            PersistantConnection.objects.create(backend=backends[slug],
+                                                identity=identity,
+                                                reporter=reporter)
+            reporter_id = reporter.pk
+        phones.append((slug, identity, reporter_id))
+    return phones
+
+
+@transaction.commit_on_success
+def insert_chunk(msgs):
+    bulk_insert(msgs)
+
+
+@transaction.commit_on_success
+def delete_seeded():
+    '''
+    Deletes the seeded messages, phones and reporters.
+    '''
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM %s WHERE backend IN (%s)" %
+                   (connection.ops.quote_name(LoggedMessage._meta.db_table),
+                    ', '.join(['%s'] * len(SEED_BACKENDS))),
+                   SEED_BACKENDS)
+    deleted = cursor.rowcount
+    PersistantConnection.objects.filter(backend__slug__in=SEED_BACKENDS) \
+                                .delete()
+    Reporter.objects.filter(username__startswith=REPORTER_PREFIX).delete()
+    PersistantBackend.objects.filter(slug__in=SEED_BACKENDS).delete()
+    return deleted
+
+
+class Command(BaseCommand):
+    '''
+    This class _must_ be named command subclass BaseCommand to work.
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--messages', type='int', dest='messages',
+                    default=1000000,
+                    help='Number of incoming messages. Defaults to '
+                         '1000000.'),
+        make_option('--phones', type='int', dest='phones', default=50000,
+                    help='Number of phones. Defaults to 50000.'),
+        make_option('--known', type='float', dest='known', default=0.6,
+                    help='Fraction of the phones with a reporter. Defaults '
+                         'to 0.6.'),
+        make_option('--replies', type='float', dest='replies', default=0.7,
+                    help='Fraction of the messages with a response. '
+                         'Defaults to 0.7.'),
+        make_option('--days', type='int', dest='days', default=365,
+                    help='Number of days the messages are spread over. '
+                         'Defaults to 365.'),
+        make_option('--skew', type='float', dest='skew', default=1.1,
+                    help='Exponent of the Zipf distribution of the phones. '
+                         'Defaults to 1.1.'),
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help='Random seed, so that the same log can be seeded '
+                         'again. Defaults to 0.'),
+        make_option('--delete', action='store_true', dest='delete',
+                    default=False,
+                    help='Delete the seeded messages, phones and reporters '
+                         'instead.'),
+    )
+    help = 'Fills the logger_ng log with realistic fake messages.'
+
+    def handle(self, *args, **options):
+        if options['delete']:
+            print _(u"%d seeded messages deleted.") % delete_seeded()
+            return
+
+        if PersistantBackend.objects.filter(slug__in=SEED_BACKENDS).count():
+            raise CommandError(_(u"The log is already seeded, use --delete " \
+                                 u"first."))
+        if options['phones'] < 1 or options['messages'] < 1:
+            raise CommandError(_(u"There must be at least one phone and " \
+                                 u"one message."))
+        random.seed(options['seed'])
+
+        phones = []
+        progress = Progress(_(u"Phones"), options['phones'])
+        while len(phones) < options['phones']:
+            count = min(1000, options['phones'] - len(phones))
+            phones.extend(create_phones(len(phones), count,
+                                        options['known']))
+            progress.add(count)
+        progress.finish()
+        # The busiest phones are spread over the backends and reporters
+        random.shuffle(phones)
+        pick_phone = zipf(len(phones), options['skew'])
+
+        count = options['messages']
+        date = datetime.now() - timedelta(days=options['days'])
+        gap = options['days'] * 86400.0 / count
+        allocator = IdAllocator(CHUNK_SIZE)
+        msgs = []
+        progress = Progress(_(u"Messages"), count)
+        for i in xrange(count):
+            date += timedelta(seconds=random.expovariate(1 / gap))
+            backend, identity, reporter_id = phones[pick_phone()[1]]
+            msg = LoggedMessage(id=allocator.next_id(), date=date,
+                                direction=LoggedMessage.DIRECTION_INCOMING,
+                                text=random_text(), backend=backend,
+                                identity=identity, reporter_id=reporter_id,
+                                status=pick_incoming_status()[1])
+            msgs.append(msg)
+            if random.random() < options['replies']:
+                msgs.append(LoggedMessage(
+                        id=allocator.next_id(),
+                        date=date + timedelta(seconds=random.randint(1, 90)),
+                        direction=LoggedMessage.DIRECTION_OUTGOING,
+                        text=random.choice(RESPONSES) %
+                                {'name': random.choice(NAMES)},
+                        backend=backend, identity=identity,
+                        reporter_id=reporter_id,
+                        status=pick_response_status()[1],
+                        response_to_id=msg.id))
+            if len(msgs) >= CHUNK_SIZE:
+                insert_chunk(msgs)
+                msgs = []
+                progress.add(i + 1 - progress.done)
+        if msgs:
+            insert_chunk(msgs)
+        progress.add(count - progress.done)
+        progress.finish()
+
+        print _(u"Seeded %(messages)d messages from %(phones)d phones. Run " \
+                u"the backfill_logger_rollups, backfill_logger_identities " \
+                u"and backfill_logger_conversations commands to summarize " \
+                u"them.") % {'messages': count, 'phones': len(phones)}
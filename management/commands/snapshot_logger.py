@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Writes a columnar snapshot of the logger_ng message log, for analysis with
+NumPy (see snapshot.py):
+    ./rapidsms snapshot_logger path/to/snapshot [--rebuild]
+
+The first run writes the whole log, and the next ones only append the
+messages logged since. --rebuild starts over, to pick up the statuses of
+messages tagged after they were snapshotted. Requires NumPy.
+'''
+
+import os
+import sys
+from optparse import make_option
+
+from django.utils.translation import ugettext as _
+from django.core.management.base import BaseCommand, CommandError
+
+from logger_ng import snapshot
+
+
+class Command(BaseCommand):
+    '''
+    This class _must_ be named command subclass BaseCommand to work.
+    '''
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', dest='rebuild',
+                    default=False,
+                    help='Rewrite the whole snapshot instead of appending '
+                         'the new messages.'),
+    )
+    args = 'path'
+    help = 'Writes or updates a columnar snapshot of the logger_ng log.'
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError(_(u"Give the directory of the snapshot."))
+        if snapshot.numpy is None:
+            raise CommandError(_(u"Snapshots require NumPy, which is not " \
+                                 u"installed."))
+        path = args[0]
+        if os.path.exists(path) and not os.path.isdir(path):
+            raise CommandError(_(u"%s is not a directory.") % path)
+
+        if options['rebuild'] and os.path.isdir(path):
+            names = [column + '.bin' for column, dtype in snapshot.COLUMNS] + \
+                    snapshot.TEXT_DICTIONARIES.values() + ['meta.json']
+            for name in names:
+                if os.path.exists(os.path.join(path, name)):
+                    os.remove(os.path.join(path, name))
+
+        def progress(count):
+            sys.stdout.write(_(u"\r%d messages written") % count)
+            sys.stdout.flush()
+
+        try:
+            count = snapshot.update(path, progress=progress)
+        except ValueError, e:
+            raise CommandError(unicode(e))
+        if count:
+            sys.stdout.write('\n')
+        print _(u"%(count)d messages appended, %(total)d in the snapshot.") % \
+              {'count': count, 'total': len(snapshot.load(path))}
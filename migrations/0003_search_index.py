@@ -0,0 +1,168 @@
+# encoding: utf-8
+import datetime
+from south.db import db
+from south.v2 import SchemaMigration
+from django.db import models
+
+from logger_ng.db import backend_vendor
+
+
+# The indexed document is the identity, the text, and the name of the
+# reporter (auth_user, since Reporter inherits from User) at the time the
+# message was logged. The 'simple' configuration doesn't stem, since messages
+# are in many languages.
+PG_DOCUMENT = """to_tsvector('simple',
+    coalesce(%(row)s.identity, '') || ' ' || coalesce(%(row)s.text, '') || ' ' ||
+    coalesce((SELECT first_name || ' ' || last_name FROM auth_user
+              WHERE id = %(row)s.reporter_id), ''))"""
+
+SQLITE_INSERT = """INSERT INTO logger_ng_search (rowid, identity, text, names)
+    VALUES (NEW.id, NEW.identity, NEW.text,
+            (SELECT first_name || ' ' || last_name FROM auth_user
+             WHERE id = NEW.reporter_id));"""
+
+
+class Migration(SchemaMigration):
+
+    def forwards(self, orm):
+        
+        # Full text index on the messages, kept up to date by triggers so
+        # that bulk inserts are indexed too. Other backends keep using
+        # plain LIKE searches.
+        vendor = backend_vendor()
+        if vendor == 'postgresql':
+            db.execute("ALTER TABLE logger_ng_loggedmessage "
+                       "ADD COLUMN search_vector tsvector")
+            db.execute("UPDATE logger_ng_loggedmessage SET search_vector = " +
+                       PG_DOCUMENT % {'row': 'logger_ng_loggedmessage'})
+            db.execute("CREATE INDEX logger_ng_loggedmessage_search "
+                       "ON logger_ng_loggedmessage USING gin(search_vector)")
+            db.execute("""CREATE OR REPLACE FUNCTION logger_ng_search_update()
+                          RETURNS trigger AS $$
+                          BEGIN
+                              NEW.search_vector := """ +
+                              PG_DOCUMENT % {'row': 'NEW'} + """;
+                              RETURN NEW;
+                          END
+                          $$ LANGUAGE plpgsql""")
+            db.execute("CREATE TRIGGER logger_ng_search_update "
+                       "BEFORE INSERT OR UPDATE OF identity, text, reporter_id "
+                       "ON logger_ng_loggedmessage FOR EACH ROW "
+                       "EXECUTE PROCEDURE logger_ng_search_update()")
+
+        elif vendor == 'sqlite':
+            try:
+                db.execute("CREATE VIRTUAL TABLE logger_ng_search "
+                           "USING fts5(identity, text, names)")
+            except Exception:
+                # This SQLite wasn't compiled with FTS5
+                return
+            db.execute("CREATE TRIGGER logger_ng_search_insert AFTER INSERT "
+                       "ON logger_ng_loggedmessage BEGIN " +
+                       SQLITE_INSERT + " END")
+            db.execute("CREATE TRIGGER logger_ng_search_update AFTER UPDATE "
+                       "OF identity, text, reporter_id "
+                       "ON logger_ng_loggedmessage BEGIN "
+                       "DELETE FROM logger_ng_search WHERE rowid = OLD.id; " +
+                       SQLITE_INSERT + " END")
+            db.execute("CREATE TRIGGER logger_ng_search_delete AFTER DELETE "
+                       "ON logger_ng_loggedmessage BEGIN "
+                       "DELETE FROM logger_ng_search WHERE rowid = OLD.id; "
+                       "END")
+            db.execute("""INSERT INTO logger_ng_search
+                              (rowid, identity, text, names)
+                          SELECT m.id, m.identity, m.text,
+                                 u.first_name || ' ' || u.last_name
+                          FROM logger_ng_loggedmessage m
+                          LEFT JOIN auth_user u ON u.id = m.reporter_id""")
+
+
+    def backwards(self, orm):
+        
+        vendor = backend_vendor()
+        if vendor == 'postgresql':
+            db.execute("DROP TRIGGER IF EXISTS logger_ng_search_update "
+                       "ON logger_ng_loggedmessage")
+            db.execute("DROP FUNCTION IF EXISTS logger_ng_search_update()")
+            db.execute("ALTER TABLE logger_ng_loggedmessage "
+                       "DROP COLUMN search_vector")
+        elif vendor == 'sqlite':
+            for trigger in ('insert', 'update', 'delete'):
+                db.execute("DROP TRIGGER IF EXISTS logger_ng_search_%s" %
+                           trigger)
+            db.execute("DROP TABLE IF EXISTS logger_ng_search")
+
+
+    models = {
+        'auth.group': {
+            'Meta': {'object_name': 'Group'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '80'}),
+            'permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'})
+        },
+        'auth.permission': {
+            'Meta': {'unique_together': "(('content_type', 'codename'),)", 'object_name': 'Permission'},
+            'codename': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'content_type': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['contenttypes.ContentType']"}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '50'})
+        },
+        'auth.user': {
+            'Meta': {'object_name': 'User'},
+            'date_joined': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'email': ('django.db.models.fields.EmailField', [], {'max_length': '75', 'blank': 'True'}),
+            'first_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'groups': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Group']", 'symmetrical': 'False', 'blank': 'True'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'is_active': ('django.db.models.fields.BooleanField', [], {'default': 'True', 'blank': 'True'}),
+            'is_staff': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'is_superuser': ('django.db.models.fields.BooleanField', [], {'default': 'False', 'blank': 'True'}),
+            'last_login': ('django.db.models.fields.DateTimeField', [], {'default': 'datetime.datetime.now'}),
+            'last_name': ('django.db.models.fields.CharField', [], {'max_length': '30', 'blank': 'True'}),
+            'password': ('django.db.models.fields.CharField', [], {'max_length': '128'}),
+            'user_permissions': ('django.db.models.fields.related.ManyToManyField', [], {'to': "orm['auth.Permission']", 'symmetrical': 'False', 'blank': 'True'}),
+            'username': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'})
+        },
+        'contenttypes.contenttype': {
+            'Meta': {'unique_together': "(('app_label', 'model'),)", 'object_name': 'ContentType', 'db_table': "'django_content_type'"},
+            'app_label': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'model': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'locations.location': {
+            'Meta': {'object_name': 'Location'},
+            'code': ('django.db.models.fields.CharField', [], {'unique': 'True', 'max_length': '30'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'latitude': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '8', 'decimal_places': '6', 'blank': 'True'}),
+            'longitude': ('django.db.models.fields.DecimalField', [], {'null': 'True', 'max_digits': '8', 'decimal_places': '6', 'blank': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'parent': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'children'", 'null': 'True', 'to': "orm['locations.Location']"}),
+            'type': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'locations'", 'null': 'True', 'to': "orm['locations.LocationType']"})
+        },
+        'locations.locationtype': {
+            'Meta': {'object_name': 'LocationType'},
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'name': ('django.db.models.fields.CharField', [], {'max_length': '100'})
+        },
+        'logger_ng.loggedmessage': {
+            'Meta': {'object_name': 'LoggedMessage'},
+            'backend': ('django.db.models.fields.CharField', [], {'max_length': '75'}),
+            'date': ('django.db.models.fields.DateTimeField', [], {'auto_now_add': 'True', 'blank': 'True'}),
+            'direction': ('django.db.models.fields.CharField', [], {'max_length': '1'}),
+            'id': ('django.db.models.fields.AutoField', [], {'primary_key': 'True'}),
+            'identity': ('django.db.models.fields.CharField', [], {'max_length': '100'}),
+            'reporter': ('django.db.models.fields.related.ForeignKey', [], {'to': "orm['reporters.Reporter']", 'null': 'True', 'blank': 'True'}),
+            'response_to': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'response'", 'null': 'True', 'to': "orm['logger_ng.LoggedMessage']"}),
+            'status': ('django.db.models.fields.CharField', [], {'max_length': '32', 'null': 'True', 'blank': 'True'}),
+            'text': ('django.db.models.fields.TextField', [], {})
+        },
+        'reporters.reporter': {
+            'Meta': {'object_name': 'Reporter', '_ormbases': ['auth.User']},
+            'language': ('django.db.models.fields.CharField', [], {'max_length': '10', 'blank': 'True'}),
+            'location': ('django.db.models.fields.related.ForeignKey', [], {'blank': 'True', 'related_name': "'reporters'", 'null': 'True', 'to': "orm['locations.Location']"}),
+            'user_ptr': ('django.db.models.fields.related.OneToOneField', [], {'to': "orm['auth.User']", 'unique': 'True', 'primary_key': 'True'})
+        }
+    }
+
+    complete_apps = ['logger_ng']
@@ -4,14 +4,53 @@
 
 '''
 Defines the LoggedMessage model and two custom managers, (OutgoingManager and
-IncomingManager
+IncomingManager), the ImportCheckpoint model used by import_from_logger, and
+the TrafficRollup, ResponseLatency and IdentitySummary statistics models
 '''
 
-from django.db import models
+import time
+import hashlib
+import threading
+from datetime import datetime
+
+from django.db import models, transaction, DatabaseError
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext as _
 
 from reporters.models import Reporter, PersistantConnection
 
+from logger_ng import instrument
+from logger_ng.libs.lru import LRUCache, MISSING
+
+
+# Maps (backend slug, identity) to the id of the reporter using that
+# connection, or None if there isn't one, so that create_from_message doesn't
+# query PersistantConnection for every message. Entries are dropped when a
+# connection or reporter is saved or deleted in this process. They also
+# expire after a while, for changes made in another process (i.e. the web
+# interface while this runs in the router). The router sets the size and
+# the ttl from local.ini.
+reporter_cache = LRUCache(max_size=1000, ttl=300)
+
+# The condition of the messages shown in the log view: all but the outgoing
+# messages responding to another, which are shown threaded beneath it.
+# Django would pass 'O' as a parameter, and SQLite only uses the partial
+# index logger_ng_lm_page (see migration 0004) for a literal condition, so
+# the log view adds it with extra(where=...).
+NOT_THREADED = "NOT (logger_ng_loggedmessage.direction = 'O' AND " \
+               "logger_ng_loggedmessage.response_to_id IS NOT NULL)"
+
+
+def message_fingerprint(direction, backend, identity, date, text):
+    '''
+    Returns a hash of the fields that identify a message, as 32 hex digits.
+    Two messages with the same fingerprint are the same message, logged
+    twice.
+    '''
+    fields = [direction, backend, identity,
+              date.strftime('%Y-%m-%d %H:%M:%S.%f'), text or u'']
+    return hashlib.md5(u'\x00'.join(fields).encode('utf-8')).hexdigest()
+
 
 class OutgoingManager(models.Manager):
     '''
@@ -48,6 +87,22 @@ class LoggedMessage(models.Model):
         response_to - recursive foreignkey to self. Only used for outgoing
                       messages. Points to the LoggedMessage to which the
                       outgoing message is a response.
+        fingerprint - message_fingerprint() of the message. Set for the
+                      messages imported from the old logger app, so that
+                      import_from_logger can tell which ones it already
+                      imported, and for every message logged before
+                      migration 0007.
+        conversation - id of the first message of the conversation this
+                       message is part of (see conversation.py)
+        modified    - when the message was last saved, tagged or put in a
+                      conversation, for the ETags of views.api_messages.
+                      Messages logged before migration 0012 have none until
+                      they change.
+
+    The indexes that the log view, the threaded responses and the lookups
+    by identity rely on are created by migration 0004, the one for loading
+    conversations by migration 0010. Check that they are
+    used with ./rapidsms check_logger_indexes
 
     Besides the default manager (objects) this model has to custom managers
     for your convenience:
@@ -128,6 +183,13 @@ class LoggedMessage(models.Model):
                                     related_name='response', blank=True,
                                     null=True)
 
+    fingerprint = models.CharField(_(u"fingerprint"), max_length=32,
+                                   blank=True, null=True, db_index=True)
+    conversation = models.IntegerField(_(u"conversation"), blank=True,
+                                       null=True)
+    modified = models.DateTimeField(_(u"modified"), auto_now=True,
+                                    blank=True, null=True, db_index=True)
+
     #Setup a default manager
     objects = models.Manager()
 
@@ -180,6 +242,21 @@ class LoggedMessage(models.Model):
                   'text': self.text}
 
 
+    def to_dict(self):
+        '''
+        Returns the fields of the message as a JSON serializable dict.
+        '''
+        return {'id': self.pk,
+                'date': self.date and self.date.strftime('%Y-%m-%d %H:%M:%S'),
+                'direction': self.direction,
+                'backend': self.backend,
+                'identity': self.identity,
+                'text': self.text,
+                'status': self.status,
+                'response_to': self.response_to_id,
+                'conversation': self.conversation}
+
+
     @classmethod
     def create_from_message(cls, message):
         '''
@@ -194,23 +271,61 @@ class LoggedMessage(models.Model):
         reporters app has handled the message, and we assume we want the
         logger_ng app to be the _first_ app in our local.ini.
         '''
+        instruments = instrument.current
+        if instruments is not None:
+            started = time.time()
+
         backend_slug = message.connection.backend.slug
         identity = message.connection.identity
-        try:
-            reporter = PersistantConnection \
-                                .objects.get(backend__slug=backend_slug,
-                                             identity=identity).reporter
-        except PersistantConnection.DoesNotExist:
-            reporter = None
-
+        reporter_id = reporter_cache.get((backend_slug, identity))
+        if reporter_id is MISSING:
+            try:
+                reporter_id = PersistantConnection \
+                                    .objects.get(backend__slug=backend_slug,
+                                                 identity=identity).reporter_id
+            except PersistantConnection.DoesNotExist:
+                reporter_id = None
+                reporter_cache.set((backend_slug, identity), None)
+            except DatabaseError:
+                # Log the message without its reporter rather than not at
+                # all, if the database is down (see spool.py)
+                transaction.rollback_unless_managed()
+                reporter_id = None
+            else:
+                reporter_cache.set((backend_slug, identity), reporter_id)
+
+        if instruments is not None:
+            built = time.time()
+            instruments.time('reporter_lookup', started)
         msg = LoggedMessage(text=message.text,
                             backend=backend_slug,
                             identity=identity,
-                            reporter=reporter,
+                            reporter_id=reporter_id,
                             status=message.status)
+        if instruments is not None:
+            instruments.time('build', built)
         return msg
 
 
+    @classmethod
+    def attach_responses(cls, msgs):
+        '''
+        Fetches the responses to all the given messages with one query, and
+        sets them, oldest first, as the `responses` attribute of each
+        message. This is much cheaper than msg.response.all() for a list of
+        messages, which does one query per message.
+        '''
+        by_id = {}
+        for msg in msgs:
+            msg.responses = []
+            by_id[msg.pk] = msg
+        if not by_id:
+            return
+        for response in cls.objects.filter(response_to__in=by_id.keys()) \
+                                   .order_by('date', 'id'):
+            by_id[response.response_to_id].responses.append(response)
+
+
     @classmethod
     def tag_message(cls, message, status):
         '''
@@ -228,18 +343,227 @@ class LoggedMessage(models.Model):
         LoggedMessage.tag_message(message, LoggedMessage.STATUS_SUCCESS)
 
         This will use the logger_id watermark in the Message object to
-        lookup the corresponding LoggedMessage object and set its status
-        accordingly.
+        update the status of the corresponding LoggedMessage, with a single
+        UPDATE query (plus a SELECT of its old status when the router keeps
+        the traffic rollups and the message wasn't logged recently, see
+        rollup.py).
+
+        If your app may tag the same message several times while handling
+        it, use defer_tag instead.
         '''
         if not hasattr(message, 'logger_id'):
             return
-        try:
-            msg = cls.objects.get(pk=message.logger_id)
-        except cls.DoesNotExist:
-            # If a LoggedMessage doesn't exist, we can't tag it. We'll just
-            # fail silently.
+
+        instruments = instrument.current
+        if instruments is not None:
+            started = time.time()
+            instruments.count('tags')
+
+        from logger_ng import rollup
+        rollup.record_tags({message.logger_id: status})
+
+        # If the message is still waiting in the write-behind buffer or in
+        # the spool, tag it there.
+        from logger_ng import batch
+        if not batch.tag_pending(message.logger_id, status):
+            # If a LoggedMessage doesn't exist, this doesn't update anything
+            # and we just fail silently.
+            cls.objects.filter(pk=message.logger_id) \
+                       .update(status=status, modified=datetime.now())
+
+        if instruments is not None:
+            instruments.time('tag', started)
+
+
+    @classmethod
+    def defer_tag(cls, message, status):
+        '''
+        Same as tag_message, except the status is only written at the end of
+        the router cycle (when the logger_ng app's cleanup is called), along
+        with all the other deferred tags. If a message is tagged more than
+        once, only the last status is written.
+        '''
+        if not hasattr(message, 'logger_id'):
             return
+        _deferred_tags_lock.acquire()
+        try:
+            _deferred_tags[message.logger_id] = status
+        finally:
+            _deferred_tags_lock.release()
+
+
+    @classmethod
+    def apply_deferred_tags(cls):
+        '''
+        Writes the tags collected by defer_tag, with one UPDATE query per
+        status value. Returns the number of messages tagged.
+        '''
+        global _deferred_tags
+        _deferred_tags_lock.acquire()
+        try:
+            tags, _deferred_tags = _deferred_tags, {}
+        finally:
+            _deferred_tags_lock.release()
+        if not tags:
+            return 0
+
+        instruments = instrument.current
+        if instruments is not None:
+            started = time.time()
+            instruments.count('tags', len(tags))
+
+        from logger_ng import batch, rollup
+        rollup.record_tags(tags)
+        by_status = {}
+        for pk, status in tags.iteritems():
+            if batch.tag_pending(pk, status):
+                continue
+            by_status.setdefault(status, []).append(pk)
+
+        for status, pks in by_status.iteritems():
+            cls.objects.filter(pk__in=pks).update(status=status,
+                                                  modified=datetime.now())
+
+        if instruments is not None:
+            instruments.time('tag', started)
+        return len(tags)
+
+
+class ImportCheckpoint(models.Model):
+    '''
+    Records how far ./rapidsms import_from_logger got, so that an
+    interrupted import resumes where it stopped, and later runs only import
+    the messages logged since. Each checkpoint covers a range of ids of one
+    of the old logger tables:
+        source   - SOURCE_INCOMING or SOURCE_OUTGOING
+        first_id - first id of the range
+        last_id  - last id of the range
+        done_id  - id of the last message of the range imported so far. It
+                   is updated in the same transaction as the messages are
+                   inserted, so it is never ahead or behind them.
+    '''
+
+    SOURCE_INCOMING = 'incoming'
+    SOURCE_OUTGOING = 'outgoing'
+
+    source = models.CharField(max_length=8)
+    first_id = models.IntegerField()
+    last_id = models.IntegerField()
+    done_id = models.IntegerField()
+
+
+    def is_done(self):
+        return self.done_id >= self.last_id
+
+
+    def __unicode__(self):
+        return u"%(source)s %(first)d-%(last)d (%(done)d)" % \
+               {'source': self.source, 'first': self.first_id,
+                'last': self.last_id, 'done': self.done_id}
+
 
-        msg.status = status
-        msg.save()
-        
+class TrafficRollup(models.Model):
+    '''
+    Number of messages logged per hour and per day, by backend, direction
+    and status, kept up to date by the router (see rollup.py), so that
+    traffic statistics don't need to count the log:
+        period    - PERIOD_HOUR or PERIOD_DAY
+        start     - start of the hour or day
+        backend   - the backend slug
+        direction - DIRECTION_INCOMING or DIRECTION_OUTGOING
+        status    - the status of the messages, '' for none
+        count     - number of messages
+    '''
+
+    class Meta:
+        unique_together = (('period', 'start', 'backend', 'direction',
+                            'status'),)
+
+
+    PERIOD_HOUR = 'H'
+    PERIOD_DAY = 'D'
+
+    period = models.CharField(max_length=1)
+    start = models.DateTimeField()
+    backend = models.CharField(max_length=75)
+    direction = models.CharField(max_length=1)
+    status = models.CharField(max_length=32, blank=True)
+    count = models.IntegerField(default=0)
+
+
+class ResponseLatency(models.Model):
+    '''
+    Histogram of the time between incoming messages and the responses to
+    them, per backend and per hour (the hour of the response), kept up to
+    date by the router (see latency.py):
+        backend   - the backend slug
+        hour      - start of the hour
+        histogram - libs.histogram.Histogram.to_dict(), as JSON, without
+                    the bounds, which are latency.BOUNDS
+    '''
+
+    class Meta:
+        unique_together = (('backend', 'hour'),)
+
+
+    backend = models.CharField(max_length=75)
+    hour = models.DateTimeField()
+    histogram = models.TextField()
+
+
+class IdentitySummary(models.Model):
+    '''
+    Activity of each phone (a backend and an identity), kept up to date by
+    the router (see summary.py), so that the top senders, the phones gone
+    silent or the last message of a phone don't need to aggregate the log:
+        backend     - the backend slug
+        identity    - the phone number or other identity
+        reporter    - the reporter of the last message, if any
+        first_seen  - date of the first message
+        last_seen   - date of the last message
+        incoming    - number of messages received from the phone
+        outgoing    - number of messages sent to the phone
+        last_status - status of the last message, '' for none
+
+    last_seen, incoming and outgoing are indexed for sorting.
+    '''
+
+    class Meta:
+        unique_together = (('backend', 'identity'),)
+
+
+    backend = models.CharField(max_length=75)
+    identity = models.CharField(max_length=100)
+    reporter = models.ForeignKey(Reporter, blank=True, null=True)
+    first_seen = models.DateTimeField()
+    last_seen = models.DateTimeField(db_index=True)
+    incoming = models.IntegerField(default=0, db_index=True)
+    outgoing = models.IntegerField(default=0, db_index=True)
+    last_status = models.CharField(max_length=32, blank=True)
+
+
+# logger_id => status, waiting for LoggedMessage.apply_deferred_tags
+_deferred_tags = {}
+_deferred_tags_lock = threading.Lock()
+
+
+def invalidate_reporter_cache(sender, instance, **kwargs):
+    '''
+    Signal handler dropping the reporter_cache entries that a saved or
+    deleted PersistantConnection or Reporter may have made stale.
+    '''
+    if isinstance(instance, PersistantConnection):
+        try:
+            reporter_cache.discard((instance.backend.slug, instance.identity))
+        except models.ObjectDoesNotExist:
+            pass
+        reporter_id = instance.reporter_id
+    else:
+        reporter_id = instance.pk
+    if reporter_id is not None:
+        reporter_cache.discard_values(lambda value: value == reporter_id)
+
+post_save.connect(invalidate_reporter_cache, sender=PersistantConnection)
+post_delete.connect(invalidate_reporter_cache, sender=PersistantConnection)
+post_save.connect(invalidate_reporter_cache, sender=Reporter)
+post_delete.connect(invalidate_reporter_cache, sender=Reporter)
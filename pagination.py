@@ -0,0 +1,237 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Keyset (cursor) pagination of the message log.
+
+Django's Paginator counts the whole queryset, then uses OFFSET to get to
+a page, so both get slower as the log grows. KeysetPaginator instead
+orders the messages by (date, id), newest first, and gets the next page
+by asking for the messages older than the last one on the current page,
+which an index on date answers just as fast for the 1000th page as for the
+first one. Pages don't have numbers, only previous and next cursors.
+
+RankedPaginator does the same for full text searches, ordered by relevance.
+'''
+
+from datetime import datetime
+
+from django.db.models import Q
+from django.db import connection
+
+from logger_ng.db import backend_vendor
+from logger_ng.search import search_rank, format_rank, parse_rank
+
+
+CURSOR_DATE_FORMAT = '%Y%m%d%H%M%S%f'
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def make_cursor(msg, field='date'):
+    '''
+    Returns a string identifying the position of a message in the log, or
+    in the order of another of its dates (i.e. modified).
+    '''
+    return format_cursor(getattr(msg, field), msg.pk)
+
+
+def format_cursor(date, pk):
+    return '%s-%d' % (date.strftime(CURSOR_DATE_FORMAT), pk)
+
+
+def parse_cursor(cursor):
+    '''
+    Returns the (date, id) tuple encoded in a cursor.
+    '''
+    try:
+        date, pk = cursor.split('-')
+        return datetime.strptime(date, CURSOR_DATE_FORMAT), int(pk)
+    except ValueError:
+        raise InvalidCursor(cursor)
+
+
+class KeysetPage(object):
+    '''
+    A page of messages, with the cursors to get to the next (older) and
+    previous (newer) pages. Like django.core.paginator.Page, the messages
+    are in object_list.
+    '''
+
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+
+class KeysetPaginator(object):
+    '''
+    Paginates a LoggedMessage queryset by (date, id), newest first.
+    '''
+
+    def __init__(self, queryset, per_page):
+        self.queryset = queryset
+        self.per_page = per_page
+
+
+    def make_cursor(self, msg):
+        return make_cursor(msg)
+
+
+    def parse_cursor(self, cursor):
+        return parse_cursor(cursor)
+
+
+    def ordered(self, msgs):
+        return msgs.order_by('-date', '-id')
+
+
+    def after(self, msgs, key):
+        '''
+        Returns the messages after (older than) the one at key, the tuple
+        returned by parse_cursor, in reverse order.
+        '''
+        date, pk = key
+        # The date__lte is redundant, but lets the database use the index
+        # on date to find where to start.
+        return msgs.filter(date__lte=date) \
+                   .filter(Q(date__lt=date) | Q(date=date, pk__lt=pk))
+
+
+    def before(self, msgs, key):
+        '''
+        Returns the messages before (newer than) the one at key, in reverse
+        order.
+        '''
+        date, pk = key
+        return msgs.filter(date__gte=date) \
+                   .filter(Q(date__gt=date) | Q(date=date, pk__gt=pk)) \
+                   .order_by('date', 'id')
+
+
+    def page(self, after=None, before=None):
+        '''
+        Returns the page of messages after the `after` cursor, or before
+        the `before` cursor, or the first page if there is neither. Raises
+        InvalidCursor for a malformed cursor.
+        '''
+        msgs = self.queryset
+        if before:
+            msgs = self.before(msgs, self.parse_cursor(before))
+        else:
+            msgs = self.ordered(msgs)
+            if after:
+                msgs = self.after(msgs, self.parse_cursor(after))
+
+        # Get one more than a page, to know whether there's another one
+        object_list = list(msgs[:self.per_page + 1])
+        more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+
+        if before:
+            if not more:
+                # Back to the first messages, show a full first page
+                return self.page()
+            object_list.reverse()
+            older = bool(object_list)
+            newer = more
+        else:
+            older = more
+            newer = bool(after) and bool(object_list)
+
+        next_cursor = previous_cursor = None
+        if object_list and older:
+            next_cursor = self.make_cursor(object_list[-1])
+        if object_list and newer:
+            previous_cursor = self.make_cursor(object_list[0])
+        return KeysetPage(object_list, next_cursor, previous_cursor)
+
+
+class RankedPaginator(KeysetPaginator):
+    '''
+    Paginates the results of a full text search, from search_messages, by
+    (rank, date, id): best match first, then newest first.
+
+    Every match is still ranked for every page, as nothing indexes the
+    rank, but unlike Django's Paginator nothing is counted and there is no
+    OFFSET to read through. The bm25 rank of SQLite depends on the other
+    messages, so a message logged between two pages can move a few matches
+    from one page to the next.
+    '''
+
+    def __init__(self, queryset, per_page, search):
+        KeysetPaginator.__init__(self, queryset, per_page)
+        self.rank_sql, self.rank_params = search_rank(search)
+
+
+    def make_cursor(self, msg):
+        return '%s_%s' % (format_rank(msg.search_rank), make_cursor(msg))
+
+
+    def parse_cursor(self, cursor):
+        try:
+            rank, position = cursor.split('_')
+            return (parse_rank(rank),) + parse_cursor(position)
+        except ValueError:
+            raise InvalidCursor(cursor)
+
+
+    def ordered(self, msgs):
+        return msgs.order_by('search_rank', '-date', '-id')
+
+
+    def where(self, key, older):
+        '''
+        Returns the .extra() arguments for the messages after the one at
+        key, or before it if older is False.
+        '''
+        rank, date, pk = key
+        rank_sql = self.rank_sql
+        date_column = 'logger_ng_loggedmessage.date'
+        id_column = 'logger_ng_loggedmessage.id'
+        rank_worse, date_older = older and ('>', '<') or ('<', '>')
+        date = connection.ops.value_to_db_datetime(date)
+        where = '(%s %s %%s OR (%s = %%s AND (%s %s %%s OR (%s = %%s ' \
+                'AND %s %s %%s))))' % (rank_sql, rank_worse, rank_sql,
+                                       date_column, date_older, date_column,
+                                       id_column, date_older)
+        params = self.rank_params + [rank] + self.rank_params + \
+                 [rank, date, date, pk]
+        return {'where': [where], 'params': params}
+
+
+    def after(self, msgs, key):
+        return msgs.extra(**self.where(key, True))
+
+
+    def before(self, msgs, key):
+        return msgs.extra(**self.where(key, False)) \
+                   .order_by('-search_rank', 'date', 'id')
+
+
+def estimated_count(model):
+    '''
+    Returns the approximate number of rows of a model's table, from the
+    database statistics, without counting them. Returns None if the
+    database doesn't keep such statistics.
+    '''
+    if backend_vendor() != 'postgresql':
+        return None
+    cursor = connection.cursor()
+    cursor.execute("SELECT reltuples FROM pg_class WHERE relname = %s",
+                   [model._meta.db_table])
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return int(row[0])
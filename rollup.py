@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Traffic rollups: the number of messages per hour and per day, by backend,
+direction and status (see models.TrafficRollup).
+
+The router counts the messages as it logs them, and moves the count of a
+message from its old status to the new one when it is tagged. The old
+status is taken from the write-behind buffer, or from the last RECENT_SIZE
+messages counted, so tagging a message doesn't query the database unless
+it was logged long ago. The counts are kept in memory and added to the
+TrafficRollup table every rollup_interval seconds, from a thread of the
+app, with one UPDATE (or INSERT) per hour or day that changed, so keeping
+the rollups costs next to nothing per message.
+
+Messages that don't go through the router, i.e. imported with
+import_from_logger, aren't counted. Recount them with:
+    ./rapidsms backfill_logger_rollups [--since=YYYY-MM-DD]
+'''
+
+import threading
+from datetime import datetime
+
+from django.db import connection, transaction, DatabaseError
+
+from logger_ng.models import LoggedMessage, TrafficRollup
+from logger_ng.libs.lru import LRUCache, MISSING
+
+
+# The Rollup kept by the logger_ng app, if rollups are enabled.
+current = None
+
+# Number of recently counted messages whose status is remembered, so that
+# tagging them doesn't need to look it up.
+RECENT_SIZE = 10000
+
+
+def period_starts(date):
+    '''
+    Returns the (period, start) of the hour and of the day of a date.
+    '''
+    hour = date.replace(minute=0, second=0, microsecond=0)
+    return [(TrafficRollup.PERIOD_HOUR, hour),
+            (TrafficRollup.PERIOD_DAY, hour.replace(hour=0))]
+
+
+class Rollup(object):
+    '''
+    Counts messages in memory, and adds the counts to the TrafficRollup
+    table when flushed.
+    '''
+
+    def __init__(self, error=None):
+        self.error = error
+        # (period, start, backend, direction, status) => count to add
+        self._counts = {}
+        self._lock = threading.Lock()
+        # pk => [date, backend, identity, direction, status]
+        self.recent = LRUCache(max_size=RECENT_SIZE)
+
+
+    def add(self, date, backend, direction, status, count=1):
+        date = date or datetime.now()
+        self._lock.acquire()
+        try:
+            for period, start in period_starts(date):
+                key = (period, start, backend, direction, status or '')
+                self._counts[key] = self._counts.get(key, 0) + count
+        finally:
+            self._lock.release()
+
+
+    def count(self, msg):
+        '''
+        Counts a LoggedMessage that was just logged.
+        '''
+        self.add(msg.date, msg.backend, msg.direction, msg.status)
+        self.recent.set(msg.pk, [msg.date, msg.backend, msg.identity,
+                                 msg.direction, msg.status])
+
+
+    def retag(self, date, backend, direction, old_status, status):
+        '''
+        Moves a message from the count of its old status to the new one.
+        '''
+        if (old_status or '') == (status or ''):
+            return
+        self.add(date, backend, direction, old_status, -1)
+        self.add(date, backend, direction, status, 1)
+
+
+    def flush(self):
+        '''
+        Adds the counts to the TrafficRollup table, in one transaction.
+        If that fails, they are kept for the next flush.
+        '''
+        self._lock.acquire()
+        try:
+            counts, self._counts = self._counts, {}
+        finally:
+            self._lock.release()
+
+        counts = dict([(key, count) for key, count in counts.iteritems()
+                       if count])
+        if not counts:
+            return
+        try:
+            add_counts(counts)
+        except DatabaseError, e:
+            self._lock.acquire()
+            try:
+                for key, count in counts.iteritems():
+                    self._counts[key] = self._counts.get(key, 0) + count
+            finally:
+                self._lock.release()
+            if self.error:
+                self.error("Could not update the traffic rollups: %s", e)
+
+
+@transaction.commit_on_success
+def add_counts(counts):
+    '''
+    Adds the counts, a dict of (period, start, backend, direction, status)
+    => count, to the TrafficRollup rows, creating the missing ones.
+    '''
+    opts = TrafficRollup._meta
+    qn = connection.ops.quote_name
+    where = ' AND '.join(['%s = %%s' % qn(field)
+                          for field in ('period', 'start', 'backend',
+                                        'direction', 'status')])
+    cursor = connection.cursor()
+    for key, count in counts.iteritems():
+        cursor.execute('UPDATE %s SET %s = %s + %%s WHERE %s' %
+                       (qn(opts.db_table), qn('count'), qn('count'), where),
+                       [count] + list(key))
+        if not cursor.rowcount:
+            period, start, backend, direction, status = key
+            TrafficRollup.objects.create(period=period, start=start,
+                                         backend=backend,
+                                         direction=direction, status=status,
+                                         count=count)
+
+
+def record_tags(tags):
+    '''
+    Moves the messages about to be tagged, a dict of id => new status, to
+    the count of their new status, and updates the last status of their
+    phone (see summary.py). Called by LoggedMessage.tag_message and
+    apply_deferred_tags before they tag the messages.
+    '''
+    from logger_ng import batch, summary
+    if (current is None and summary.current is None) or not tags:
+        return
+
+    def retag(date, backend, identity, direction, old_status, status):
+        if current is not None:
+            current.retag(date, backend, direction, old_status, status)
+        if summary.current is not None:
+            summary.current.retag(date, backend, identity, status)
+
+    unknown = []
+    for pk, status in tags.iteritems():
+        msg = batch.current is not None and batch.current.get(pk) or None
+        recent = current is not None and current.recent.get(pk) or MISSING
+        if msg is not None:
+            retag(msg.date, msg.backend, msg.identity, msg.direction,
+                  msg.status, status)
+        elif recent is not MISSING:
+            date, backend, identity, direction, old_status = recent
+            retag(date, backend, identity, direction, old_status, status)
+        else:
+            unknown.append(pk)
+        if recent is not MISSING:
+            recent[4] = status
+    if not unknown:
+        return
+
+    try:
+        rows = list(LoggedMessage.objects.filter(pk__in=unknown)
+                                         .values_list('id', 'date', 'backend',
+                                                      'identity', 'direction',
+                                                      'status'))
+    except DatabaseError:
+        # The tag goes to the spool (see spool.py), its count is lost
+        transaction.rollback_unless_managed()
+        return
+    for pk, date, backend, identity, direction, old_status in rows:
+        retag(date, backend, identity, direction, old_status, tags[pk])
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Searching the message log.
+
+Migration 0003 creates a full text index of the message identity, text and
+reporter name: a tsvector column with a GIN index on PostgreSQL, or an FTS5
+table on SQLite. When it exists, searches use it and return the matches
+best first. Otherwise (other backends, or a SQLite without FTS5), they
+fall back to case insensitive LIKE queries on the same fields, newest
+first.
+
+Every word of the search must match, as the beginning of a word, so that
+"jo 0803" finds John's messages from +2340803...
+'''
+
+import re
+from decimal import Decimal, InvalidOperation
+
+from django.db import connection
+from django.db.models import Q
+
+from logger_ng.db import backend_vendor
+
+
+_index_exists = None
+
+
+def index_exists():
+    '''
+    Returns True if the full text index has been created for this database.
+    '''
+    global _index_exists
+    if _index_exists is None:
+        cursor = connection.cursor()
+        vendor = backend_vendor()
+        if vendor == 'postgresql':
+            cursor.execute("SELECT COUNT(*) FROM information_schema.columns "
+                           "WHERE table_name = 'logger_ng_loggedmessage' "
+                           "AND column_name = 'search_vector'")
+            _index_exists = bool(cursor.fetchone()[0])
+        elif vendor == 'sqlite':
+            cursor.execute("SELECT COUNT(*) FROM sqlite_master "
+                           "WHERE name = 'logger_ng_search'")
+            _index_exists = bool(cursor.fetchone()[0])
+        else:
+            _index_exists = False
+    return _index_exists
+
+
+def search_words(search):
+    '''
+    Splits the search string in words, leaving out anything that would mean
+    something to the full text query parsers.
+    '''
+    return re.findall(r'\w+', search, re.UNICODE)
+
+
+def filter_messages(msgs, search):
+    '''
+    Filters a LoggedMessage queryset to the messages matching the search
+    string, leaving the order alone.
+    '''
+    words = search_words(search)
+    if not words:
+        return msgs
+
+    if not index_exists():
+        for word in words:
+            msgs = msgs.filter(Q(identity__icontains=word) | \
+                               Q(text__icontains=word) | \
+                               Q(reporter__first_name__icontains=word) | \
+                               Q(reporter__last_name__icontains=word))
+        return msgs
+
+    if backend_vendor() == 'postgresql':
+        return msgs.extra(where=["logger_ng_loggedmessage.search_vector @@ "
+                                 "to_tsquery('simple', %s)"],
+                          params=[tsquery(words)])
+
+    return msgs.extra(tables=['logger_ng_search'],
+                      where=['logger_ng_search.rowid = '
+                             'logger_ng_loggedmessage.id',
+                             'logger_ng_search MATCH %s'],
+                      params=[fts_query(words)])
+
+
+def tsquery(words):
+    return ' & '.join(['%s:*' % word for word in words])
+
+
+def fts_query(words):
+    return ' '.join(['"%s"*' % word for word in words])
+
+
+def search_rank(search):
+    '''
+    Returns the SQL expression, and its parameters, of the relevance of a
+    message to a search, lower for better matches, or None if searches
+    aren't ranked (no words, or no full text index).
+    '''
+    words = search_words(search)
+    if not words or not index_exists():
+        return None
+
+    if backend_vendor() == 'postgresql':
+        # ts_rank is a real, rounded to a numeric so that it reads back
+        # exactly, and cursors (see pagination.py) find the same message.
+        return ("-CAST(ts_rank(logger_ng_loggedmessage.search_vector, "
+                "to_tsquery('simple', %s)) AS numeric)", [tsquery(words)])
+
+    # bm25 is lower for better matches
+    return 'bm25(logger_ng_search)', []
+
+
+def format_rank(rank):
+    '''
+    Returns the search_rank of a message as a string that parse_rank reads
+    back as the same number.
+    '''
+    if isinstance(rank, float):
+        return repr(rank)
+    return str(rank)
+
+
+def parse_rank(value):
+    '''
+    Returns the search rank written by format_rank, as the type the
+    database compares exactly with the rank. Raises ValueError if it isn't
+    a number.
+    '''
+    if backend_vendor() == 'postgresql':
+        try:
+            return Decimal(value)
+        except InvalidOperation:
+            raise ValueError(value)
+    return float(value)
+
+
+def search_messages(msgs, search):
+    '''
+    Filters a LoggedMessage queryset to the messages matching the search
+    string, and orders them by relevance then date. The relevance is in
+    the search_rank of the messages, see search_rank.
+    '''
+    msgs = filter_messages(msgs, search)
+    rank = search_rank(search)
+    if rank is None:
+        return msgs.order_by('-date', 'direction')
+
+    sql, params = rank
+    return msgs.extra(select={'search_rank': sql}, select_params=params,
+                      order_by=['search_rank', '-date', '-id'])
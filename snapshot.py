@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Columnar snapshots of the message log, for analysis with NumPy (or pandas).
+
+A snapshot is a directory with one file per column of LoggedMessage, each
+a plain array of fixed size numbers, so that it can be memory-mapped and
+counts or time series over tens of millions of messages computed with
+vectorized operations, without going through Django at all:
+    id.bin        int64  - the message id, mostly in increasing order
+    date.bin      int64  - microseconds since 1970-01-01 (local time, like
+                           LoggedMessage.date)
+    direction.bin uint8  - code in meta['directions']
+    status.bin    uint8  - code in meta['statuses'], 0 for none
+    backend.bin   uint16 - line number in backends.txt
+    identity.bin  int32  - line number in identities.txt
+    reporter.bin  int32  - the reporter id, -1 for none
+meta.json holds the number of rows, the last id, the small dictionaries and
+the number of lines and bytes of the text ones (backends.txt and
+identities.txt, one UTF-8 value per line).
+
+Snapshots are written with ./rapidsms snapshot_logger, which appends the
+messages logged since the last run. Messages aren't always committed in
+id order (the router's batches and spool replays, or imports, may commit
+after messages with a higher id), so the ids missing among the last
+WINDOW ids are kept in meta['holes'], and looked for again on the next
+run. A message committed later than that is only in a rebuilt snapshot.
+Appended rows are never changed, so
+messages tagged after they were written keep their old status until the
+snapshot is rebuilt. The data files are written before meta.json, which is
+replaced atomically, so an interrupted run leaves the previous snapshot
+intact. Read it with:
+    >>> from logger_ng.snapshot import load
+    >>> snap = load('/path/to/snapshot')
+    >>> (snap['direction'] == snap.code('direction', 'I')).sum()
+
+NumPy is only needed to write and read snapshots, not by the rest of
+logger_ng.
+'''
+
+import os
+from datetime import datetime
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from django.utils import simplejson
+
+from logger_ng.models import LoggedMessage
+
+
+VERSION = 1
+
+# Number of messages read per query
+CHUNK_SIZE = 20000
+
+# Number of ids below the last one in the snapshot whose messages may still
+# be committed
+WINDOW = 10000
+
+# Number of missing ids looked up per query. SQLite doesn't allow more than
+# 999 parameters in a query.
+LOOKUP_SIZE = 500
+
+# column => numpy dtype, in file order
+COLUMNS = [('id', 'int64'), ('date', 'int64'), ('direction', 'uint8'),
+           ('status', 'uint8'), ('backend', 'uint16'), ('identity', 'int32'),
+           ('reporter', 'int32')]
+
+# Text dictionaries kept in files of their own, as they can be large
+TEXT_DICTIONARIES = {'backend': 'backends.txt', 'identity': 'identities.txt'}
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def to_microseconds(date):
+    delta = date - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + \
+           delta.microseconds
+
+
+def _read_lines(path, count):
+    '''
+    Returns the first count lines of a text dictionary.
+    '''
+    if not count:
+        return []
+    f = open(path, 'rb')
+    try:
+        values = [f.readline()[:-1].decode('utf-8') for i in xrange(count)]
+    finally:
+        f.close()
+    return values
+
+
+class Snapshot(object):
+    '''
+    A snapshot directory. Columns are read with snap[column], as read-only
+    memory-mapped arrays.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            f = open(meta_path)
+            try:
+                self.meta = simplejson.load(f)
+            finally:
+                f.close()
+            if self.meta.get('version') != VERSION:
+                raise ValueError("%s is not a version %d snapshot" %
+                                 (path, VERSION))
+        else:
+            self.meta = {'version': VERSION, 'count': 0, 'last_id': 0,
+                         'directions': [code for code, name
+                                        in LoggedMessage.DIRECTION_CHOICES],
+                         'statuses': [''],
+                         'sizes': {'backend': 0, 'identity': 0},
+                         'bytes': {'backend': 0, 'identity': 0}}
+            for code, name in LoggedMessage.STATUS_CHOICES:
+                if code not in self.meta['statuses']:
+                    self.meta['statuses'].append(code)
+
+        self.dictionaries = {'direction': self.meta['directions'],
+                             'status': self.meta['statuses']}
+        for column, name in TEXT_DICTIONARIES.iteritems():
+            self.dictionaries[column] = _read_lines(
+                                            os.path.join(path, name),
+                                            self.meta['sizes'][column])
+        self._codes = {}
+        for column, values in self.dictionaries.iteritems():
+            self._codes[column] = dict([(value, code) for code, value
+                                        in enumerate(values)])
+
+
+    def __len__(self):
+        return self.meta['count']
+
+
+    def __getitem__(self, column):
+        dtype = dict(COLUMNS)[column]
+        if not self.meta['count']:
+            return numpy.zeros(0, dtype=dtype)
+        return numpy.memmap(os.path.join(self.path, column + '.bin'),
+                            dtype=dtype, mode='r',
+                            shape=(self.meta['count'],))
+
+
+    def dates(self):
+        '''
+        Returns the date column as datetime64 values.
+        '''
+        return self['date'].view('datetime64[us]')
+
+
+    def code(self, column, value):
+        '''
+        Returns the code of a value of a dictionary encoded column, or None
+        if no message has that value.
+        '''
+        return self._codes[column].get(value)
+
+
+    def decode(self, column, codes):
+        '''
+        Returns the values of codes of a dictionary encoded column.
+        '''
+        values = self.dictionaries[column]
+        return [values[code] for code in codes]
+
+
+    def _encode(self, column, value):
+        code = self._codes[column].get(value)
+        if code is None:
+            code = self._codes[column][value] = \
+                                            len(self.dictionaries[column])
+            self.dictionaries[column].append(value)
+        return code
+
+
+    def _truncate(self):
+        '''
+        Drops whatever an interrupted append left after the rows and
+        dictionary values that meta.json knows of.
+        '''
+        for column, dtype in COLUMNS:
+            path = os.path.join(self.path, column + '.bin')
+            size = self.meta['count'] * numpy.dtype(dtype).itemsize
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                f = open(path, 'r+b')
+                try:
+                    f.truncate(size)
+                finally:
+                    f.close()
+        for column, name in TEXT_DICTIONARIES.iteritems():
+            path = os.path.join(self.path, name)
+            size = self.meta['bytes'][column]
+            if not os.path.exists(path):
+                open(path, 'wb').close()
+            elif os.path.getsize(path) > size:
+                f = open(path, 'r+b')
+                try:
+                    f.truncate(size)
+                finally:
+                    f.close()
+
+
+    def append(self, rows, holes=None):
+        '''
+        Appends a list of (id, date, direction, status, backend, identity,
+        reporter_id) rows, and saves meta.json, with the missing ids in
+        holes if given.
+        '''
+        if not rows:
+            return
+        sizes = dict([(column, len(self.dictionaries[column]))
+                      for column in TEXT_DICTIONARIES])
+        columns = {
+            'id': [row[0] for row in rows],
+            'date': [to_microseconds(row[1]) for row in rows],
+            'direction': [self._encode('direction', row[2]) for row in rows],
+            'status': [self._encode('status', row[3] or '') for row in rows],
+            'backend': [self._encode('backend', row[4]) for row in rows],
+            'identity': [self._encode('identity', row[5]) for row in rows],
+            'reporter': [row[6] is None and -1 or row[6] for row in rows],
+        }
+        if len(self.dictionaries['backend']) > 65536 or \
+           len(self.dictionaries['status']) > 256 or \
+           len(self.dictionaries['direction']) > 256:
+            raise ValueError("Too many distinct values for the snapshot "
+                             "columns")
+
+        for column, dtype in COLUMNS:
+            f = open(os.path.join(self.path, column + '.bin'), 'ab')
+            try:
+                numpy.array(columns[column], dtype=dtype).tofile(f)
+            finally:
+                f.close()
+        written = {}
+        for column, name in TEXT_DICTIONARIES.iteritems():
+            data = ''.join([value.encode('utf-8') + '\n' for value
+                            in self.dictionaries[column][sizes[column]:]])
+            f = open(os.path.join(self.path, name), 'ab')
+            try:
+                f.write(data)
+            finally:
+                f.close()
+            written[column] = len(data)
+
+        self.meta['count'] += len(rows)
+        self.meta['last_id'] = max(self.meta['last_id'],
+                                   max([row[0] for row in rows]))
+        if holes is not None:
+            self.meta['holes'] = holes
+        for column in TEXT_DICTIONARIES:
+            self.meta['sizes'][column] = len(self.dictionaries[column])
+            self.meta['bytes'][column] += written[column]
+        self._save_meta()
+
+
+    def _save_meta(self):
+        path = os.path.join(self.path, 'meta.json')
+        f = open(path + '.tmp', 'w')
+        try:
+            simplejson.dump(self.meta, f)
+        finally:
+            f.close()
+        os.rename(path + '.tmp', path)
+
+
+def load(path):
+    '''
+    Returns the Snapshot in a directory, for reading.
+    '''
+    if numpy is None:
+        raise ImportError("Reading logger_ng snapshots requires NumPy")
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        raise ValueError("%s is not a logger_ng snapshot" % path)
+    return Snapshot(path)
+
+
+def find_holes(holes, last_id, ids):
+    '''
+    Returns the missing ids among the WINDOW below the highest of ids,
+    given the previous holes, the last id before ids, and ids, a sorted
+    list.
+    '''
+    floor = ids[-1] - WINDOW
+    present = set(ids)
+    return [pk for pk in holes if pk > floor] + \
+           [pk for pk in xrange(max(last_id, floor) + 1, ids[-1])
+            if pk not in present]
+
+
+def update(path, chunk_size=CHUNK_SIZE, progress=None):
+    '''
+    Creates the snapshot in a directory, or appends the messages logged
+    since it was last updated: those committed since in the holes, then
+    those with a higher id than the last one, read chunk_size at a time by
+    id. Calls progress(count) after each chunk. Returns the number of
+    messages appended.
+    '''
+    if numpy is None:
+        raise ImportError("Writing logger_ng snapshots requires NumPy")
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    snap = Snapshot(path)
+    snap._truncate()
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        snap._save_meta()
+
+    msgs = LoggedMessage.objects.order_by('id') \
+                        .values_list('id', 'date', 'direction', 'status',
+                                     'backend', 'identity', 'reporter')
+    appended = 0
+    holes = snap.meta.get('holes', [])
+    rows = []
+    for i in range(0, len(holes), LOOKUP_SIZE):
+        rows.extend(msgs.filter(id__in=holes[i:i + LOOKUP_SIZE]))
+    if rows:
+        found = set([row[0] for row in rows])
+        snap.append(rows, [pk for pk in holes if pk not in found])
+        appended += len(rows)
+        if progress is not None:
+            progress(appended)
+
+    while True:
+        last_id = snap.meta['last_id']
+        rows = list(msgs.filter(id__gt=last_id)[:chunk_size])
+        if not rows:
+            return appended
+        snap.append(rows, find_holes(snap.meta.get('holes', []), last_id,
+                                     [row[0] for row in rows]))
+        appended += len(rows)
+        if progress is not None:
+            progress(appended)
@@ -0,0 +1,587 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Local spooling of LoggedMessage objects while the database is unavailable.
+
+When a spool_path is set in local.ini, every batch of LoggedMessages goes
+through a Spool before reaching the database. The Spool has a circuit
+breaker watching how the database writes go: when too many of the recent
+ones failed or were slow, the circuit opens and messages are appended to
+a local journal file instead, which is fast and doesn't depend on the
+database at all. After a while the database is tried again, and once it
+works, the journal is replayed into the table in bulk.
+
+Journaled messages keep the primary key they were given (see
+batch.IdAllocator, which doesn't hand out the ids in the journal again,
+even after a restart), so logger_id watermarks and response_to links stay
+valid. Replaying skips the messages that are already in the table with the
+same contents, so a journal can safely be replayed twice, or after a crash
+half way through. A message whose id is taken by another one, or that the
+database refuses, is set aside in a .rejected journal rather than holding
+up the others.
+
+Tags are journaled too while the database can't be written to, or while
+older journaled tags wait to be replayed, and are replayed before the next
+batch of messages is written. A replayed tag only changes the status of a
+message still having the status the tag replaced, when that is known.
+
+The journal can also be replayed with ./rapidsms replay_logger_spool
+'''
+
+import os
+import time
+import threading
+from collections import deque
+from datetime import datetime
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+from django.db import connection, models, transaction, DatabaseError
+from django.utils import simplejson
+
+from logger_ng.db import backend_vendor, bulk_insert
+from logger_ng.models import LoggedMessage
+from logger_ng.libs.lru import LRUCache, MISSING
+
+
+# The Spool in use by the logger_ng app, if spooling is enabled.
+current = None
+
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S.%f'
+
+# Number of journal records replayed per transaction
+REPLAY_CHUNK_SIZE = 500
+
+# Number of recent messages whose status is remembered for journaled tags
+STATUS_CACHE_SIZE = 1000
+
+
+class CircuitBreaker(object):
+    '''
+    Keeps track of the last `window` database writes, and opens when at
+    least `error_rate` of them failed or took longer than `slow_ms` (once
+    there are a few to judge from). While open, allow() returns False.
+    After `retry_after` seconds one write is allowed through again: if it
+    goes well the circuit closes, otherwise it stays open for another
+    `retry_after` seconds.
+    '''
+
+    def __init__(self, window=20, error_rate=0.5, slow_ms=1000,
+                 retry_after=30):
+        self.window = window
+        self.error_rate = error_rate
+        self.slow_ms = slow_ms
+        self.retry_after = retry_after
+        self.opened_at = None
+        self.trips = 0
+        self._outcomes = deque()
+
+
+    def is_open(self):
+        return self.opened_at is not None
+
+
+    def allow(self):
+        '''
+        Returns True if the database should be written to.
+        '''
+        return self.opened_at is None or \
+               time.time() - self.opened_at >= self.retry_after
+
+
+    def record(self, ok, duration_ms=0):
+        '''
+        Records the outcome of a database write.
+        '''
+        bad = not ok or duration_ms > self.slow_ms
+        if self.opened_at is not None:
+            # This was the trial write
+            if bad:
+                self.opened_at = time.time()
+            else:
+                self.opened_at = None
+                self._outcomes.clear()
+            return
+
+        self._outcomes.append(bad)
+        if len(self._outcomes) > self.window:
+            self._outcomes.popleft()
+        count = len(self._outcomes)
+        if count >= min(self.window, 5) and \
+           self._outcomes.count(True) >= self.error_rate * count:
+            self.opened_at = time.time()
+            self.trips += 1
+
+
+class Journal(object):
+    '''
+    An append-only file of JSON records, one per line. Records are either
+    LoggedMessage fields, or {"tag": <pk>, "status": <status>} for a tag
+    applied while the database couldn't be written to, with the status it
+    replaces as "old" when it is known.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+
+
+    def append(self, records):
+        '''
+        Appends the records and makes sure they are on disk before
+        returning. The file is locked meanwhile, so that replay_journal
+        can't move it aside half way.
+        '''
+        data = ''.join([simplejson.dumps(record) + '\n'
+                        for record in records])
+        appended = False
+        while not appended:
+            journal = open(self.path, 'a+b')
+            try:
+                _lock(journal)
+                # If the journal was moved aside while we waited for the
+                # lock, append to the new one instead.
+                if _is_file(journal, self.path):
+                    # A crash while appending may have left half a line,
+                    # which the first record must not be glued to.
+                    journal.seek(0, 2)
+                    if journal.tell():
+                        journal.seek(-1, 2)
+                        if journal.read(1) != '\n':
+                            data = '\n' + data
+                        journal.seek(0, 2)
+                    journal.write(data)
+                    journal.flush()
+                    os.fsync(journal.fileno())
+                    appended = True
+            finally:
+                # Releases the lock
+                journal.close()
+
+
+    def read(self, path=None):
+        '''
+        Yields the records of the journal. A truncated line, left by a
+        crash while appending, is ignored.
+        '''
+        journal = open(path or self.path, 'rb')
+        try:
+            for line in journal:
+                try:
+                    yield simplejson.loads(line)
+                except ValueError:
+                    continue
+        finally:
+            journal.close()
+
+
+def _lock(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+
+
+def _is_file(f, path):
+    '''
+    Returns True if the open file f is the one at path.
+    '''
+    try:
+        opened, current = os.fstat(f.fileno()), os.stat(path)
+    except OSError:
+        return False
+    return (opened.st_dev, opened.st_ino) == (current.st_dev, current.st_ino)
+
+
+def to_record(msg):
+    '''
+    Returns a JSON serializable dict of the LoggedMessage fields.
+    '''
+    record = {}
+    for field in msg._meta.local_fields:
+        value = getattr(msg, field.attname)
+        if isinstance(value, datetime):
+            value = value.strftime(DATE_FORMAT)
+        record[field.attname] = value
+    return record
+
+
+def from_record(record):
+    '''
+    Returns an unsaved LoggedMessage from a journal record.
+    '''
+    values = {}
+    for field in LoggedMessage._meta.local_fields:
+        value = record.get(field.attname)
+        if value is not None and isinstance(field, models.DateTimeField):
+            value = datetime.strptime(value, DATE_FORMAT)
+        values[str(field.attname)] = value
+    return LoggedMessage(**values)
+
+
+class Spool(object):
+    '''
+    Writes batches of LoggedMessages to the database, or to the journal
+    when the circuit breaker is open.
+    '''
+
+    def __init__(self, path, breaker=None, error=None):
+        self.journal = Journal(path)
+        self.breaker = breaker or CircuitBreaker()
+        self.error = error
+        self.spooled = 0
+        self.replayed = 0
+
+        # pk => status of the messages written or journaled recently, so
+        # that a journaled tag only replaces the status it was meant to.
+        self.statuses = LRUCache(max_size=STATUS_CACHE_SIZE)
+        # Held while writing to the database
+        self._lock = threading.RLock()
+        # Held while the journal is appended to or replayed, and ids and
+        # pending_tags are updated. It is never held while waiting for
+        # the database.
+        self._journal_lock = threading.Lock()
+        self._replaying = False
+        self._load_pending()
+
+
+    def _load_pending(self):
+        '''
+        Reads the pk => direction of the journaled messages in ids, so that
+        they can be tagged and responded to before they are replayed, and
+        counts the journaled tags of messages in the table in pending_tags.
+        '''
+        self.ids = {}
+        tagged = []
+        for record in self.pending_records():
+            if 'tag' in record:
+                tagged.append(record['tag'])
+            else:
+                self.ids[record['id']] = record['direction']
+        self.pending_tags = len([pk for pk in tagged if pk not in self.ids])
+
+
+    def highest_id(self):
+        '''
+        Returns the highest id in the journal, or 0. The table doesn't know
+        of these ids yet, so batch.IdAllocator must not hand them out again.
+        '''
+        return self.ids and max(self.ids) or 0
+
+
+    def write(self, msgs):
+        '''
+        Writes the messages to the database if the circuit allows it and
+        the write succeeds, else to the journal.
+        '''
+        self._lock.acquire()
+        try:
+            if self.breaker.allow():
+                try:
+                    # Journaled messages and tags go in first, since the
+                    # new messages may respond to them, and tags written
+                    # from now on are newer. Unless the messages are older
+                    # than the journaled ones, which were spilled while
+                    # they were being written.
+                    older = self.ids and \
+                            max([msg.pk for msg in msgs]) < min(self.ids)
+                    if (self.ids or self.pending_tags) and not older:
+                        self._replay()
+                    start = time.time()
+                    bulk_insert(msgs)
+                except Exception, e:
+                    self.breaker.record(False)
+                    if self.error:
+                        self.error("Spooling %d messages, database write "
+                                   "failed: %s", len(msgs), e)
+                else:
+                    self.breaker.record(True, (time.time() - start) * 1000)
+                    for msg in msgs:
+                        self.statuses.set(msg.pk, msg.status)
+                    if older:
+                        self.replay()
+                    return
+
+            self._append(msgs)
+        finally:
+            self._lock.release()
+
+
+    def spill(self, msgs):
+        '''
+        Appends the messages to the journal straight away, without waiting
+        for a database write in progress. Used by a writer.BackgroundWriter
+        whose queue is full.
+        '''
+        self._append(msgs)
+
+
+    def _append(self, msgs):
+        self._journal_lock.acquire()
+        try:
+            self.journal.append([to_record(msg) for msg in msgs])
+            for msg in msgs:
+                self.ids[msg.pk] = msg.direction
+                self.statuses.set(msg.pk, msg.status)
+            self.spooled += len(msgs)
+        finally:
+            self._journal_lock.release()
+
+
+    def tag(self, pk, status):
+        '''
+        Journals the tag if the message is in the journal, if the database
+        can't be written to right now, or if journaled tags are waiting to
+        be replayed (so that they can't overwrite this newer one). Returns
+        False if the tag should be written to the database as usual.
+        '''
+        self._journal_lock.acquire()
+        try:
+            if pk not in self.ids and not self.pending_tags and \
+               not self._replaying and self.breaker.allow():
+                self.statuses.set(pk, status)
+                return False
+            record = {'tag': pk, 'status': status}
+            old = self.statuses.get(pk)
+            if old is not MISSING:
+                record['old'] = old
+            self.journal.append([record])
+            if pk not in self.ids:
+                self.pending_tags += 1
+            self.statuses.set(pk, status)
+            return True
+        finally:
+            self._journal_lock.release()
+
+
+    def direction(self, pk):
+        '''
+        Returns the direction of a journaled message, or None if the
+        message with this pk isn't in the journal.
+        '''
+        return self.ids.get(pk)
+
+
+    def pending_records(self):
+        '''
+        Yields the records of the journal, including those of a replay
+        that was interrupted.
+        '''
+        for path in (self.journal.path + '.replaying', self.journal.path):
+            if os.path.exists(path):
+                for record in self.journal.read(path):
+                    yield record
+
+
+    def replay(self):
+        '''
+        Writes the journaled messages that aren't in the table yet, applies
+        the journaled tags, and removes the journal. Returns the number of
+        messages inserted.
+        '''
+        self._lock.acquire()
+        try:
+            try:
+                return self._replay()
+            except Exception, e:
+                if self.error:
+                    self.error("Could not replay the logger_ng journal: %s",
+                               e)
+                return 0
+        finally:
+            self._lock.release()
+
+
+    def _replay(self):
+        self._journal_lock.acquire()
+        try:
+            self._replaying = True
+        finally:
+            self._journal_lock.release()
+        try:
+            inserted = replay_journal(self.journal.path, self.error)
+        finally:
+            self._journal_lock.acquire()
+            try:
+                # What was journaled during the replay is still there
+                self._load_pending()
+                self._replaying = False
+            finally:
+                self._journal_lock.release()
+        self.replayed += inserted
+        return inserted
+
+
+    def stats(self):
+        return {'open': self.breaker.is_open(), 'trips': self.breaker.trips,
+                'spooled': self.spooled, 'replayed': self.replayed,
+                'in_journal': len(self.ids),
+                'pending_tags': self.pending_tags}
+
+
+def replay_journal(path, error=None):
+    '''
+    Replays the journal at path into the LoggedMessage table and deletes it.
+    Can be run by any process: replays are serialized with a lock file, and
+    the journal is moved aside first, with the lock Journal.append takes,
+    so that the router can keep appending to a fresh one meanwhile.
+
+    Journaled messages whose id is already in the table with the same
+    contents were replayed before, and are skipped. Those whose id is used
+    by another message, or that the database refuses, are appended to the
+    path.rejected journal, and reported with error.
+    '''
+    replaying = path + '.replaying'
+    lock = open(path + '.lock', 'a')
+    try:
+        _lock(lock)
+
+        inserted = 0
+        # A journal left by an interrupted replay is replayed first
+        while os.path.exists(replaying) or os.path.exists(path):
+            if not os.path.exists(replaying):
+                journal = open(path, 'rb')
+                try:
+                    _lock(journal)
+                    os.rename(path, replaying)
+                finally:
+                    journal.close()
+            inserted += _replay_file(replaying, Journal(path + '.rejected'),
+                                     error)
+            os.remove(replaying)
+        _reset_sequence()
+        return inserted
+    finally:
+        lock.close()
+
+
+def _replay_file(path, rejects, error):
+    journal = Journal(path)
+    # pk => (status, status it replaces or MISSING)
+    tags = {}
+    messages = {}
+    for record in journal.read():
+        if 'tag' in record:
+            pk = record['tag']
+            old = record.get('old', MISSING)
+            if pk in tags:
+                # The status it replaces is the one before the first tag
+                old = tags[pk][1]
+            tags[pk] = (record['status'], old)
+        else:
+            messages[record['id']] = record
+
+    def reject(records, reason):
+        rejects.append(records)
+        for record in records:
+            tags.pop(record['id'], None)
+            if error:
+                error("Rejected journaled message %s from %s %s (%r): %s",
+                      record['id'], record['backend'], record['identity'],
+                      record['text'], reason)
+
+    inserted = 0
+    pks = sorted(messages.keys())
+    for i in range(0, len(pks), REPLAY_CHUNK_SIZE):
+        chunk = [messages[pk] for pk in pks[i:i + REPLAY_CHUNK_SIZE]]
+        msgs, conflicts = _new_messages(chunk, tags, messages)
+        if conflicts:
+            reject(conflicts, "its id is used by another message")
+        try:
+            inserted += _insert(msgs)
+        except Exception, e:
+            # Tell the rows the database refuses from a database that is
+            # down, which must not lose the journal.
+            refused = []
+            for msg in msgs:
+                try:
+                    inserted += _insert([msg])
+                except Exception:
+                    refused.append(to_record(msg))
+            if len(refused) == len(msgs) and not _database_answers():
+                raise
+            reject(refused, e)
+
+    # Tags only replace the status they were journaled over, if it is known
+    by_status = {}
+    for pk, (status, old) in tags.iteritems():
+        by_status.setdefault((status, old), []).append(pk)
+    for (status, old), tagged in by_status.iteritems():
+        for i in range(0, len(tagged), REPLAY_CHUNK_SIZE):
+            msgs = LoggedMessage.objects.filter(
+                                    pk__in=tagged[i:i + REPLAY_CHUNK_SIZE])
+            if old is None:
+                msgs = msgs.filter(status__isnull=True)
+            elif old is not MISSING:
+                msgs = msgs.filter(status=old)
+            msgs.update(status=status, modified=datetime.now())
+    return inserted
+
+
+def _new_messages(records, tags, messages):
+    '''
+    Returns the LoggedMessages of the records that aren't in the table yet,
+    and the records whose id is used by another message.
+    '''
+    pks = [record['id'] for record in records]
+    existing = dict([(row[0], row[1:]) for row in
+                     LoggedMessage.objects.filter(pk__in=pks)
+                                  .values_list('id', 'direction', 'backend',
+                                               'identity', 'text')])
+    msgs = []
+    conflicts = []
+    for record in records:
+        if record['id'] in existing:
+            if existing[record['id']] != (record['direction'],
+                                          record['backend'],
+                                          record['identity'],
+                                          record['text']):
+                conflicts.append(record)
+            continue
+        msg = from_record(record)
+        if msg.id in tags:
+            msg.status = tags.pop(msg.id)[0]
+        # The message this responds to should either be in the journal
+        # (with a lower id, so it's already replayed) or in the table.
+        if msg.response_to_id is not None and \
+           msg.response_to_id not in messages and \
+           not LoggedMessage.objects.filter(pk=msg.response_to_id).count():
+            msg.response_to_id = None
+        msgs.append(msg)
+    return msgs, conflicts
+
+
+@transaction.commit_on_success
+def _insert(msgs):
+    return bulk_insert(msgs)
+
+
+def _database_answers():
+    try:
+        LoggedMessage.objects.filter(pk=0).count()
+        return True
+    except DatabaseError:
+        transaction.rollback_unless_managed()
+        return False
+
+
+def _reset_sequence():
+    '''
+    On PostgreSQL, ids given while the database was down may be ahead of
+    the sequence. Moves the sequence past them.
+    '''
+    if backend_vendor() != 'postgresql':
+        return
+    opts = LoggedMessage._meta
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute("SELECT pg_get_serial_sequence(%s, %s)",
+                   [opts.db_table, opts.pk.column])
+    sequence = cursor.fetchone()[0]
+    cursor.execute("SELECT setval(%%s, GREATEST((SELECT MAX(%s) FROM %s), "
+                   "(SELECT last_value FROM %s)))" %
+                   (qn(opts.pk.column), qn(opts.db_table), sequence),
+                   [sequence])
+    transaction.commit_unless_managed()
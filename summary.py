@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Identity summaries: the activity of each phone (see models.IdentitySummary).
+
+Like the traffic rollups (see rollup.py), the router collects the changes
+in memory as it logs and tags messages, and writes them every
+rollup_interval seconds with one UPDATE (or INSERT) per phone that was
+active, so the top senders, the phones gone silent or the last message of
+a phone are read from one small, indexed table instead of aggregating the
+whole log.
+
+Phones of messages that don't go through the router, i.e. logged before
+the summaries existed or imported, are summarized with:
+    ./rapidsms backfill_logger_identities
+'''
+
+import threading
+from datetime import datetime
+
+from django.db import connection, transaction, DatabaseError
+
+from logger_ng.models import IdentitySummary
+
+
+# The Summaries of the logger_ng app, if enabled.
+current = None
+
+
+class _Change(object):
+    '''
+    What happened to a phone since the last flush.
+    '''
+
+    def __init__(self):
+        self.first_seen = None
+        self.last_seen = None
+        self.incoming = 0
+        self.outgoing = 0
+        self.last_status = ''
+        self.reporter_id = None
+
+
+    def merge(self, other):
+        '''
+        Adds an older change to this one.
+        '''
+        self.incoming += other.incoming
+        self.outgoing += other.outgoing
+        if other.first_seen is not None and (self.first_seen is None or
+                                             other.first_seen <
+                                                self.first_seen):
+            self.first_seen = other.first_seen
+        if other.last_seen is not None and (self.last_seen is None or
+                                            other.last_seen >
+                                                self.last_seen):
+            self.last_seen = other.last_seen
+            self.last_status = other.last_status
+        self.reporter_id = self.reporter_id or other.reporter_id
+
+
+class Summaries(object):
+    '''
+    Collects the activity of phones in memory, and writes it to the
+    IdentitySummary table when flushed.
+    '''
+
+    def __init__(self, error=None):
+        self.error = error
+        # (backend, identity) => _Change
+        self._changes = {}
+        self._lock = threading.Lock()
+
+
+    def _change(self, backend, identity):
+        change = self._changes.get((backend, identity))
+        if change is None:
+            change = self._changes[(backend, identity)] = _Change()
+        return change
+
+
+    def count(self, msg):
+        '''
+        Adds a LoggedMessage that was just logged.
+        '''
+        date = msg.date or datetime.now()
+        self._lock.acquire()
+        try:
+            change = self._change(msg.backend, msg.identity)
+            if msg.is_incoming():
+                change.incoming += 1
+            else:
+                change.outgoing += 1
+            if change.first_seen is None or date < change.first_seen:
+                change.first_seen = date
+            if change.last_seen is None or date >= change.last_seen:
+                change.last_seen = date
+                change.last_status = msg.status or ''
+            change.reporter_id = msg.reporter_id or change.reporter_id
+        finally:
+            self._lock.release()
+
+
+    def retag(self, date, backend, identity, status):
+        '''
+        Records the new status of a message, which becomes the last status
+        of the phone if it is its last message.
+        '''
+        date = date or datetime.now()
+        self._lock.acquire()
+        try:
+            change = self._change(backend, identity)
+            if change.last_seen is None or date >= change.last_seen:
+                change.last_seen = date
+                change.last_status = status or ''
+        finally:
+            self._lock.release()
+
+
+    def flush(self):
+        '''
+        Writes the changes to the IdentitySummary table, in one
+        transaction. If that fails, they are kept for the next flush.
+        '''
+        self._lock.acquire()
+        try:
+            changes, self._changes = self._changes, {}
+        finally:
+            self._lock.release()
+        if not changes:
+            return
+
+        try:
+            write_changes(changes)
+        except DatabaseError, e:
+            self._lock.acquire()
+            try:
+                for key, change in changes.iteritems():
+                    if key in self._changes:
+                        self._changes[key].merge(change)
+                    else:
+                        self._changes[key] = change
+            finally:
+                self._lock.release()
+            if self.error:
+                self.error("Could not update the identity summaries: %s", e)
+
+
+@transaction.commit_on_success
+def write_changes(changes):
+    '''
+    Applies a dict of (backend, identity) => _Change to the IdentitySummary
+    rows, creating the missing ones.
+    '''
+    qn = connection.ops.quote_name
+    # MySQL assigns from left to right, seeing the values already assigned,
+    # so last_status is compared with last_seen before it changes.
+    sql = "UPDATE %(table)s SET " \
+          "%(incoming)s = %(incoming)s + %%s, " \
+          "%(outgoing)s = %(outgoing)s + %%s, " \
+          "%(last_status)s = CASE WHEN %(last_seen)s > %%s " \
+          "THEN %(last_status)s ELSE %%s END, " \
+          "%(last_seen)s = CASE WHEN %(last_seen)s > %%s " \
+          "THEN %(last_seen)s ELSE %%s END, " \
+          "%(reporter_id)s = COALESCE(%%s, %(reporter_id)s) " \
+          "WHERE %(backend)s = %%s AND %(identity)s = %%s" % \
+          dict([('table', qn(IdentitySummary._meta.db_table))] +
+               [(column, qn(column))
+                for column in ('incoming', 'outgoing', 'last_status',
+                               'last_seen', 'reporter_id', 'backend',
+                               'identity')])
+    cursor = connection.cursor()
+    for (backend, identity), change in changes.iteritems():
+        cursor.execute(sql, [change.incoming, change.outgoing,
+                             change.last_seen, change.last_status,
+                             change.last_seen, change.last_seen,
+                             change.reporter_id, backend, identity])
+        # A tag alone doesn't make a phone; the backfill will summarize it
+        if not cursor.rowcount and change.first_seen is not None:
+            IdentitySummary.objects.create(backend=backend,
+                                           identity=identity,
+                                           reporter_id=change.reporter_id,
+                                           first_seen=change.first_seen,
+                                           last_seen=change.last_seen,
+                                           incoming=change.incoming,
+                                           outgoing=change.outgoing,
+                                           last_status=change.last_status)
@@ -7,5 +7,5 @@ register = template.Library()
 from logger_ng.libs.format_timedelta import humanize_timedelta
 
 @register.filter("humanize_time_delta")
-def humanize_time_delta(value):
-    return humanize_timedelta(value)
+def humanize_time_delta(value, now=None):
+    return humanize_timedelta(value, now=now)
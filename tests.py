@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Tests of the spool journal, the background writer, the id allocator and
+the queries of the log view and their plans, run with:
+    ./rapidsms test logger_ng
+
+Messages go through the app the way the router hands them over, with
+App.handle and App.outgoing.
+'''
+
+import os
+import copy
+import time
+import shutil
+import tempfile
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase
+from django.contrib.auth.models import User
+
+from rapidsms.message import Message
+from rapidsms.connection import Connection
+
+from reporters.models import Reporter, PersistantBackend, \
+                             PersistantConnection
+
+from logger_ng import batch, spool, writer
+from logger_ng.app import App
+from logger_ng.db import backend_vendor
+from logger_ng.models import LoggedMessage, reporter_cache
+from logger_ng.management.commands.check_logger_indexes import hot_queries, \
+                                                            query_plan
+
+
+class Backend(object):
+    '''
+    Stands for a backend, of which the app only logs the slug.
+    '''
+
+    def __init__(self, slug):
+        self.slug = slug
+
+
+class Router(object):
+    '''
+    Stands for the router, keeping what the app logs.
+    '''
+
+    def __init__(self):
+        self.logged = []
+
+    def log(self, level, msg, *args):
+        self.logged.append((level, msg, args))
+
+    def errors(self):
+        return [msg for level, msg, args in self.logged if level == 'error']
+
+
+class AppTestCase(TestCase):
+    '''
+    Starts the logger_ng app with options of the test's choosing, and feeds
+    it messages.
+    '''
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal')
+        self.router = Router()
+        self.app = None
+        reporter_cache.clear()
+
+    def tearDown(self):
+        if self.app is not None:
+            self.app.stop()
+        shutil.rmtree(self.dir)
+
+    def start_app(self, **options):
+        '''
+        Starts the app, without its stats thread and writing thread: only
+        the thread running the test sees the test database, so messages
+        are written when the buffer is full or flush() is called.
+        '''
+        options.setdefault('rollup_interval', 0)
+        self.app = App(self.router)
+        self.app.configure(**options)
+        self.app.start()
+        if batch.current is not None:
+            batch.current.stop()
+        return self.app
+
+    def restart_app(self, **options):
+        self.app.stop()
+        self.app = None
+        return self.start_app(**options)
+
+    def handle(self, text='hello', identity='5551234'):
+        message = Message(Connection(Backend('pygsm'), identity), text)
+        self.app.handle(message)
+        self.app.cleanup(message)
+        return message
+
+    def respond(self, message, text='thanks'):
+        # Like Message.respond, the response is a copy, logger_id included
+        response = copy.copy(message)
+        response.text = text
+        self.app.outgoing(response)
+        return response
+
+    def database_down(self):
+        spool.current.breaker.opened_at = time.time()
+        spool.current.breaker.retry_after = 3600
+
+    def database_back(self):
+        spool.current.breaker.opened_at = None
+
+
+class SpoolTest(AppTestCase):
+
+    def test_restart_does_not_reuse_journaled_ids(self):
+        self.start_app(spool_path=self.path)
+        self.handle()
+        self.database_down()
+        journaled = [self.handle().logger_id for i in range(2)]
+        self.assertEqual(LoggedMessage.objects.count(), 1)
+
+        self.restart_app(spool_path=self.path)
+        self.assertEqual(spool.current.highest_id(), max(journaled))
+        self.failUnless(self.handle().logger_id > max(journaled))
+        self.assertEqual(LoggedMessage.objects.count(), 4)
+
+
+    def test_allocator_without_database(self):
+        def fail(count):
+            raise Exception("The database is down")
+
+        allocator = batch.IdAllocator(10, 51)
+        allocator._reserve = fail
+        self.assertEqual(allocator.next_id(), 52)
+        self.failUnless(allocator.behind)
+
+        allocator = batch.IdAllocator(10)
+        allocator._reserve = fail
+        self.failUnless(allocator.next_id() > 1000000000)
+
+
+    def test_replay(self):
+        self.start_app(spool_path=self.path)
+        self.database_down()
+        journaled = [self.handle(text).logger_id
+                     for text in ('one', 'two', 'three')]
+
+        # A replay inserted the first message before crashing, and another
+        # process took the id of the last one.
+        records = list(spool.Journal(self.path).read())
+        spool.from_record(records[0]).save(force_insert=True)
+        other = spool.from_record(records[2])
+        other.text = 'other'
+        other.save(force_insert=True)
+
+        # The journal is replayed before the next message is written
+        self.database_back()
+        self.handle()
+        self.assertEqual(LoggedMessage.objects.count(), 4)
+        self.assertEqual(LoggedMessage.objects.get(pk=journaled[1]).text,
+                         'two')
+        self.assertEqual(LoggedMessage.objects.get(pk=journaled[2]).text,
+                         'other')
+        self.assertEqual(len(self.router.errors()), 1)
+        self.failIf(os.path.exists(self.path))
+        rejected = list(spool.Journal(self.path + '.rejected').read())
+        self.assertEqual([record['id'] for record in rejected],
+                         [journaled[2]])
+
+        # Replaying again does nothing
+        spool.Journal(self.path).append([records[1]])
+        self.assertEqual(spool.replay_journal(self.path, self.app.error), 0)
+        self.assertEqual(len(self.router.errors()), 1)
+
+
+    def test_responses_to_journaled_messages(self):
+        self.start_app(spool_path=self.path)
+        self.database_down()
+        message = self.handle()
+        response = self.respond(message)
+
+        self.database_back()
+        spool.current.replay()
+        self.assertEqual(LoggedMessage.objects.get(pk=response.logger_id)
+                                              .response_to_id,
+                         message.logger_id)
+
+
+    def test_replayed_tag_keeps_newer_status(self):
+        self.start_app(spool_path=self.path)
+        first, second = self.handle(), self.handle()
+        self.database_down()
+        LoggedMessage.tag_message(first, 'success')
+        LoggedMessage.tag_message(second, 'success')
+        # Tagged again in the table, by a process without the spool
+        LoggedMessage.objects.filter(pk=first.logger_id) \
+                             .update(status='parse_error')
+
+        self.database_back()
+        spool.current.replay()
+        self.assertEqual(LoggedMessage.objects.get(pk=first.logger_id)
+                                              .status, 'parse_error')
+        self.assertEqual(LoggedMessage.objects.get(pk=second.logger_id)
+                                              .status, 'success')
+
+
+    def test_tags_replayed_before_next_write(self):
+        self.start_app(spool_path=self.path)
+        message = self.handle()
+        self.database_down()
+        LoggedMessage.tag_message(message, 'success')
+        self.assertEqual(spool.current.pending_tags, 1)
+
+        self.database_back()
+        self.handle()
+        self.assertEqual(spool.current.pending_tags, 0)
+        self.assertEqual(LoggedMessage.objects.get(pk=message.logger_id)
+                                              .status, 'success')
+
+        # Tags go straight to the table again
+        LoggedMessage.tag_message(message, 'error')
+        self.failIf(os.path.exists(self.path))
+        self.assertEqual(LoggedMessage.objects.get(pk=message.logger_id)
+                                              .status, 'error')
+
+
+    def test_truncated_line(self):
+        self.start_app(spool_path=self.path)
+        self.database_down()
+        first = self.handle()
+        f = open(self.path, 'ab')
+        f.write('{"id": 2, "te')
+        f.close()
+        second = self.handle()
+
+        records = list(spool.Journal(self.path).read())
+        self.assertEqual([record['id'] for record in records],
+                         [first.logger_id, second.logger_id])
+
+
+    def test_append_during_replay(self):
+        self.start_app(spool_path=self.path)
+        self.database_down()
+        for i in range(200):
+            self.handle()
+        records = list(spool.Journal(self.path).read())
+        os.remove(self.path)
+        spool.Journal(self.path).append(records[:100])
+        appended = []
+
+        def append():
+            for record in records[100:]:
+                spool.Journal(self.path).append([record])
+                appended.append(record)
+
+        thread = threading.Thread(target=append)
+        thread.start()
+        replayed = spool.replay_journal(self.path, self.app.error)
+        thread.join()
+
+        # Every record is either replayed or in the new journal
+        left = [record['id'] for record in spool.Journal(self.path).read()] \
+               if os.path.exists(self.path) else []
+        self.assertEqual(replayed + len(left), 200)
+        self.assertEqual(LoggedMessage.objects.count(), replayed)
+        self.assertEqual(self.router.errors(), [])
+
+
+class WriterTest(AppTestCase):
+
+    def test_spill(self):
+        self.assertRaises(ValueError, self.start_app, writer_queue_size=2,
+                          writer_policy=writer.POLICY_SPILL)
+        self.app.stop()
+
+        self.start_app(writer_queue_size=2, writer_policy=writer.POLICY_SPILL,
+                       batch_size=2, spool_path=self.path)
+        messages = [self.handle() for i in range(3)]
+        self.assertEqual(batch.current.spilled, 2)
+        self.assertEqual(sorted(spool.current.ids.keys()),
+                         [message.logger_id for message in messages[:2]])
+        self.assertEqual(LoggedMessage.objects.count(), 0)
+
+        # A response to a spilled message is still linked to it
+        response = self.respond(messages[0])
+        self.assertEqual(batch.current.flush(), 2)
+        self.assertEqual(LoggedMessage.objects.count(), 4)
+        self.assertEqual(spool.current.ids, {})
+        self.assertEqual(LoggedMessage.objects.get(pk=response.logger_id)
+                                              .response_to_id,
+                         messages[0].logger_id)
+
+
+    def test_failing_batch_is_dropped(self):
+        def fail(msgs):
+            raise Exception("Bad row")
+
+        self.start_app(writer_queue_size=10, batch_size=10)
+        write_messages = batch.write_messages
+        writer.write_messages = batch.write_messages = fail
+        try:
+            message = self.handle()
+            for i in range(batch.MAX_RETRIES - 1):
+                self.assertEqual(batch.current.flush(), 0)
+                self.assertEqual(batch.current.stats()['depth'], 1)
+            self.assertEqual(batch.current.flush(), 0)
+        finally:
+            writer.write_messages = batch.write_messages = write_messages
+        self.assertEqual(batch.current.stats()['depth'], 0)
+        self.assertEqual(batch.current.dropped, 1)
+        self.assertEqual(batch.current.get(message.logger_id), None)
+        self.failUnless(self.router.errors())
+
+
+class IndexQueriesTest(AppTestCase):
+    '''
+    The log view must get a page of messages, with their reporters and
+    responses, in the same number of queries however many there are.
+    '''
+
+    def setUp(self):
+        AppTestCase.setUp(self)
+        User.objects.create_superuser('logger_ng_test', '', 'secret')
+        self.client.login(username='logger_ng_test', password='secret')
+        # Queries are only recorded in debug mode
+        self.debug, settings.DEBUG = settings.DEBUG, True
+        self.backend = PersistantBackend.objects.get_or_create(
+                                                        slug='pygsm')[0]
+        self.start_app(rollup_interval=0)
+
+    def tearDown(self):
+        settings.DEBUG = self.debug
+        connection.queries = []
+        AppTestCase.tearDown(self)
+
+    def log(self, first, count):
+        '''
+        Logs a message from `count` reporters from number `first`, and a
+        response to each.
+        '''
+        for i in range(first, first + count):
+            reporter = Reporter.objects.create(username='logger_ng_%d' % i,
+                                               first_name=u"Test",
+                                               last_name=unicode(i))
+            PersistantConnection.objects.create(backend=self.backend,
+                                                identity='555%04d' % i,
+                                                reporter=reporter)
+            self.respond(self.handle(identity='555%04d' % i))
+
+    def page_queries(self):
+        connection.queries = []
+        response = self.client.get('/logger_ng')
+        self.assertEqual(response.status_code, 200)
+        return response, [query['sql'] for query in connection.queries]
+
+
+    def test_queries_per_page(self):
+        self.log(0, 1)
+        response, few = self.page_queries()
+        self.assertEqual(response.content.count('class="details"'), 1)
+
+        self.log(1, 29)
+        response, full = self.page_queries()
+        self.assertEqual(response.content.count('class="details"'), 30)
+        self.assertEqual(response.content.count('class="msg response"'), 30)
+        self.assertEqual(len(full), len(few))
+
+        # The page, with the reporters and their locations, then the
+        # responses
+        logged = [sql for sql in full
+                  if 'FROM "logger_ng_loggedmessage"' in sql]
+        self.assertEqual(len(logged), 2)
+
+
+class QueryPlanTest(TestCase):
+    '''
+    The queries of the log view, of the threaded responses and of the
+    identity lookups must use the indexes made for them by the migrations
+    (see check_logger_indexes), on SQLite and PostgreSQL.
+    '''
+
+    def test_hot_queries_use_their_index(self):
+        vendor = backend_vendor()
+        if vendor not in ('postgresql', 'sqlite'):
+            return
+        cursor = connection.cursor()
+        if vendor == 'postgresql':
+            # The test tables are nearly empty, and would be scanned
+            cursor.execute('SET enable_seqscan = off')
+        try:
+            for description, queryset, indexes in hot_queries():
+                plan = query_plan(queryset)
+                self.failUnless([index for index in indexes
+                                 if index in plan],
+                                "%s doesn't use %s:\n%s" %
+                                (description, ' or '.join(indexes), plan))
+        finally:
+            if vendor == 'postgresql':
+                cursor.execute('RESET enable_seqscan')
@@ -11,4 +11,14 @@ import logger_ng.views as views
 
 urlpatterns = patterns('',
     url(r'^logger_ng/?$', views.index),
+    url(r'^logger_ng/api/messages/?$', views.api_messages),
+    url(r'^logger_ng/live/?$', views.live_tail),
+    url(r'^logger_ng/stats/?$', views.stats),
+    url(r'^logger_ng/latency/?$', views.response_latency),
+    url(r'^logger_ng/instrumentation\.json$', views.instrumentation),
+    url(r'^logger_ng/identities/?$', views.identities),
+    url(r'^logger_ng/conversation/(?P<conversation_id>\d+)/?$',
+        views.conversation),
+    url(r'^logger_ng/live/stream$', views.live_stream),
+    url(r'^logger_ng/export\.(?P<format>csv|jsonl)$', views.export),
 )
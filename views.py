@@ -7,16 +7,48 @@ Views for logger_ng
 '''
 
 import re
+import socket
+import hashlib
+from urllib import urlencode
+from datetime import datetime, timedelta
 
-from django.db.models import Q
+from django.conf import settings
+from django.db.models import Max, Q
+from django.utils import simplejson
+from django.http import HttpResponse, HttpResponseBadRequest, \
+                        HttpResponseNotModified, Http404
 from django.shortcuts import get_object_or_404, redirect
 from django.core.paginator import Paginator, InvalidPage, EmptyPage
 from django.contrib.auth.decorators import login_required, permission_required
 
 from rapidsms.webui.utils import render_to_response
 
-from logger_ng.models import LoggedMessage
+from reporters.models import Reporter
+
+from logger_ng import live, latency, instrument
+from logger_ng.models import LoggedMessage, TrafficRollup, IdentitySummary, \
+                             NOT_THREADED
+from logger_ng.libs.lru import LRUCache, MISSING
 from logger_ng.utils import respond_to_msg
+from logger_ng.export import export_queryset, export_messages, parse_date
+from logger_ng.search import search_messages, search_words, index_exists, \
+                             filter_messages
+from logger_ng.pagination import KeysetPaginator, RankedPaginator, \
+                                 InvalidCursor, estimated_count, \
+                                 make_cursor, format_cursor, parse_cursor
+
+
+def threaded_messages():
+    '''
+    Returns the messages shown in the log, with their reporter and its
+    location.
+    '''
+    # Exclude outgoing messages that are a response to another, because
+    # they will be shown threaded beneath the original message.
+    # The reporter and its location are shown for every message, so get
+    # them along with the messages.
+    return LoggedMessage.objects.extra(where=[NOT_THREADED]) \
+                                .select_related('reporter__location')
 
 
 @login_required
@@ -40,39 +72,464 @@ def index(request):
                     respond_to_msg(msg, value)
             return redirect(index)
     
-    # Don't exclude outgoing messages that are a response to another,
-    # because they will be shown threaded beneath the original message
-    msgs = LoggedMessage.objects.exclude(
-                                    direction=LoggedMessage.DIRECTION_OUTGOING,
-                                    response_to__isnull=False)
-                                    
-    # filter from form        
-    if request.method == 'GET':
-        search = request.GET.get('logger_ng_search_box', '')
-        msgs = msgs.filter(Q(identity__icontains=search) | \
-                           Q(text__icontains=search) | \
-                           Q(reporter__first_name__icontains=search) | \
-                           Q(reporter__last_name__icontains=search))
-
-    msgs = msgs.order_by('-date', 'direction')
-
-    paginator = Paginator(msgs, MESSAGES_PER_PAGE)
-
-    # Set the pagination page. Go to page 1 in the event there is no page
-    # get variable or if it's something other than a number.
+    msgs = threaded_messages()
+
+    # filter from form, using the full text index if there is one (see
+    # search.py). Matches are ordered by relevance, then date.
+    search = request.GET.get('logger_ng_search_box', '')
+    ranked = search_words(search) and index_exists()
+    msgs = search_messages(msgs, search)
+
+    # Pages are found with cursors (see pagination.py) rather than page
+    # numbers, so that deep pages are as fast as the first one. Matches
+    # of the full text index are in order of relevance, the rest in date
+    # order.
+    if ranked:
+        paginator = RankedPaginator(msgs, MESSAGES_PER_PAGE, search)
+    else:
+        paginator = KeysetPaginator(msgs, MESSAGES_PER_PAGE)
+    try:
+        msgs = paginator.page(after=request.GET.get('after'),
+                              before=request.GET.get('before'))
+    except InvalidCursor:
+        msgs = paginator.page()
+
+    params = {'logger_ng_search_box': search.encode('utf-8')}
+    previous_link = next_link = None
+    if msgs.has_previous():
+        params['before'] = msgs.previous_cursor
+        previous_link = urlencode(params)
+        del params['before']
+    if msgs.has_next():
+        params['after'] = msgs.next_cursor
+        next_link = urlencode(params)
+
+    # Counting every message is as slow as it gets, so only do it if
+    # asked to, otherwise use the database's estimate if it has one.
+    exact_count = getattr(settings, 'LOGGER_NG_EXACT_COUNT', False)
+    if exact_count:
+        total = paginator.queryset.count()
+    elif not search:
+        total = estimated_count(LoggedMessage)
+
+    # Get all the responses shown on the page in one go
+    msgs.object_list = list(msgs.object_list)
+    LoggedMessage.attach_responses(msgs.object_list)
+
+    # Dates are displayed relative to the time of the request
+    now = datetime.now()
+
+    ctx = locals()
+    ctx['request'] = request
+    return render_to_response(request, "logger_ng/index.html", ctx)
+
+
+@login_required
+@permission_required('logger_ng.can_view')
+def export(request, format):
+    '''
+    Streams the messages matching the search box, optionally between the
+    since and until dates (YYYY-MM-DD), as CSV or JSON Lines. See export.py
+    '''
+    try:
+        since = parse_date(request.GET.get('since'))
+        until = parse_date(request.GET.get('until'))
+    except ValueError:
+        return HttpResponseBadRequest("Dates must be given as YYYY-MM-DD")
+
+    msgs = export_queryset(request.GET.get('logger_ng_search_box', ''),
+                           since, until)
+    if format == 'csv':
+        mimetype = 'text/csv; charset=utf-8'
+    else:
+        mimetype = 'application/x-ndjson; charset=utf-8'
+    # The response is sent as the messages are read, unless a middleware
+    # (i.e. GZipMiddleware) reads all of it first.
+    response = HttpResponse(export_messages(msgs, format), mimetype=mimetype)
+    response['Content-Disposition'] = 'attachment; filename=logger_ng.%s' % \
+                                      format
+    return response
+
+
+def message_dict(msg, reporter=True):
+    '''
+    Returns a LoggedMessage as a JSON serializable dict, with its responses
+    if they were attached (see LoggedMessage.attach_responses).
+    '''
+    data = msg.to_dict()
+    if reporter:
+        data['reporter'] = None
+        if msg.reporter_id is not None:
+            data['reporter'] = {'id': msg.reporter_id,
+                                'name': msg.reporter.full_name(),
+                                'location': msg.reporter.location and \
+                                            msg.reporter.location.name}
+    if hasattr(msg, 'responses'):
+        # Responses are to the same identity, so to the same reporter
+        data['responses'] = [message_dict(response, reporter=False)
+                             for response in msg.responses]
+    return data
+
+
+# How long a message can take to be committed once its modified date is
+# set. ?since= only returns messages modified at least that long ago, so
+# that one committed late isn't skipped (see api_messages).
+SINCE_SETTLE = timedelta(seconds=10)
+
+
+@login_required
+@permission_required('logger_ng.can_view')
+def api_messages(request):
+    '''
+    The message log as JSON, for dashboards and other scripts.
+
+    By default it returns the newest messages, with their responses, like
+    the log view. The `next` cursor in the result gets the older ones with
+    ?after=<cursor>, and `previous` the newer ones with ?before=<cursor>.
+
+    To fetch only what changed, pass the `since` cursor of the previous
+    result as ?since=<cursor>. This returns the messages that were logged
+    or tagged since, by the time they last changed (see
+    LoggedMessage.modified), oldest first, with `more` set if there are
+    others, and a new `since` cursor. Responses come as messages of their
+    own, linked by their response_to, and a message that was tagged comes
+    again, so clients should replace the messages they have by id.
+
+    Messages are paged on (modified, id) rather than on id, because ids
+    aren't committed in order (batches, the writer thread, the spool) and a
+    tag doesn't change the id. The modified date is set just before a
+    message is written, so only the messages modified at least
+    SINCE_SETTLE ago are returned, which leaves the ones being written time
+    to be committed. The router and the web server must share a clock for
+    that. Messages logged before LoggedMessage.modified was added are only
+    returned once they are tagged.
+
+    ?search= filters the messages like the search box of the log view, and
+    ?limit= sets the number of messages (30 by default, at most 500).
+
+    The result has an ETag, so polling with If-None-Match gets an empty
+    304 response when nothing changed. It is worked out from the request,
+    the newest id and the last time a message changed with two index
+    lookups, before anything else is queried. Renaming a reporter doesn't
+    change it.
+    '''
+    try:
+        limit = min(max(int(request.GET.get('limit', 30)), 1), 500)
+    except ValueError:
+        return HttpResponseBadRequest("limit must be a number")
+    since = request.GET.get('since')
+    if since:
+        try:
+            since_date, since_id = parse_cursor(since)
+        except InvalidCursor:
+            return HttpResponseBadRequest("Invalid cursor")
+    search = request.GET.get('search', '')
+
+    cutoff = datetime.now() - SINCE_SETTLE
+    newest = LoggedMessage.objects.aggregate(newest=Max('id'))['newest'] or 0
+    modified = LoggedMessage.objects.aggregate(
+                                modified=Max('modified'))['modified']
+    if since and modified is not None and modified > cutoff:
+        # The newest changes aren't returned yet, but will be once they
+        # settle, so the same request mustn't get a 304 then.
+        modified = cutoff
+    etag = '"%s"' % hashlib.md5('%s %d %s' % (request.get_full_path(),
+                                              newest, modified)).hexdigest()
+    if request.META.get('HTTP_IF_NONE_MATCH') == etag:
+        response = HttpResponseNotModified()
+        response['ETag'] = etag
+        return response
+
+    if since:
+        # The modified__gte is redundant, but lets the database use the
+        # index on modified to find where to start, and costs next to
+        # nothing when nothing changed.
+        msgs = filter_messages(LoggedMessage.objects.all(), search) \
+                    .filter(modified__gte=since_date, modified__lte=cutoff) \
+                    .filter(Q(modified__gt=since_date) |
+                            Q(modified=since_date, pk__gt=since_id)) \
+                    .select_related('reporter__location') \
+                    .order_by('modified', 'id')
+        msgs = list(msgs[:limit + 1])
+        page = msgs[:limit]
+        data = {'messages': [message_dict(msg) for msg in page],
+                'more': len(msgs) > limit,
+                'since': page and make_cursor(page[-1], 'modified') or since}
+    else:
+        paginator = KeysetPaginator(filter_messages(threaded_messages(),
+                                                    search), limit)
+        try:
+            page = paginator.page(after=request.GET.get('after'),
+                                  before=request.GET.get('before'))
+        except InvalidCursor:
+            return HttpResponseBadRequest("Invalid cursor")
+        LoggedMessage.attach_responses(page.object_list)
+        # Everything modified up to the cutoff is committed, so is either
+        # in this result or older than it.
+        data = {'messages': [message_dict(msg) for msg in page.object_list],
+                'next': page.next_cursor,
+                'previous': page.previous_cursor,
+                'since': format_cursor(cutoff, 0),
+                'last_id': newest}
+
+    response = HttpResponse(simplejson.dumps(data),
+                            mimetype='application/json')
+    response['ETag'] = etag
+    return response
+
+
+# reporter id => (name, location name), for the live tail, which only gets
+# the reporter id of the messages.
+reporter_names = LRUCache(max_size=1000, ttl=300)
+
+
+def reporter_dict(reporter_id):
+    '''
+    Returns the reporter of a message as in message_dict, from the
+    reporter_names cache if possible.
+    '''
+    if reporter_id is None:
+        return None
+    names = reporter_names.get(reporter_id)
+    if names is MISSING:
+        try:
+            reporter = Reporter.objects.select_related('location') \
+                                       .get(pk=reporter_id)
+            names = (reporter.full_name(),
+                     reporter.location and reporter.location.name)
+        except Reporter.DoesNotExist:
+            names = (None, None)
+        reporter_names.set(reporter_id, names)
+    return {'id': reporter_id, 'name': names[0], 'location': names[1]}
+
+
+def live_events(messages):
+    '''
+    Yields the messages from live.subscribe as server-sent events, with a
+    comment every now and then, so that the connection isn't closed by a
+    proxy and a browser that went away is noticed.
+    '''
+    yield 'retry: 3000\n\n'
+    for data in messages:
+        if data is None:
+            yield ': keep alive\n\n'
+            continue
+        data['reporter'] = reporter_dict(data.pop('reporter_id'))
+        yield 'id: %d\ndata: %s\n\n' % (data['id'], simplejson.dumps(data))
+
+
+@login_required
+@permission_required('logger_ng.can_view')
+def live_stream(request):
+    '''
+    Streams the messages as they are logged, as server-sent events, from
+    the router's live tail (see live.py).
+
+    Browsers send the id of the last message they got in the Last-Event-ID
+    header when they reconnect, and get the messages they missed first.
+    The same can be done with ?last_id=
+    '''
+    port = getattr(settings, 'LOGGER_NG_LIVE_PORT', 0)
+    secret = getattr(settings, 'LOGGER_NG_LIVE_SECRET', '')
+    if not port or not secret:
+        raise Http404
+    try:
+        last_id = int(request.META.get('HTTP_LAST_EVENT_ID') or
+                      request.GET.get('last_id') or 0)
+    except ValueError:
+        return HttpResponseBadRequest("last_id must be a number")
+
+    try:
+        messages = live.subscribe(int(port), secret, last_id)
+    except socket.error:
+        return HttpResponse("The router isn't running", status=503)
+
+    # Every event is sent as it comes, unless a middleware (i.e.
+    # GZipMiddleware) reads the whole response first.
+    response = HttpResponse(live_events(messages),
+                            mimetype='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    return response
+
+
+@login_required
+@permission_required('logger_ng.can_view')
+def live_tail(request):
+    '''
+    Shows the messages as they are logged.
+    '''
+    return render_to_response(request, "logger_ng/live.html",
+                              {'request': request})
+
+
+@login_required
+@permission_required('logger_ng.can_view')
+def stats(request):
+    '''
+    Traffic per hour over the last two days, or per day over the last month
+    with ?period=day, by backend, from the rollups (see rollup.py).
+    '''
+    if request.GET.get('period') == 'day':
+        period, since = TrafficRollup.PERIOD_DAY, timedelta(days=30)
+    else:
+        period, since = TrafficRollup.PERIOD_HOUR, timedelta(days=2)
+    rollups = TrafficRollup.objects.filter(period=period,
+                                           start__gte=datetime.now() - since) \
+                                   .order_by('-start', 'backend')
+
+    # (start, backend) => {'incoming': ..., 'outgoing': ..., status: ...}
+    rows = {}
+    statuses = set()
+    for rollup in rollups:
+        row = rows.setdefault((rollup.start, rollup.backend),
+                              {'start': rollup.start,
+                               'backend': rollup.backend,
+                               'incoming': 0, 'outgoing': 0, 'statuses': {}})
+        if rollup.direction == LoggedMessage.DIRECTION_INCOMING:
+            row['incoming'] += rollup.count
+        else:
+            row['outgoing'] += rollup.count
+        if rollup.status:
+            statuses.add(rollup.status)
+            row['statuses'][rollup.status] = \
+                row['statuses'].get(rollup.status, 0) + rollup.count
+
+    statuses = sorted(statuses)
+    rows = sorted(rows.values(), key=lambda row: (row['start'],
+                                                  row['backend']),
+                  reverse=True)
+    for row in rows:
+        row['status_counts'] = [row['statuses'].get(status, 0)
+                                for status in statuses]
+    by_day = period == TrafficRollup.PERIOD_DAY
+
+    return render_to_response(request, "logger_ng/stats.html",
+                              {'request': request, 'rows': rows,
+                               'statuses': statuses, 'by_day': by_day})
+
+
+@login_required
+@permission_required('logger_ng.can_view')
+def response_latency(request):
+    '''
+    Percentiles of the time reporters waited for a response, per backend
+    and per day over the last month (or ?days=), from the ResponseLatency
+    histograms (see latency.py).
+    '''
+    try:
+        days = min(max(int(request.GET.get('days', 30)), 1), 366)
+    except ValueError:
+        days = 30
+    since = datetime.now().replace(hour=0, minute=0, second=0,
+                                   microsecond=0) - timedelta(days=days - 1)
+    rows = latency.load(since, backend=request.GET.get('backend'))
+
+    def summary(backend, start, histogram):
+        stats = histogram.stats()
+        stats.update({'backend': backend, 'start': start})
+        return stats
+
+    totals = [summary(*row) for row in latency.summarize(rows)]
+    per_day = [summary(*row) for row in latency.summarize(rows, 'day')]
+    per_day.reverse()
+
+    return render_to_response(request, "logger_ng/latency.html",
+                              {'request': request, 'days': days,
+                               'totals': totals, 'per_day': per_day})
+
+
+@login_required
+@permission_required('logger_ng.can_view')
+def conversation(request, conversation_id):
+    '''
+    All the messages of a conversation (see conversation.py), in order,
+    loaded with one query on the (conversation, date, id) index.
+    '''
+    msgs = list(LoggedMessage.objects.filter(conversation=conversation_id)
+                                     .order_by('date', 'id')
+                                     .select_related('reporter__location'))
+    if not msgs:
+        raise Http404
+    return render_to_response(request, "logger_ng/conversation.html",
+                              {'request': request, 'msgs': msgs,
+                               'first': msgs[0], 'now': datetime.now()})
+
+
+# ?sort= of the identities view => ordering, each using an index
+IDENTITY_SORTS = {
+    'recent': ('-last_seen', '-id'),
+    'senders': ('-incoming', '-id'),
+    'recipients': ('-outgoing', '-id'),
+}
+
+
+@login_required
+@permission_required('logger_ng.can_view')
+def identities(request):
+    '''
+    The phones that sent or received messages, from the identity summaries
+    (see summary.py): the most recent first, the top senders with
+    ?sort=senders, or the top recipients with ?sort=recipients. With
+    ?silent=N, only the phones that have been silent for N days.
+    '''
+    IDENTITIES_PER_PAGE = 50
+
+    sort = request.GET.get('sort')
+    if sort not in IDENTITY_SORTS:
+        sort = 'recent'
+    summaries = IdentitySummary.objects.order_by(*IDENTITY_SORTS[sort]) \
+                                       .select_related('reporter')
+    params = {'sort': sort}
+    try:
+        silent = max(int(request.GET.get('silent', 0)), 0)
+    except ValueError:
+        silent = 0
+    if silent:
+        summaries = summaries.filter(last_seen__lt=datetime.now() -
+                                                   timedelta(days=silent))
+        params['silent'] = silent
+
+    paginator = Paginator(summaries, IDENTITIES_PER_PAGE)
     try:
         page = int(request.GET.get('page', '1'))
     except ValueError:
         page = 1
-
-    # Try to set the paginator object to the correct page. Set it to the
-    # last page if there is some problem with it (too high, etc...)
-    
     try:
-        msgs = paginator.page(page)
+        summaries = paginator.page(page)
     except (EmptyPage, InvalidPage):
-        msgs = paginator.page(paginator.num_pages)
+        summaries = paginator.page(paginator.num_pages)
 
-    ctx = locals()
-    ctx['request'] = request
-    return render_to_response(request, "logger_ng/index.html", ctx)
+    previous_link = next_link = None
+    if summaries.has_previous():
+        params['page'] = summaries.previous_page_number()
+        previous_link = urlencode(params)
+    if summaries.has_next():
+        params['page'] = summaries.next_page_number()
+        next_link = urlencode(params)
+
+    return render_to_response(request, "logger_ng/identities.html",
+                              {'request': request, 'summaries': summaries,
+                               'sort': sort, 'silent': silent,
+                               'previous_link': previous_link,
+                               'next_link': next_link,
+                               'now': datetime.now()})
+
+
+@login_required
+@permission_required('logger_ng.can_view')
+def instrumentation(request):
+    '''
+    The latest instrumentation snapshot of the router (see instrument.py),
+    as JSON, if LOGGER_NG_STATS_PATH is set.
+    '''
+    path = getattr(settings, 'LOGGER_NG_STATS_PATH', None)
+    if not path:
+        raise Http404
+    data = instrument.read_snapshot(path)
+    if data is None:
+        return HttpResponse("The router hasn't written its stats yet",
+                            status=503)
+    response = HttpResponse(simplejson.dumps(data),
+                            mimetype='application/json')
+    response['Cache-Control'] = 'no-cache'
+    return response
@@ -0,0 +1,362 @@
+#!/usr/bin/env python
+# vim: ai ts=4 sts=4 et sw=4
+# maintainer: dgelvin
+
+'''
+Asynchronous writing of LoggedMessage objects.
+
+With a BackgroundWriter, App.handle and App.outgoing never wait for the
+database: they put the LoggedMessage in a bounded queue and return, and a
+dedicated thread writes the queued messages in bulk. As with the
+MessageBuffer in batch.py (which it replaces when enabled), messages get
+their primary key when they are queued, and tag_message and response_to
+linking work on messages that haven't been written yet.
+
+When the queue is full, what happens depends on the policy:
+    block       - the router waits until there is room in the queue.
+    drop_oldest - the oldest queued message is discarded (and counted).
+    spill       - the oldest queued messages are appended to the spool
+                  journal (see spool.py) to make room, which doesn't wait
+                  for the database or the writer thread. It needs a
+                  spool_path in local.ini.
+
+Messages are always written in the order they were queued, so a response
+is never written before the incoming message it points to: spilled
+messages are replayed from the journal before the next batch is written.
+If that incoming message was dropped, the response is written without
+response_to.
+
+If writing a batch fails batch.MAX_RETRIES times in a row, its messages
+are written one at a time, and those that still fail are dropped and
+logged, as in batch.MessageBuffer.
+'''
+
+import time
+import threading
+from collections import deque
+from datetime import datetime
+
+from logger_ng import spool
+from logger_ng.batch import IdAllocator, MAX_RETRIES, write_messages, \
+                            write_each
+from logger_ng.libs.histogram import Histogram
+from logger_ng.libs.lru import LRUCache, MISSING
+
+
+POLICY_BLOCK = 'block'
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_SPILL = 'spill'
+POLICIES = (POLICY_BLOCK, POLICY_DROP_OLDEST, POLICY_SPILL)
+
+# Don't log more than one warning about dropped messages per that many
+# seconds.
+WARNING_INTERVAL = 60
+
+
+class BackgroundWriter(object):
+    '''
+    Writes LoggedMessage objects from a bounded queue, in a thread of its
+    own. It has the same interface as batch.MessageBuffer, so it can be
+    used as batch.current.
+    '''
+
+    def __init__(self, max_size=10000, policy=POLICY_BLOCK, batch_size=100,
+                 allocator=None, error=None):
+        if policy not in POLICIES:
+            raise ValueError("Unknown queue policy %r, must be one of: %s" %
+                             (policy, ', '.join(POLICIES)))
+        if policy == POLICY_SPILL and spool.current is None:
+            raise ValueError("The %s queue policy needs a spool_path" %
+                             policy)
+        self.max_size = max_size
+        self.policy = policy
+        self.batch_size = batch_size
+        self.allocator = allocator or IdAllocator(max(batch_size, 1))
+        self.error = error
+
+        # Queued messages, with the time they were queued
+        self._queue = deque()
+        # pk => message, for the queued messages and those being written
+        self._by_id = {}
+        # pks of the messages being written
+        self._writing = set()
+        # pks of recently dropped messages, which can't be pointed to
+        self._dropped = LRUCache(max_size=max_size)
+        self._cond = threading.Condition()
+        # Held while a batch is taken from the queue and written, so that
+        # batches are written in order when flush() is called by another
+        # thread than the writer's.
+        self._write_lock = threading.Lock()
+        self._thread = None
+        self._stopping = False
+
+        self.enqueued = 0
+        self.written = 0
+        self.dropped = 0
+        self.spilled = 0
+        self.failures = 0
+        # Number of times in a row the batch at the front failed
+        self._retries = 0
+        self.max_depth = 0
+        # Milliseconds between a message being queued and committed
+        self.latency = Histogram()
+        self._last_warning = 0
+
+
+    def add(self, msg):
+        '''
+        Gives the LoggedMessage its primary key and date, and queues it for
+        writing, applying the queue policy if the queue is full.
+        '''
+        if msg.pk is None:
+            msg.id = self.allocator.next_id()
+        if msg.date is None:
+            msg.date = datetime.now()
+
+        self._cond.acquire()
+        try:
+            while len(self._queue) >= self.max_size and \
+                  self.policy == POLICY_BLOCK and not self._stopping:
+                self._cond.wait()
+
+            if len(self._queue) >= self.max_size and \
+               self.policy == POLICY_DROP_OLDEST:
+                oldest, queued_at = self._queue.popleft()
+                del self._by_id[oldest.pk]
+                self._dropped.set(oldest.pk, True)
+                self.dropped += 1
+                self._warn("Queue full, dropped %d messages so far" %
+                           self.dropped)
+
+            self._queue.append((msg, time.time()))
+            self._by_id[msg.pk] = msg
+            self.enqueued += 1
+            self.max_depth = max(self.max_depth, len(self._queue))
+            self._cond.notifyAll()
+            spill = self.policy == POLICY_SPILL and \
+                    len(self._queue) > self.max_size
+        finally:
+            self._cond.release()
+
+        if spill:
+            self._spill()
+
+
+    def get(self, pk):
+        '''
+        Returns the LoggedMessage with this primary key if it hasn't been
+        written yet, else None.
+        '''
+        return self._by_id.get(pk)
+
+
+    def tag(self, pk, status):
+        '''
+        Sets the status of a LoggedMessage that is still queued. Returns
+        False if it has already been written. If it is being written right
+        now, this waits until it has been.
+        '''
+        self._cond.acquire()
+        try:
+            while pk in self._writing:
+                self._cond.wait()
+            msg = self._by_id.get(pk)
+            if msg is None:
+                return False
+            msg.status = status
+            return True
+        finally:
+            self._cond.release()
+
+
+    def flush(self):
+        '''
+        Writes everything that is queued, in the calling thread, and
+        returns the number of messages written.
+        '''
+        count = 0
+        while self._queue:
+            written = self._write_batch(wait=False)
+            if written is None:
+                break
+            count += written
+        return count
+
+
+    def stats(self):
+        '''
+        Returns the queue metrics as a dict.
+        '''
+        return {'depth': len(self._queue), 'max_depth': self.max_depth,
+                'max_size': self.max_size, 'policy': self.policy,
+                'enqueued': self.enqueued, 'written': self.written,
+                'dropped': self.dropped, 'spilled': self.spilled,
+                'failures': self.failures,
+                'latency_ms': self.latency.stats()}
+
+
+    def start(self):
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='logger_ng writer')
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+
+    def stop(self):
+        '''
+        Stops the writing thread once the queue is empty.
+        '''
+        self._cond.acquire()
+        try:
+            self._stopping = True
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.flush()
+
+
+    def _run(self):
+        while True:
+            written = self._write_batch(wait=True)
+            # Don't keep retrying on shutdown if the database is failing.
+            if self._stopping and (written is None or not self._queue):
+                return
+
+
+    def _write_batch(self, wait):
+        '''
+        Takes up to batch_size messages from the queue and writes them.
+        If wait is True, waits for messages to be queued first. Returns
+        the number of messages written, or None if writing failed.
+        '''
+        self._write_lock.acquire()
+        try:
+            return self._take_and_write(wait)
+        finally:
+            self._write_lock.release()
+
+
+    def _take_and_write(self, wait):
+        self._cond.acquire()
+        try:
+            if wait:
+                while not self._queue and not self._stopping:
+                    self._cond.wait(1)
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popleft())
+            msgs = [msg for msg, queued_at in batch]
+            self._writing.update([msg.pk for msg in msgs])
+            # There is room in the queue again
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+        if not batch:
+            return 0
+
+        self._unlink_dropped(msgs)
+        try:
+            write_messages(msgs)
+        except Exception, e:
+            self.failures += 1
+            self._retries += 1
+            if self.error:
+                self.error("Could not write %d queued messages: %s",
+                           len(msgs), e)
+            if self._retries < MAX_RETRIES:
+                # Put the messages back at the front of the queue, they
+                # will be retried with the next batch.
+                self._put_back(batch)
+                if not self._stopping:
+                    time.sleep(1)
+                return None
+            dropped = write_each(msgs, self.error)
+        else:
+            dropped = []
+            if self.allocator.behind:
+                self.allocator.catch_up()
+        self._retries = 0
+
+        now = time.time()
+        self._cond.acquire()
+        try:
+            for msg, queued_at in batch:
+                self.latency.add((now - queued_at) * 1000)
+                self._by_id.pop(msg.pk, None)
+            for msg in dropped:
+                self._dropped.set(msg.pk, True)
+            self._writing.difference_update([msg.pk for msg in msgs])
+            self.written += len(batch) - len(dropped)
+            self.dropped += len(dropped)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+        return len(batch) - len(dropped)
+
+
+    def _spill(self):
+        '''
+        Moves the oldest batch_size queued messages to the spool journal.
+        '''
+        self._cond.acquire()
+        try:
+            batch = []
+            while self._queue and len(batch) < self.batch_size:
+                batch.append(self._queue.popleft())
+            msgs = [msg for msg, queued_at in batch]
+            self._writing.update([msg.pk for msg in msgs])
+        finally:
+            self._cond.release()
+
+        self._unlink_dropped(msgs)
+        try:
+            spool.current.spill(msgs)
+        except Exception, e:
+            self._put_back(batch)
+            if self.error:
+                self.error("Could not spill %d queued messages: %s",
+                           len(msgs), e)
+            return
+
+        self._cond.acquire()
+        try:
+            for msg in msgs:
+                self._by_id.pop(msg.pk, None)
+            self._writing.difference_update([msg.pk for msg in msgs])
+            self.spilled += len(msgs)
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+
+    def _put_back(self, batch):
+        '''
+        Puts the (message, queued at) of a batch that couldn't be written
+        back at the front of the queue.
+        '''
+        self._cond.acquire()
+        try:
+            self._writing.difference_update([msg.pk for msg, queued_at
+                                             in batch])
+            self._queue.extendleft(reversed(batch))
+            self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+
+    def _unlink_dropped(self, msgs):
+        for msg in msgs:
+            if msg.response_to_id is not None and \
+               self._dropped.get(msg.response_to_id) is not MISSING:
+                msg.response_to_id = None
+
+
+    def _warn(self, text):
+        if self.error and time.time() - self._last_warning > WARNING_INTERVAL:
+            self._last_warning = time.time()
+            self.error(text)